@@ -35,6 +35,7 @@ export function useIntakeForm(
     const packageVol = ref('')
     const numberOfPackages = ref('')
     const intakeLotId = ref('')
+    const previewLotId = ref('')  // next auto ID as shown; the server assigns it on save
     const showIngredientDialog = ref(false)
     const tempIngredientId = ref('')
     const isSaving = ref(false)
@@ -265,7 +266,7 @@ export function useIntakeForm(
     const generateIntakeLotId = async () => {
         try {
             const data = await $fetch<{ next_id: string }>(`${appConfig.apiBaseUrl}/ingredient-intake-next-id`)
-            intakeLotId.value = data.next_id
+            intakeLotId.value = previewLotId.value = data.next_id
         } catch (e: any) {
             console.error('Failed to generate ID', e)
             intakeLotId.value = 'Error: ' + e.message
@@ -360,7 +361,8 @@ export function useIntakeForm(
         const proceedSave = async () => {
             isSaving.value = true
             const payload = {
-                intake_lot_id: intakeLotId.value,
+                // An untouched preview is not reserved: let the server allocate the ID
+                intake_lot_id: !isEditing.value && intakeLotId.value === previewLotId.value ? null : intakeLotId.value,
                 intake_from: intakeFrom.value, intake_to: intakeTo.value,
                 mat_sap_code: xMatSapCode.value, re_code: xReCode.value,
                 material_description: xIngredientName.value, uom: 'kg',
@@ -3,6 +3,7 @@
  */
 import { ref, computed, watch } from 'vue'
 import { appConfig } from '~/appConfig/config'
+import { useProductionPlanSync } from '~/composables/useProductionPlanSync'
 
 export interface ProductionDeps {
     $q: any
@@ -34,6 +35,7 @@ export function usePreBatchProduction(deps: ProductionDeps) {
     const selectedBatchIndex = ref(0)
     const isLoading = ref(false)
     const productionPlans = ref<any[]>([])
+    const planSync = useProductionPlanSync(getAuthHeader, productionPlans)
     const planFilter = ref('All')
     const searchPlanId = ref('')
     const searchSkuName = ref('')
@@ -125,10 +127,7 @@ export function usePreBatchProduction(deps: ProductionDeps) {
     const fetchProductionPlans = async () => {
         try {
             isLoading.value = true
-            const data = await $fetch<any[]>(`${appConfig.apiBaseUrl}/production-plans/`, {
-                headers: getAuthHeader() as Record<string, string>
-            })
-            productionPlans.value = data
+            await planSync.refresh()
         } catch (error) {
             console.error('Error fetching production plans:', error)
             $q.notify({ type: 'negative', message: t('preBatch.errorLoadingPlans'), position: 'top' })
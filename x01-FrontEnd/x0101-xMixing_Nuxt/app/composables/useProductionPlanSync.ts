@@ -0,0 +1,61 @@
+/**
+ * useProductionPlanSync — incremental refresh of GET /production-plans/
+ *
+ * The first refresh downloads the plan list. Later refreshes send the last
+ * ETag (304 = nothing changed, no body) and the last X-Sync-Token as
+ * `updated_since`, and merge only the plans that changed into `plans`;
+ * unchanged plan objects (and anything the page attached to them) are kept.
+ * Plans listed in X-Deleted-Plans are dropped; X-Sync-Reset means the body
+ * is the full list.
+ */
+import { ref, type Ref } from 'vue'
+import { appConfig } from '~/appConfig/config'
+
+const PAGE_SIZE = 1000
+
+const newestFirst = (a: any, b: any) =>
+    String(b.created_at).localeCompare(String(a.created_at)) || b.id - a.id
+
+export function useProductionPlanSync(
+    getAuthHeader: () => Record<string, string>,
+    plans: Ref<any[]> = ref([]),
+) {
+    let etag = ''
+    let syncToken = ''
+
+    const refresh = async (full = false): Promise<any[]> => {
+        const delta = !full && !!syncToken
+        const res = await $fetch.raw<any[]>(`${appConfig.apiBaseUrl}/production-plans/`, {
+            params: { skip: 0, limit: PAGE_SIZE, ...(delta ? { updated_since: syncToken } : {}) },
+            headers: { ...getAuthHeader(), ...(delta && etag ? { 'If-None-Match': etag } : {}) },
+            cache: 'no-store',
+            ignoreResponseError: true,
+        })
+        if (res.status === 304) return plans.value
+        if (!res.ok) throw new Error(`Failed to load production plans (HTTP ${res.status})`)
+
+        // More changes than one page: start over with a full download
+        if (delta && res.headers.get('X-Next-Cursor')) return refresh(true)
+
+        etag = res.headers.get('ETag') || ''
+        syncToken = res.headers.get('X-Sync-Token') || ''
+        const data = res._data || []
+        const deleted = (res.headers.get('X-Deleted-Plans') || '').split(',').filter(Boolean).map(Number)
+        if (!delta || res.headers.get('X-Sync-Reset')) {
+            plans.value = data
+        } else if (data.length || deleted.length) {
+            const byId = new Map(plans.value.map((p: any) => [p.id, p]))
+            for (const id of deleted) byId.delete(id)
+            for (const p of data) byId.set(p.id, p)
+            plans.value = [...byId.values()].sort(newestFirst)
+        }
+        return plans.value
+    }
+
+    const reset = () => {
+        etag = ''
+        syncToken = ''
+    }
+
+    return { plans, refresh, reset }
+}
@@ -0,0 +1,22 @@
+from database import SessionLocal
+from crud.crud_prebatch import backfill_rec_barcodes, rebuild_req_progress
+
+
+def backfill():
+    db = SessionLocal()
+    try:
+        print("Filling prebatch_recs.batch_id from requirements and bag barcodes...")
+        count = backfill_rec_barcodes(db)
+        print(f"Successfully updated {count} bags.")
+        print("Recounting prebatch_reqs.packaged_volume / bag_count...")
+        count = rebuild_req_progress(db)
+        print(f"Successfully updated {count} requirements.")
+    except Exception as e:
+        db.rollback()
+        print(f"Error during backfill: {e}")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    backfill()
@@ -0,0 +1,21 @@
+import models  # noqa: F401  (registers stock_ledger on Base)
+from database import Base, SessionLocal, engine
+from crud.crud_ledger import backfill_stock_ledger
+
+
+def backfill():
+    Base.metadata.create_all(bind=engine, tables=[models.StockLedger.__table__])
+    db = SessionLocal()
+    try:
+        print("Seeding stock_ledger from intakes, stock adjustments and pre-batch usage...")
+        count = backfill_stock_ledger(db)
+        print(f"Successfully wrote {count} ledger rows.")
+    except Exception as e:
+        db.rollback()
+        print(f"Error during backfill: {e}")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    backfill()
@@ -0,0 +1,68 @@
+"""
+Bag Barcodes
+============
+Format and parse the IDs printed on pre-batch labels.
+
+    batch_id         <plan_id>-<NNN>                      P001-260305-01-003
+    batch_record_id  <batch_id>-<re_code>-<package_no>    P001-260305-01-003-RE-101-2
+    prebatch_id      <batch_id><re_code><recode_batch_id>
+
+re_code and plan_id may contain "-", so a barcode is only split with one of
+them known. Bags store the parts (prebatch_recs.batch_id, re_code,
+package_no) when they are written, and lookups compare those indexed columns;
+parse_bag_barcode() is for scans and for rows written before the columns
+existed.
+
+The CRUD layer fills the parts where it builds a bag. Scripts that insert bags
+some other way set batch_id themselves or run backfill_bag_barcodes.py.
+"""
+from typing import NamedTuple, Optional
+
+
+class BagBarcode(NamedTuple):
+    batch_id: str
+    re_code: str
+    package_no: Optional[int]
+
+
+def format_bag_barcode(batch_id: str, re_code: str, package_no: int) -> str:
+    return f"{batch_id}-{re_code}-{package_no}"
+
+
+def format_prebatch_id(batch_id: str, re_code: str, recode_batch_id: str) -> str:
+    return f"{batch_id}{re_code}{recode_batch_id}"
+
+
+def _package_no(part: str) -> Optional[int]:
+    return int(part) if part.isdigit() else None
+
+
+def parse_bag_barcode(barcode: str, re_code: Optional[str] = None,
+                      plan_id: Optional[str] = None) -> Optional[BagBarcode]:
+    """Split a batch_record_id using its re_code or, failing that, its plan_id.
+
+    Returns None when neither locates the parts. package_no is None when the
+    barcode does not end in a number.
+    """
+    if not barcode:
+        return None
+    if re_code:
+        marker = f"-{re_code}"
+        at = barcode.find(marker + "-")
+        if at > 0:
+            return BagBarcode(barcode[:at], re_code, _package_no(barcode[at + len(marker) + 1:]))
+        if barcode.endswith(marker) and len(barcode) > len(marker):
+            return BagBarcode(barcode[:-len(marker)], re_code, None)
+    if plan_id and barcode.startswith(plan_id + "-"):
+        seq, _, rest = barcode[len(plan_id) + 1:].partition("-")
+        if seq and rest:
+            head, _, tail = rest.rpartition("-")
+            package_no = _package_no(tail) if head else None
+            return BagBarcode(f"{plan_id}-{seq}", head if package_no is not None else rest, package_no)
+    return None
+
+
+def batch_plan_id(batch_id: str) -> str:
+    """plan_id part of a batch_id (everything before the last "-")."""
+    return batch_id.rpartition("-")[0] or batch_id
+
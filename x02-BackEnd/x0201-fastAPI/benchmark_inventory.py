@@ -0,0 +1,96 @@
+"""
+Concurrent weighing-station benchmark for the inventory mutation service.
+
+N station threads, each with its own session, draw from the same lots at the
+same time through lock_lots() / move_stock() / run_in_transaction(). At the
+end every lot must hold exactly intake − Σ draws (no lost updates) and the
+ledger must have one row per draw.
+
+The BENCH-* lots and their ledger rows are removed afterwards.
+
+Usage:
+    python benchmark_inventory.py                      # 20 stations x 50 draws over 3 lots
+    python benchmark_inventory.py 40 100 5             # stations, draws per station, lots
+"""
+import sys
+import threading
+import time
+
+from database import SessionLocal
+import models
+from crud.crud_inventory import lock_lots, move_stock, run_in_transaction
+
+INTAKE_VOL = 1_000_000.0
+DRAW = 0.25
+
+
+def _station(station: int, lot_ids, draws: int, errors: list):
+    db = SessionLocal()
+    try:
+        for n in range(draws):
+            # Stations pull from two lots per draw, listed in a different order each time
+            pair = [lot_ids[(station + n) % len(lot_ids)], lot_ids[(station + n + 1) % len(lot_ids)]]
+
+            def draw():
+                lots = lock_lots(db, reversed(pair))
+                for lot_id in pair:
+                    move_stock(db, lots[lot_id], -DRAW, "prebatch", reason="Benchmark",
+                               moved_by=f"station-{station}", reference="BENCH")
+
+            run_in_transaction(db, draw)
+    except Exception as e:
+        errors.append(e)
+    finally:
+        db.close()
+
+
+def run_benchmark(stations=20, draws=50, lot_count=3):
+    lot_ids = [f"BENCH-{n:03d}" for n in range(lot_count)]
+    db = SessionLocal()
+    try:
+        _cleanup(db, lot_ids)
+        for lot_id in lot_ids:
+            db.add(models.IngredientIntakeList(
+                intake_lot_id=lot_id, lot_id=lot_id, mat_sap_code="BENCH", re_code="BENCH",
+                intake_vol=INTAKE_VOL, remain_vol=INTAKE_VOL, intake_by="benchmark",
+            ))
+        db.commit()
+
+        errors: list = []
+        threads = [threading.Thread(target=_station, args=(s, lot_ids, draws, errors)) for s in range(stations)]
+        started = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - started
+
+        db.expire_all()
+        expected_total = lot_count * INTAKE_VOL - stations * draws * 2 * DRAW
+        remain = {lot.intake_lot_id: lot.remain_vol for lot in db.query(models.IngredientIntakeList).filter(
+            models.IngredientIntakeList.intake_lot_id.in_(lot_ids))}
+        ledger_rows = db.query(models.StockLedger).filter(models.StockLedger.intake_lot_id.in_(lot_ids)).count()
+        lost = round((sum(remain.values()) - expected_total) / DRAW)
+
+        print(f"{stations} stations x {draws} draws over {lot_count} lots in {elapsed:.2f}s "
+              f"-> {stations * draws / elapsed:.1f} transactions/s")
+        print(f"Failed stations: {len(errors)}  lost updates: {lost}  ledger rows: {ledger_rows} "
+              f"(expected {stations * draws * 2})")
+        for e in errors[:5]:
+            print(f"  {e}")
+        return {"elapsed": elapsed, "errors": errors, "lost_updates": lost, "ledger_rows": ledger_rows}
+    finally:
+        _cleanup(db, lot_ids)
+        db.close()
+
+
+def _cleanup(db, lot_ids):
+    db.query(models.StockLedger).filter(models.StockLedger.intake_lot_id.in_(lot_ids)).delete(synchronize_session=False)
+    db.query(models.IngredientIntakeList).filter(
+        models.IngredientIntakeList.intake_lot_id.in_(lot_ids)).delete(synchronize_session=False)
+    db.commit()
+
+
+if __name__ == "__main__":
+    args = [int(a) for a in sys.argv[1:4]]
+    run_benchmark(*args)
@@ -0,0 +1,99 @@
+"""
+Production plan creation benchmark.
+
+Creates plans of increasing batch count for a BENCH-PLAN SKU with a
+40-ingredient recipe through crud.create_production_plan(), and prints the
+wall time and the number of SQL statements (round trips to the database)
+each one took.
+
+The benchmark SKU, its ingredients and the plans (plant "Line-99", plan ids
+P099-...) are removed afterwards.
+
+Usage:
+    python benchmark_plan_creation.py                  # 10, 50, 100, 200 batches x 40 ingredients
+    python benchmark_plan_creation.py 40 10 100 500    # ingredients, then batch counts
+"""
+import sys
+import time
+
+from sqlalchemy import event
+
+from database import SessionLocal, engine
+import models
+import schemas
+from crud.crud_production import create_production_plan
+
+SKU_ID = "BENCH-PLAN"
+PLANT = "Line-99"
+
+
+class _StatementCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+
+
+def _setup(db, ingredient_count):
+    _cleanup(db)
+    db.add(models.Sku(sku_id=SKU_ID, sku_name="Plan benchmark", std_batch_size=1000.0, creat_by="benchmark"))
+    for n in range(ingredient_count):
+        re_code = f"BENCH-RE-{n:03d}"
+        db.add(models.Ingredient(blind_code=f"BENCH-BLIND-{n:03d}", mat_sap_code=f"BENCH-MAT-{n:03d}",
+                                 re_code=re_code, name=f"Bench ingredient {n}", warehouse="FH",
+                                 creat_by="benchmark"))
+        db.add(models.SkuStep(sku_id=SKU_ID, phase_number="P1", sub_step=n + 1, re_code=re_code, require=10.0 + n))
+    db.commit()
+
+
+def run_benchmark(ingredient_count=40, batch_counts=(10, 50, 100, 200)):
+    db = SessionLocal()
+    counter = _StatementCounter()
+    results = []
+    try:
+        _setup(db, ingredient_count)
+        event.listen(engine, "before_cursor_execute", counter)
+        try:
+            for batches in batch_counts:
+                counter.count = 0
+                started = time.perf_counter()
+                plan = create_production_plan(db, schemas.ProductionPlanCreate(
+                    sku_id=SKU_ID, plant=PLANT, batch_size=500.0, num_batches=batches, created_by="benchmark",
+                ))
+                elapsed = time.perf_counter() - started
+                statements = counter.count
+                reqs = db.query(models.PreBatchReq).filter(models.PreBatchReq.plan_id == plan.plan_id).count()
+                print(f"{batches:>5} batches x {ingredient_count} ingredients: {elapsed:7.3f}s  "
+                      f"{statements:>4} statements  ({reqs} requirements)")
+                results.append({"batches": batches, "elapsed": elapsed, "statements": statements, "reqs": reqs})
+        finally:
+            event.remove(engine, "before_cursor_execute", counter)
+        return results
+    finally:
+        _cleanup(db)
+        db.close()
+
+
+def _cleanup(db):
+    plan_ids = [p.id for p in db.query(models.ProductionPlan.id).filter(models.ProductionPlan.sku_id == SKU_ID)]
+    if plan_ids:
+        db.query(models.PreBatchReq).filter(models.PreBatchReq.batch_db_id.in_(
+            db.query(models.ProductionBatch.id).filter(models.ProductionBatch.plan_id.in_(plan_ids))
+        )).delete(synchronize_session=False)
+        db.query(models.ProductionBatch).filter(models.ProductionBatch.plan_id.in_(plan_ids)).delete(synchronize_session=False)
+        db.query(models.ProductionPlanHistory).filter(
+            models.ProductionPlanHistory.plan_db_id.in_(plan_ids)).delete(synchronize_session=False)
+        db.query(models.ProductionPlan).filter(models.ProductionPlan.id.in_(plan_ids)).delete(synchronize_session=False)
+    db.query(models.SkuStep).filter(models.SkuStep.sku_id == SKU_ID).delete(synchronize_session=False)
+    db.query(models.Sku).filter(models.Sku.sku_id == SKU_ID).delete(synchronize_session=False)
+    db.query(models.Ingredient).filter(models.Ingredient.re_code.like("BENCH-RE-%")).delete(synchronize_session=False)
+    db.commit()
+
+
+if __name__ == "__main__":
+    args = [int(a) for a in sys.argv[1:]]
+    if args:
+        run_benchmark(args[0], args[1:] or (10, 50, 100, 200))
+    else:
+        run_benchmark()
@@ -33,6 +33,8 @@ def clear_db(host, label):
                 connection.execute(text(f"DELETE FROM {table};"))
                 connection.execute(text(f"ALTER TABLE {table} AUTO_INCREMENT = 1;"))
             connection.execute(text("SET FOREIGN_KEY_CHECKS = 1;"))
+            # Plan list clients reload instead of merging deltas (see plan_sync.py)
+            connection.execute(text("INSERT INTO sync_tombstones (table_name) VALUES ('*');"))
             connection.commit()
             print(f"✅ {label} cleared successfully.")
     except Exception as e:
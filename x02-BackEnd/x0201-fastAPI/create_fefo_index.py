@@ -0,0 +1,16 @@
+import models
+from database import engine
+
+
+def create_index():
+    index = next(i for i in models.IngredientIntakeList.__table__.indexes if i.name == "ix_intake_fefo")
+    print("Creating index 'ix_intake_fefo' on ingredient_intake_lists if not exists...")
+    try:
+        index.create(bind=engine, checkfirst=True)
+        print("Successfully checked/created index ix_intake_fefo.")
+    except Exception as e:
+        print(f"Error creating index: {e}")
+
+
+if __name__ == "__main__":
+    create_index()
@@ -0,0 +1,24 @@
+import models
+from database import engine
+
+SYNC_INDEXES = (
+    (models.ProductionPlan, "ix_plans_created_id"),
+    (models.ProductionPlan, "ix_plans_updated_at"),
+    (models.ProductionBatch, "ix_batches_updated_plan"),
+    (models.PreBatchReq, "ix_reqs_updated_plan"),
+)
+
+
+def create_indexes():
+    for model, name in SYNC_INDEXES:
+        index = next(i for i in model.__table__.indexes if i.name == name)
+        print(f"Creating index '{name}' on {model.__tablename__} if not exists...")
+        try:
+            index.create(bind=engine, checkfirst=True)
+            print(f"Successfully checked/created index {name}.")
+        except Exception as e:
+            print(f"Error creating index: {e}")
+
+
+if __name__ == "__main__":
+    create_indexes()
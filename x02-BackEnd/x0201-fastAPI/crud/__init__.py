@@ -5,3 +5,11 @@ from .crud_production import *
 from .crud_plant import *
 from .crud_prebatch import *
 from .crud_warehouse import *
+from .crud_genealogy import *
+from .crud_consumption import *
+from .crud_ledger import *
+from .crud_inventory import *
+from .crud_reconcile import *
+from .crud_allocation import *
+from .crud_sequence import *
+from .crud_box import *
@@ -0,0 +1,164 @@
+import logging
+import sys
+from collections import defaultdict
+from datetime import datetime
+from itertools import groupby
+from pathlib import Path
+
+# Ensure parent dir (x0201-fastAPI/) is on sys.path so models/schemas resolve
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from sqlalchemy import func, or_, select  # type: ignore[import-untyped]
+from sqlalchemy.orm import Session  # type: ignore[import-untyped]
+from typing import Dict, Iterable, List, Optional
+import lot_reservations  # type: ignore[import-untyped]
+import models  # type: ignore[import-untyped]
+
+logger = logging.getLogger(__name__)
+
+EPS = 1e-6
+ANY_WAREHOUSE = (None, "", "-", "All")
+
+
+# ---------------------------------------------------------------------------
+# Needs
+# ---------------------------------------------------------------------------
+
+def fefo_needs_for_batches(db: Session, batch_id: Optional[str] = None, plan_id: Optional[str] = None) -> List[dict]:
+    """Open requirements of a batch or plan as FEFO lines (required − already weighed).
+
+    "Already weighed" is the requirement's packaged_volume counter, so this is
+    one query on prebatch_reqs.
+    """
+    Req = models.PreBatchReq
+    q = (
+        db.query(Req.batch_id, Req.re_code, Req.wh, Req.required_volume, func.coalesce(Req.packaged_volume, 0))
+        .filter(Req.status != 2)
+    )
+    if batch_id:
+        q = q.filter(Req.batch_id == batch_id)
+    if plan_id:
+        q = q.filter(Req.plan_id == plan_id)
+
+    needs = []
+    for ref, re_code, wh, required, done in q.order_by(Req.batch_id, Req.re_code):
+        volume = round((required or 0) - (done or 0), 6)
+        if volume > EPS:
+            needs.append({"ref": ref, "re_code": re_code, "volume": volume, "warehouse": wh})
+    return needs
+
+
+# ---------------------------------------------------------------------------
+# Allocation
+# ---------------------------------------------------------------------------
+
+def _fefo_candidates(db: Session, re_codes: Iterable[str], now: datetime, include_expired: bool) -> Dict[str, list]:
+    """Active lots with stock per re_code, in FEFO order (no-expiry lots last)."""
+    Lot = models.IngredientIntakeList
+    q = select(
+        Lot.intake_lot_id, Lot.re_code, Lot.mat_sap_code, Lot.intake_to, Lot.expire_date, Lot.remain_vol,
+    ).where(Lot.re_code.in_(sorted(set(re_codes))), Lot.status == "Active", Lot.remain_vol > 0)
+    if not include_expired:
+        q = q.where(or_(Lot.expire_date.is_(None), Lot.expire_date >= now))
+    q = q.order_by(Lot.re_code, Lot.expire_date.is_(None), Lot.expire_date, Lot.intake_lot_id)
+
+    by_re_code: Dict[str, list] = defaultdict(list)
+    for lot in db.execute(q):
+        by_re_code[lot.re_code].append(lot)
+    return by_re_code
+
+
+def _split(lots: list, available: Dict[str, float], volume: float) -> List[tuple]:
+    """FEFO split of `volume` over `lots`; returns [(lot, take)] and draws down `available`.
+
+    Earlier expiry always goes first. Within one expiry date the fewest lots are
+    used: the smallest lot that covers what is left, otherwise the largest.
+    """
+    takes = []
+    remaining = volume
+    for _expiry, group in groupby(lots, key=lambda l: l.expire_date):
+        group = [l for l in group if available[l.intake_lot_id] > EPS]
+        while remaining > EPS and group:
+            cover = [l for l in group if available[l.intake_lot_id] >= remaining - EPS]
+            lot = (min(cover, key=lambda l: available[l.intake_lot_id]) if cover
+                   else max(group, key=lambda l: available[l.intake_lot_id]))
+            take = round(min(available[lot.intake_lot_id], remaining), 6)
+            available[lot.intake_lot_id] -= take
+            remaining -= take
+            takes.append((lot, take))
+            group.remove(lot)
+        if remaining <= EPS:
+            break
+    return takes
+
+
+def allocate_fefo(db: Session, needs: List[dict], include_expired: bool = False,
+                  now: Optional[datetime] = None, station: Optional[str] = None,
+                  reserve: bool = False, ttl_s: int = lot_reservations.DEFAULT_TTL_S) -> dict:
+    """Split each need {"re_code", "volume", "warehouse", "ref"} over lots, first-expiry-first-out.
+
+    Needs are served in order against one shared view of stock, so a plan's
+    batches never get the same volume twice. Lot volume held by other stations'
+    reservations is not offered; a preview also offers `station`'s own holds.
+
+    With `reserve`, every take is held for `station` (ref = the need's ref);
+    nothing is deducted either way. The station's existing holds for the same
+    refs are replaced, and its other holds count against it exactly as
+    lot_reservations.reserve() counts them, so an offered take can be held.
+    """
+    now = now or datetime.now()
+    candidates = _fefo_candidates(db, (n["re_code"] for n in needs), now, include_expired)
+    remain = {l.intake_lot_id: l.remain_vol or 0.0 for lots in candidates.values() for l in lots}
+    if reserve:
+        refs = {n.get("ref") for n in needs if n.get("ref")}
+        for r in lot_reservations.list_reservations(station=station):
+            if r["ref"] in refs:
+                lot_reservations.release(r["id"])
+    held = lot_reservations.reserved_volumes(remain, exclude_station=None if reserve else station)
+    available = {lot_id: vol - held.get(lot_id, 0.0) for lot_id, vol in remain.items()}
+
+    allocations = []
+    for need in needs:
+        warehouse = need.get("warehouse")
+        lots = candidates.get(need["re_code"], [])
+        if warehouse not in ANY_WAREHOUSE:
+            lots = [l for l in lots if l.intake_to == warehouse]
+        takes = _split(lots, available, need["volume"])
+        allocated = round(sum(t for _l, t in takes), 6)
+        reservations = [None] * len(takes)
+        if reserve:
+            try:
+                for n, (lot, take) in enumerate(takes):
+                    reservations[n] = lot_reservations.reserve(
+                        lot.intake_lot_id, take, station, remain[lot.intake_lot_id],
+                        ref=need.get("ref"), ttl_s=ttl_s,
+                    )["id"]
+            except ValueError:
+                # Lost a race with another station: drop this call's holds, the caller retries
+                for a in allocations:
+                    for l in a["lots"]:
+                        lot_reservations.release(l["reservation_id"])
+                for rid in reservations:
+                    if rid:
+                        lot_reservations.release(rid)
+                raise
+        allocations.append({
+            "ref": need.get("ref"),
+            "re_code": need["re_code"],
+            "warehouse": warehouse,
+            "volume": need["volume"],
+            "allocated": allocated,
+            "shortfall": round(max(need["volume"] - allocated, 0.0), 6),
+            "lots": [{
+                "intake_lot_id": lot.intake_lot_id,
+                "mat_sap_code": lot.mat_sap_code,
+                "expire_date": lot.expire_date,
+                "take_volume": take,
+                "remain_after": round(available[lot.intake_lot_id], 6),
+                "reservation_id": reservation_id,
+            } for (lot, take), reservation_id in zip(takes, reservations)],
+        })
+    return {
+        "complete": all(a["shortfall"] <= EPS for a in allocations),
+        "allocations": allocations,
+    }
@@ -0,0 +1,286 @@
+import logging
+import sys
+from collections import defaultdict
+from datetime import datetime
+from pathlib import Path
+
+# Ensure parent dir (x0201-fastAPI/) is on sys.path so models/schemas resolve
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from sqlalchemy import case, func, tuple_, update  # type: ignore[import-untyped]
+from sqlalchemy.exc import IntegrityError  # type: ignore[import-untyped]
+from sqlalchemy.orm import Session  # type: ignore[import-untyped]
+from typing import Dict, Iterable, List, Optional, Tuple
+import models  # type: ignore[import-untyped]
+import report_cache  # type: ignore[import-untyped]
+
+logger = logging.getLogger(__name__)
+
+# A box is one warehouse's share of a batch: the bags of the batch's
+# requirements with the same prebatch_reqs.wh. Its counters change in the same
+# transaction as the bags they count:
+#   - crud_prebatch create/delete  lock_boxes() after the batch and requirement
+#                                  locks, then add_bag() on the locked rows
+#   - packing-status / recheck-bag change_bag_status(): box lock, bag lock, a
+#                                  compare-and-set UPDATE of the bag, then
+#                                  shift_box() — one UPDATE … SET n = n + :delta
+# so release checks and packing summaries read a few box rows, never the bags.
+# Bags saved without a req_id belong to no box; get_unboxed_bag_totals()
+# counts them for the release check.
+
+BoxKey = Tuple[int, str]  # (batch_db_id, wh)
+
+
+def box_wh(wh: Optional[str]) -> str:
+    return wh or "-"
+
+
+def _status_counts(packing_status: Optional[int], recheck_status: Optional[int]) -> Dict[str, int]:
+    return {
+        "packed_count": int(packing_status == 1),
+        "recheck_ok": int(recheck_status == 1),
+        "recheck_error": int(recheck_status == 2),
+    }
+
+
+def _lock_box_rows(db: Session, keys: List[BoxKey]) -> Dict[BoxKey, models.PreBatchBox]:
+    Box = models.PreBatchBox
+    boxes = (
+        db.query(Box)
+        .filter(tuple_(Box.batch_db_id, Box.wh).in_(keys))
+        .order_by(Box.batch_db_id, Box.wh)
+        .with_for_update()
+        .populate_existing()
+        .all()
+    )
+    return {(b.batch_db_id, b.wh): b for b in boxes}
+
+
+def _lock_boxes(db: Session, specs: Dict[BoxKey, Tuple[str, Optional[str]]]) -> Dict[BoxKey, models.PreBatchBox]:
+    """Lock (creating where missing) the boxes keyed by (batch_db_id, wh); specs give (batch_id, plan_id)."""
+    keys = sorted(specs)
+    if not keys:
+        return {}
+    boxes = _lock_box_rows(db, keys)
+    missing = [k for k in keys if k not in boxes]
+    if missing:
+        for batch_db_id, wh in missing:
+            batch_id, plan_id = specs[(batch_db_id, wh)]
+            try:
+                with db.begin_nested():
+                    db.add(models.PreBatchBox(batch_db_id=batch_db_id, batch_id=batch_id, plan_id=plan_id, wh=wh,
+                                              expected_bags=0, bag_count=0, packed_count=0,
+                                              recheck_ok=0, recheck_error=0))
+            except IntegrityError:
+                pass  # Created by a concurrent transaction; lock that row instead
+        boxes.update(_lock_box_rows(db, missing))
+    return boxes
+
+
+def lock_boxes(db: Session, reqs: Iterable[models.PreBatchReq]) -> Dict[BoxKey, models.PreBatchBox]:
+    """Row-lock the boxes of the given (already locked) requirements, creating missing ones."""
+    return _lock_boxes(db, {(r.batch_db_id, box_wh(r.wh)): (r.batch_id, r.plan_id) for r in reqs})
+
+
+def box_of(boxes: Dict[BoxKey, models.PreBatchBox], req: models.PreBatchReq) -> Optional[models.PreBatchBox]:
+    return boxes.get((req.batch_db_id, box_wh(req.wh)))
+
+
+def add_bag(box: models.PreBatchBox, rec: models.PreBatchRec, sign: int = 1, expected: int = 0) -> None:
+    """Count a bag into (sign=1) or out of (sign=-1) a locked box.
+
+    `expected` is the requirement's total_packages when this bag is its first
+    (or, removing, its last) one.
+    """
+    box.bag_count = (box.bag_count or 0) + sign
+    box.expected_bags = (box.expected_bags or 0) + sign * expected
+    for column, n in _status_counts(rec.packing_status, rec.recheck_status).items():
+        setattr(box, column, (getattr(box, column) or 0) + sign * n)
+
+
+def shift_box(
+    db: Session,
+    batch_db_id: Optional[int],
+    wh: Optional[str],
+    before: Tuple[Optional[int], Optional[int]],
+    after: Tuple[Optional[int], Optional[int]],
+) -> None:
+    """Move a bag's (packing_status, recheck_status) from `before` to `after` in its box's counters."""
+    if batch_db_id is None:
+        return
+    old, new = _status_counts(*before), _status_counts(*after)
+    Box = models.PreBatchBox
+    values = {getattr(Box, c): getattr(Box, c) + (new[c] - old[c]) for c in new if new[c] != old[c]}
+    if values:
+        db.execute(
+            update(Box)
+            .where(Box.batch_db_id == batch_db_id, Box.wh == box_wh(wh))
+            .values(values)
+            .execution_options(synchronize_session=False)
+        )
+
+
+def _is(column, value):
+    return column.is_(None) if value is None else column == value
+
+
+def change_bag_status(db: Session, bag_id: int, batch_db_id: Optional[int], wh: Optional[str],
+                      **values) -> Optional[models.PreBatchRec]:
+    """Write a bag's packing/recheck columns and move its box's counters to match.
+
+    Locks the box, then the bag (the order create and delete take them in),
+    and updates the bag only if its statuses are still the ones just read, so
+    two concurrent scans of one bag count it once. `values` holds any of
+    packing_status, recheck_status and their *_at / *_by columns. Returns the
+    updated bag, None when it does not exist; raises ValueError if the bag
+    changed under the lock (it cannot, short of a write bypassing it).
+    """
+    if batch_db_id is not None:
+        _lock_box_rows(db, [(batch_db_id, box_wh(wh))])
+    Rec = models.PreBatchRec
+    bag = db.query(Rec).filter(Rec.id == bag_id).with_for_update().populate_existing().first()
+    if bag is None:
+        return None
+    before = (bag.packing_status, bag.recheck_status)
+    after = (values.get("packing_status", before[0]), values.get("recheck_status", before[1]))
+    result = db.execute(
+        update(Rec)
+        .where(Rec.id == bag_id, _is(Rec.packing_status, before[0]), _is(Rec.recheck_status, before[1]))
+        .values(**values)
+        .execution_options(synchronize_session="evaluate")
+    )
+    if result.rowcount != 1:
+        raise ValueError(f"Bag {bag.batch_record_id} changed concurrently, scan it again")
+    # The Core UPDATE skips the ORM flush hook that invalidates cached reports
+    report_cache.touch(db, report_cache.plan_scope(bag.plan_id) if bag.plan_id else report_cache.ALL)
+    shift_box(db, batch_db_id, wh, before, after)
+    return bag
+
+
+def close_box(db: Session, batch: models.ProductionBatch, wh: str, closed_by: Optional[str] = None,
+              closed_at: Optional[datetime] = None) -> models.PreBatchBox:
+    """Stamp a batch's warehouse box as closed (created if no bag was counted into it yet)."""
+    key = (batch.id, box_wh(wh))
+    box = _lock_boxes(db, {key: (batch.batch_id, batch.plan.plan_id if batch.plan else None)})[key]
+    box.closed_at = closed_at or datetime.now()
+    box.closed_by = closed_by
+    return box
+
+
+# ---------------------------------------------------------------------------
+# Reads
+# ---------------------------------------------------------------------------
+
+def get_boxes(db: Session, batch_ids: Optional[Iterable[str]] = None,
+              plan_id: Optional[str] = None) -> List[models.PreBatchBox]:
+    Box = models.PreBatchBox
+    query = db.query(Box)
+    if batch_ids is not None:
+        query = query.filter(Box.batch_id.in_(list(batch_ids)))
+    if plan_id is not None:
+        query = query.filter(Box.plan_id == plan_id)
+    return query.order_by(Box.batch_id, Box.wh).all()
+
+
+def get_batch_box_totals(db: Session, batch_id: str) -> Dict[str, int]:
+    """Counters of all of a batch's boxes added up."""
+    Box = models.PreBatchBox
+    columns = ("expected_bags", "bag_count", "packed_count", "recheck_ok", "recheck_error")
+    row = db.query(*(func.coalesce(func.sum(getattr(Box, c)), 0) for c in columns)).filter(
+        Box.batch_id == batch_id
+    ).one()
+    return {c: int(v) for c, v in zip(columns, row)}
+
+
+def get_unboxed_bag_totals(db: Session, batch_id: str) -> Dict[str, int]:
+    """bag_count / recheck_ok of a batch's bags saved without a req_id (in no box)."""
+    Rec = models.PreBatchRec
+    bags, ok = db.query(
+        func.count(Rec.id), func.coalesce(func.sum(case((Rec.recheck_status == 1, 1), else_=0)), 0),
+    ).filter(Rec.batch_id == batch_id, Rec.req_id.is_(None)).one()
+    return {"bag_count": int(bags), "recheck_ok": int(ok)}
+
+
+def box_summary(box: models.PreBatchBox) -> dict:
+    return {
+        "batch_id": box.batch_id,
+        "plan_id": box.plan_id,
+        "wh": box.wh,
+        "expected_bags": box.expected_bags or 0,
+        "bag_count": box.bag_count or 0,
+        "packed_count": box.packed_count or 0,
+        "recheck_ok": box.recheck_ok or 0,
+        "recheck_error": box.recheck_error or 0,
+        "closed_at": box.closed_at.isoformat() if box.closed_at else None,
+        "closed_by": box.closed_by,
+    }
+
+
+# ---------------------------------------------------------------------------
+# Rebuild
+# ---------------------------------------------------------------------------
+
+def rebuild_boxes(db: Session) -> int:
+    """Recount every box from the bags, creating missing ones. Returns boxes written.
+
+    FH/SPP boxes of batches closed before this table existed take closed_at
+    from production_batches.fh_boxed_at / spp_boxed_at.
+    """
+    Req = models.PreBatchReq
+    Rec = models.PreBatchRec
+    per_req = (
+        db.query(
+            Req.batch_db_id, Req.batch_id, Req.plan_id, Req.wh,
+            func.max(func.coalesce(Rec.total_packages, 1)),
+            func.count(Rec.id),
+            func.sum(case((Rec.packing_status == 1, 1), else_=0)),
+            func.sum(case((Rec.recheck_status == 1, 1), else_=0)),
+            func.sum(case((Rec.recheck_status == 2, 1), else_=0)),
+        )
+        .join(Rec, Rec.req_id == Req.id)
+        .group_by(Req.id, Req.batch_db_id, Req.batch_id, Req.plan_id, Req.wh)
+        .all()
+    )
+    counts: Dict[BoxKey, dict] = defaultdict(lambda: dict.fromkeys(
+        ("expected_bags", "bag_count", "packed_count", "recheck_ok", "recheck_error"), 0))
+    specs: Dict[BoxKey, Tuple[str, Optional[str]]] = {}
+    for batch_db_id, batch_id, plan_id, wh, expected, bags, packed, ok, error in per_req:
+        key = (batch_db_id, box_wh(wh))
+        specs[key] = (batch_id, plan_id)
+        c = counts[key]
+        c["expected_bags"] += int(expected or 0)
+        c["bag_count"] += int(bags or 0)
+        c["packed_count"] += int(packed or 0)
+        c["recheck_ok"] += int(ok or 0)
+        c["recheck_error"] += int(error or 0)
+
+    B = models.ProductionBatch
+    closed: Dict[BoxKey, datetime] = {}
+    for batch_db_id, batch_id, plan_id, fh_boxed_at, spp_boxed_at in (
+        db.query(B.id, B.batch_id, models.ProductionPlan.plan_id, B.fh_boxed_at, B.spp_boxed_at)
+        .outerjoin(models.ProductionPlan, models.ProductionPlan.id == B.plan_id)
+        .filter(B.fh_boxed_at.isnot(None) | B.spp_boxed_at.isnot(None))
+    ):
+        for wh, boxed_at in (("FH", fh_boxed_at), ("SPP", spp_boxed_at)):
+            if boxed_at is not None:
+                closed[(batch_db_id, wh)] = boxed_at
+                specs.setdefault((batch_db_id, wh), (batch_id, plan_id))
+
+    existing = {(b.batch_db_id, b.wh): b for b in db.query(models.PreBatchBox)}
+    for key, box in existing.items():
+        if key not in specs:
+            for column in ("expected_bags", "bag_count", "packed_count", "recheck_ok", "recheck_error"):
+                setattr(box, column, 0)
+    for key, (batch_id, plan_id) in specs.items():
+        box = existing.get(key)
+        if box is None:
+            box = models.PreBatchBox(batch_db_id=key[0], batch_id=batch_id, plan_id=plan_id, wh=key[1])
+            db.add(box)
+        for column, value in counts[key].items():
+            setattr(box, column, value)
+        if box.closed_at is None and key in closed:
+            box.closed_at = closed[key]
+    db.commit()
+    written = len(set(existing) | set(specs))
+    logger.info("Rebuilt %d pre-batch boxes", written)
+    return written
@@ -0,0 +1,140 @@
+import logging
+import sys
+from collections import defaultdict
+from datetime import date, datetime
+from pathlib import Path
+
+# Ensure parent dir (x0201-fastAPI/) is on sys.path so models/schemas resolve
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from sqlalchemy import case, func, update  # type: ignore[import-untyped]
+from sqlalchemy.exc import IntegrityError  # type: ignore[import-untyped]
+from sqlalchemy.orm import Session  # type: ignore[import-untyped]
+from typing import Iterable, List, Optional
+import models  # type: ignore[import-untyped]
+from .crud_genealogy import LotDraw
+
+logger = logging.getLogger(__name__)
+
+
+def _rec_plant(rec: models.PreBatchRec) -> str:
+    if rec.req is not None and rec.req.batch is not None:
+        return rec.req.batch.plant or ""
+    return ""
+
+
+def _bump(db: Session, day: date, plant: str, mat_sap_code: str, re_code: str, volume: float, count: int) -> None:
+    """Atomically add (volume, count) to one rollup row, inserting it on first use.
+
+    A removal (count < 0) never inserts a row and never takes one below zero:
+    bags recorded before the rollup existed were never counted in it.
+    """
+    D = models.DailyIngredientConsumption
+    key = (
+        D.consumption_date == day, D.plant == plant,
+        D.mat_sap_code == mat_sap_code, D.re_code == re_code,
+    )
+    values = {"total_volume": D.total_volume + volume, "txn_count": D.txn_count + count}
+    if count < 0:
+        values = {col: case((v < 0, 0), else_=v) for col, v in values.items()}
+    res = db.execute(update(D).where(*key).values(**values))
+    if res.rowcount or count < 0:
+        return
+    try:
+        with db.begin_nested():
+            db.add(D(consumption_date=day, plant=plant, mat_sap_code=mat_sap_code, re_code=re_code,
+                     total_volume=volume, txn_count=count))
+    except IntegrityError:
+        # Another station inserted the row first — fall back to the atomic increment
+        db.execute(update(D).where(*key).values(**values))
+
+
+# ---------------------------------------------------------------------------
+# Maintenance (called inside the prebatch rec transaction, no commit)
+# ---------------------------------------------------------------------------
+
+def apply_rec_consumption(db: Session, rec: models.PreBatchRec, draws: Iterable[LotDraw],
+                          sign: int = 1, day: Optional[date] = None) -> None:
+    """Add (sign=1) or remove (sign=-1) the lots drawn by `rec` from the daily rollup.
+
+    The day is the bag's own created_at (as rebuild_daily_consumption counts
+    it), so a delete always reverses the day the bag was added to.
+    """
+    day = day or (rec.created_at.date() if rec.created_at else datetime.now().date())
+    plant = _rec_plant(rec)
+    per_mat: dict = defaultdict(lambda: [0.0, 0])
+    for _lot, mat_sap_code, take_volume in draws:
+        agg = per_mat[mat_sap_code or rec.mat_sap_code or ""]
+        agg[0] += take_volume or 0
+        agg[1] += 1
+    for mat_sap_code, (volume, count) in per_mat.items():
+        _bump(db, day, plant, mat_sap_code, rec.re_code or "", sign * volume, sign * count)
+
+
+def rebuild_daily_consumption(db: Session, date_from: Optional[date] = None, date_to: Optional[date] = None) -> int:
+    """Recompute the rollup from batch_genealogy for [date_from, date_to] (inclusive). Returns row count."""
+    D = models.DailyIngredientConsumption
+    G = models.BatchGenealogy
+    B = models.ProductionBatch
+
+    wipe = db.query(D)
+    if date_from:
+        wipe = wipe.filter(D.consumption_date >= date_from)
+    if date_to:
+        wipe = wipe.filter(D.consumption_date <= date_to)
+    wipe.delete(synchronize_session=False)
+
+    day_col = func.date(G.created_at)
+    q = db.query(
+        day_col.label("day"),
+        func.coalesce(B.plant, "").label("plant"),
+        func.coalesce(G.mat_sap_code, "").label("mat_sap_code"),
+        func.coalesce(G.re_code, "").label("re_code"),
+        func.sum(G.take_volume).label("total_volume"),
+        func.count(G.id).label("txn_count"),
+    ).outerjoin(B, B.batch_id == G.batch_id)
+    if date_from:
+        q = q.filter(G.created_at >= datetime.combine(date_from, datetime.min.time()))
+    if date_to:
+        q = q.filter(day_col <= date_to.isoformat())
+    rows = q.group_by(day_col, B.plant, G.mat_sap_code, G.re_code).all()
+
+    # Merge rows that collapse onto the same key after coalescing NULLs
+    merged: dict = defaultdict(lambda: [0.0, 0])
+    for r in rows:
+        day = r.day if isinstance(r.day, date) else date.fromisoformat(str(r.day))
+        agg = merged[(day, r.plant, r.mat_sap_code, r.re_code)]
+        agg[0] += r.total_volume or 0
+        agg[1] += r.txn_count or 0
+
+    db.bulk_insert_mappings(D, [{
+        "consumption_date": k[0], "plant": k[1], "mat_sap_code": k[2], "re_code": k[3],
+        "total_volume": v[0], "txn_count": v[1],
+    } for k, v in merged.items()])
+    db.commit()
+    logger.info("Rebuilt daily_ingredient_consumption: %d rows", len(merged))
+    return len(merged)
+
+
+# ---------------------------------------------------------------------------
+# Reads
+# ---------------------------------------------------------------------------
+
+def get_consumption(db: Session, date_from: date, date_to: date, plant: Optional[str] = None,
+                    by_day: bool = False) -> List:
+    """Consumption per ingredient over [date_from, date_to], optionally split per day."""
+    D = models.DailyIngredientConsumption
+    cols = [D.mat_sap_code, D.re_code]
+    if by_day:
+        cols.insert(0, D.consumption_date)
+    q = db.query(
+        *cols,
+        func.sum(D.total_volume).label("total_volume"),
+        func.sum(D.txn_count).label("txn_count"),
+    ).filter(
+        D.consumption_date >= date_from,
+        D.consumption_date <= date_to,
+    )
+    if plant:
+        q = q.filter(D.plant == plant)
+    return q.group_by(*cols).having(func.sum(D.txn_count) > 0).order_by(*cols).all()
@@ -0,0 +1,176 @@
+import logging
+import sys
+from pathlib import Path
+
+# Ensure parent dir (x0201-fastAPI/) is on sys.path so models/schemas resolve
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from sqlalchemy import func, select  # type: ignore[import-untyped]
+from sqlalchemy.orm import Session  # type: ignore[import-untyped]
+from typing import Iterable, List, Optional, Tuple
+import barcodes  # type: ignore[import-untyped]
+import models  # type: ignore[import-untyped]
+
+logger = logging.getLogger(__name__)
+
+# (intake_lot_id, mat_sap_code, take_volume)
+LotDraw = Tuple[str, Optional[str], float]
+
+
+def _rec_batch_id(rec: models.PreBatchRec) -> Optional[str]:
+    """Resolve the batch a bag belongs to: stored batch_id, then req, then the parsed barcode."""
+    if rec.batch_id:
+        return rec.batch_id
+    if rec.req is not None:
+        return rec.req.batch_id
+    parsed = barcodes.parse_bag_barcode(rec.batch_record_id, rec.re_code, rec.plan_id)
+    return parsed.batch_id if parsed else None
+
+
+# ---------------------------------------------------------------------------
+# Maintenance (called inside the prebatch rec transaction, no commit)
+# ---------------------------------------------------------------------------
+
+def add_rec_genealogy(db: Session, rec: models.PreBatchRec, draws: Iterable[LotDraw]) -> None:
+    """Insert one genealogy edge per lot drawn by `rec`."""
+    batch_id = _rec_batch_id(rec)
+    wh = rec.req.wh if rec.req is not None else None
+    for intake_lot_id, mat_sap_code, take_volume in draws:
+        db.add(models.BatchGenealogy(
+            intake_lot_id=intake_lot_id,
+            prebatch_rec_id=rec.id,
+            batch_record_id=rec.batch_record_id,
+            batch_id=batch_id,
+            plan_id=rec.plan_id,
+            re_code=rec.re_code,
+            mat_sap_code=mat_sap_code or rec.mat_sap_code,
+            wh=wh,
+            take_volume=take_volume or 0,
+        ))
+
+
+def remove_rec_genealogy(db: Session, rec_id: int) -> None:
+    """Drop all genealogy edges of a prebatch rec."""
+    db.query(models.BatchGenealogy).filter(
+        models.BatchGenealogy.prebatch_rec_id == rec_id
+    ).delete(synchronize_session=False)
+
+
+def rebuild_genealogy(db: Session, chunk_size: int = 5000) -> int:
+    """Rebuild batch_genealogy from prebatch_recs / prebatch_rec_from. Returns edge count."""
+    G = models.BatchGenealogy
+    Rec = models.PreBatchRec
+    RecFrom = models.PreBatchRecFrom
+    Req = models.PreBatchReq
+
+    db.query(G).delete(synchronize_session=False)
+
+    # Multi-lot bags: one edge per origin row
+    from_stmt = (
+        select(
+            RecFrom.intake_lot_id.label("lot"), RecFrom.mat_sap_code.label("lot_mat"),
+            RecFrom.take_volume.label("vol"), RecFrom.created_at.label("ts"),
+            Rec.id, Rec.batch_record_id, Rec.plan_id, Rec.re_code, Rec.mat_sap_code.label("rec_mat"),
+            func.coalesce(Rec.batch_id, Req.batch_id).label("batch_id"), Req.wh,
+        )
+        .join(Rec, Rec.id == RecFrom.prebatch_rec_id)
+        .outerjoin(Req, Req.id == Rec.req_id)
+    )
+    # Single-lot bags: recs carrying intake_lot_id with no origin rows
+    single_stmt = (
+        select(
+            Rec.intake_lot_id.label("lot"), Rec.mat_sap_code.label("lot_mat"),
+            Rec.net_volume.label("vol"), Rec.created_at.label("ts"),
+            Rec.id, Rec.batch_record_id, Rec.plan_id, Rec.re_code, Rec.mat_sap_code.label("rec_mat"),
+            func.coalesce(Rec.batch_id, Req.batch_id).label("batch_id"), Req.wh,
+        )
+        .outerjoin(Req, Req.id == Rec.req_id)
+        .where(
+            Rec.intake_lot_id.isnot(None),
+            ~select(RecFrom.id).where(RecFrom.prebatch_rec_id == Rec.id).exists(),
+        )
+    )
+
+    total = 0
+    buf: List[dict] = []
+    for stmt in (from_stmt, single_stmt):
+        for r in db.execute(stmt):
+            batch_id = r.batch_id
+            if not batch_id:
+                parsed = barcodes.parse_bag_barcode(r.batch_record_id, r.re_code, r.plan_id)
+                batch_id = parsed.batch_id if parsed else None
+            buf.append({
+                "intake_lot_id": r.lot,
+                "prebatch_rec_id": r.id,
+                "batch_record_id": r.batch_record_id,
+                "batch_id": batch_id,
+                "plan_id": r.plan_id,
+                "re_code": r.re_code,
+                "mat_sap_code": r.lot_mat or r.rec_mat,
+                "wh": r.wh,
+                "take_volume": r.vol or 0,
+                "created_at": r.ts,
+            })
+            if len(buf) >= chunk_size:
+                db.bulk_insert_mappings(G, buf)
+                total += len(buf)
+                buf = []
+    if buf:
+        db.bulk_insert_mappings(G, buf)
+        total += len(buf)
+
+    db.commit()
+    logger.info("Rebuilt batch_genealogy: %d edges", total)
+    return total
+
+
+# ---------------------------------------------------------------------------
+# Traces (one indexed query each)
+# ---------------------------------------------------------------------------
+
+def trace_forward(db: Session, intake_lot_id: str) -> list:
+    """Lot → every bag/batch/plan/box it went into, with delivery state."""
+    G = models.BatchGenealogy
+    B = models.ProductionBatch
+    return db.query(
+        G.batch_record_id, G.batch_id, G.plan_id, G.re_code, G.wh, G.take_volume, G.created_at,
+        B.status.label("batch_status"),
+        B.fh_boxed_at, B.spp_boxed_at, B.fh_delivered_at, B.spp_delivered_at,
+    ).outerjoin(B, B.batch_id == G.batch_id).filter(
+        G.intake_lot_id == intake_lot_id
+    ).order_by(G.created_at).all()
+
+
+def trace_backward(db: Session, batch_id: str) -> list:
+    """Batch → every requirement with the lots actually drawn for it (one row per req × lot)."""
+    G = models.BatchGenealogy
+    Req = models.PreBatchReq
+    Lot = models.IngredientIntakeList
+    return db.query(
+        Req.re_code, Req.ingredient_name, Req.required_volume,
+        G.intake_lot_id, G.mat_sap_code, G.take_volume, G.batch_record_id, G.wh,
+        Lot.lot_id, Lot.intake_from, Lot.expire_date,
+    ).outerjoin(
+        G, (G.batch_id == Req.batch_id) & (G.re_code == Req.re_code)
+    ).outerjoin(
+        Lot, Lot.intake_lot_id == G.intake_lot_id
+    ).filter(
+        Req.batch_id == batch_id
+    ).order_by(Req.re_code, G.batch_record_id).all()
+
+
+def trace_recall(db: Session, intake_lot_id: str) -> list:
+    """Multi-hop recall: lot → batches it reached → every lot drawn into those batches."""
+    G = models.BatchGenealogy
+    Lot = models.IngredientIntakeList
+    hit_batches = select(G.batch_id).where(
+        G.intake_lot_id == intake_lot_id, G.batch_id.isnot(None)
+    ).distinct()
+    return db.query(
+        G.batch_id, G.plan_id, G.intake_lot_id, G.re_code, G.mat_sap_code, G.take_volume,
+        Lot.lot_id, Lot.intake_from, Lot.material_description,
+    ).outerjoin(
+        Lot, Lot.intake_lot_id == G.intake_lot_id
+    ).filter(
+        G.batch_id.in_(hit_batches)
+    ).order_by(G.batch_id, G.intake_lot_id).all()
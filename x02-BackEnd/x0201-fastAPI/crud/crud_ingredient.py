@@ -4,6 +4,9 @@ from typing import Optional, List
 from datetime import date
 import models
 import schemas
+from .crud_inventory import lock_lot, move_stock, run_in_transaction
+from .crud_ledger import record_movement
+from .crud_sequence import allocate_ids, peek_next_id
 
 # Ingredient CRUD
 def get_ingredient_by_id(db: Session, ingredient_db_id: int) -> Optional[models.Ingredient]:
@@ -194,7 +197,11 @@ def create_ingredient_intake_list(db: Session, list_data: schemas.IngredientInta
     """Create new ingredient intake list with error handling and individual package generation"""
     try:
         db_list = models.IngredientIntakeList(**list_data.dict())
+        if not db_list.intake_lot_id:
+            # Auto ID: reserved in this transaction, so a failed create does not use it up
+            db_list.intake_lot_id = _allocate_intake_ids(db, 1)[0]
         db.add(db_list)
+        record_movement(db, db_list, "intake", 0.0, reason="Intake", moved_by=db_list.intake_by)
         db.commit()
         db.refresh(db_list)
 
@@ -242,18 +249,28 @@ def create_ingredient_intake_list(db: Session, list_data: schemas.IngredientInta
 def update_ingredient_intake_list(db: Session, list_id: str, list_update: schemas.IngredientIntakeListCreate) -> Optional[models.IngredientIntakeList]:
     """Update ingredient intake list"""
     try:
-        db_list = db.query(models.IngredientIntakeList).filter(models.IngredientIntakeList.intake_lot_id == list_id).first()
+        update_data = list_update.dict(exclude_unset=True)
+        if update_data.get('intake_lot_id') is None:
+            update_data.pop('intake_lot_id', None)  # optional on create only; never clear the key
+        new_remain_vol = update_data.pop('remain_vol', None)
+        # Check for significant changes to log
+        new_status = update_data.get('status')
+
+        def apply_edit():
+            db_list = lock_lot(db, list_id)
+            if db_list:
+                old_status = db_list.status
+                for key, value in update_data.items():
+                    setattr(db_list, key, value)
+                if new_remain_vol is not None:
+                    # Locked, so the ledger's prev_vol is the stock actually being replaced
+                    move_stock(db, db_list, new_remain_vol - (db_list.remain_vol or 0.0), "intake_edit",
+                               reason="Intake edit", moved_by=db_list.edit_by or "system")
+                return db_list, old_status
+            return None, None
+
+        db_list, old_status = run_in_transaction(db, apply_edit)
         if db_list:
-            old_status = db_list.status
-            update_data = list_update.dict(exclude_unset=True)
-            
-            # Check for significant changes to log
-            new_status = update_data.get('status')
-            
-            for key, value in update_data.items():
-                setattr(db_list, key, value)
-            
-            db.commit()
             db.refresh(db_list)
 
             # Log history if status changed or just a general update
@@ -277,39 +294,62 @@ def update_ingredient_intake_list(db: Session, list_id: str, list_update: schema
 def delete_ingredient_intake_list(db: Session, list_id: str) -> Optional[models.IngredientIntakeList]:
     """Delete ingredient intake list with error handling"""
     try:
-        db_list = db.query(models.IngredientIntakeList).filter(models.IngredientIntakeList.intake_lot_id == list_id).first()
-        if db_list:
-            db.delete(db_list)
-            db.commit()
-        return db_list
+        def apply_delete():
+            db_list = lock_lot(db, list_id)
+            if db_list:
+                record_movement(db, db_list, "intake_delete", db_list.remain_vol, reason="Intake deleted", new_vol=0.0)
+                db.delete(db_list)
+            return db_list
+
+        return run_in_transaction(db, apply_delete)
     except SQLAlchemyError as e:
         db.rollback()
         raise RuntimeError(f"Database error: {str(e)}")
 
-def get_next_intake_id(db: Session) -> str:
-    """Generate next intake ID: intake-yyyy-mm-dd-nnn"""
-    today_str = date.today().strftime("%Y-%m-%d")
-    pattern = f"intake-{today_str}-%"
-    
-    # Count existing for today or find max
-    # We use len() of query to simple count since we renamed table
-    # Optimally we would parse the max number, but count+1 is usually fine if no deletes
-    # To be robust against deletes, let's try to find max
-    
-    # This query might be slow if huge data, but fine for now.
-    last_record = db.query(models.IngredientIntakeList)\
-        .filter(models.IngredientIntakeList.intake_lot_id.like(pattern))\
+def _max_intake_number(db: Session, today_str: str) -> int:
+    """Highest nnn of today's intake-yyyy-mm-dd-nnn ids made before the intake sequence existed."""
+    last_record = db.query(models.IngredientIntakeList.intake_lot_id)\
+        .filter(models.IngredientIntakeList.intake_lot_id.like(f"intake-{today_str}-%"))\
         .order_by(models.IngredientIntakeList.intake_lot_id.desc())\
         .first()
-        
     if last_record:
         try:
             # Extract last 3 digits
-            last_num = int(last_record.intake_lot_id.split('-')[-1])
-            new_num = last_num + 1
-        except:
-            new_num = 1
-    else:
-        new_num = 1
-        
-    return f"intake-{today_str}-{new_num:03d}"
+            return int(last_record.intake_lot_id.split('-')[-1])
+        except ValueError:
+            return 0
+    return 0
+
+def _allocate_intake_ids(db: Session, count: int) -> List[str]:
+    """Reserve `count` intake IDs (intake-yyyy-mm-dd-nnn) in the caller's transaction."""
+    today = date.today()
+    today_str = today.strftime("%Y-%m-%d")
+    numbers = allocate_ids(db, "intake", count, day=today, seed=lambda: _max_intake_number(db, today_str))
+    return [f"intake-{today_str}-{n:03d}" for n in numbers]
+
+def allocate_intake_ids(db: Session, count: int) -> List[str]:
+    """Reserve `count` intake IDs in one sequence allocation and commit it.
+
+    Committed IDs are never handed out again, even if the caller never uses them.
+    """
+    try:
+        ids = _allocate_intake_ids(db, count)
+        db.commit()
+    except SQLAlchemyError as e:
+        db.rollback()
+        raise RuntimeError(f"Database error: {str(e)}")
+    return ids
+
+def peek_next_intake_id(db: Session) -> str:
+    """The intake ID the next create would get. Nothing is reserved: a concurrent create may take it first."""
+    today = date.today()
+    today_str = today.strftime("%Y-%m-%d")
+    try:
+        number = peek_next_id(db, "intake", day=today, seed=lambda: _max_intake_number(db, today_str))
+    except SQLAlchemyError as e:
+        raise RuntimeError(f"Database error: {str(e)}")
+    return f"intake-{today_str}-{number:03d}"
+
+def get_next_intake_id(db: Session) -> str:
+    """Reserve the next intake ID: intake-yyyy-mm-dd-nnn. It is never handed out twice."""
+    return allocate_intake_ids(db, 1)[0]
@@ -0,0 +1,126 @@
+import logging
+import random
+import sys
+import time
+from pathlib import Path
+
+# Ensure parent dir (x0201-fastAPI/) is on sys.path so models/schemas resolve
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from sqlalchemy.exc import DBAPIError  # type: ignore[import-untyped]
+from sqlalchemy.orm import Session  # type: ignore[import-untyped]
+from typing import Callable, Dict, Iterable, Optional, Sequence, Tuple, TypeVar
+import models  # type: ignore[import-untyped]
+from .crud_ledger import record_movement
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Every write to ingredient_intake_lists.remain_vol goes through this module:
+#   1. lock_lots()     SELECT … FOR UPDATE, always in intake_lot_id order so two
+#                      stations drawing from the same lots cannot deadlock each other
+#   2. move_stock()    UPDATE … SET remain_vol = remain_vol + :delta (never a
+#                      Python-side read-modify-write) plus the ledger row
+#   3. run_in_transaction()  commits, and replays the whole unit of work when
+#                      the server picks it as a deadlock victim
+
+MAX_ATTEMPTS = 5
+RETRY_BACKOFF_S = 0.02
+# MySQL/MariaDB: 1213 deadlock, 1205 lock wait timeout. SQLite (tests, local
+# database.db) reports a busy writer as "database is locked".
+RETRYABLE_ERROR_CODES = {1205, 1213}
+
+
+def _is_retryable(e: DBAPIError) -> bool:
+    orig = e.orig
+    if orig is None:
+        return False
+    code = orig.args[0] if orig.args else None
+    return code in RETRYABLE_ERROR_CODES or "database is locked" in str(orig)
+
+
+def run_in_transaction(db: Session, work: Callable[[], T], attempts: int = MAX_ATTEMPTS) -> T:
+    """Run `work()` and commit; on deadlock/lock timeout roll back and run it again.
+
+    `work` must redo all of its reads and writes on every call (the rollback
+    discards them). Any other exception rolls back and propagates.
+    """
+    for attempt in range(1, attempts + 1):
+        try:
+            result = work()
+            db.commit()
+            return result
+        except DBAPIError as e:
+            db.rollback()
+            if attempt == attempts or not _is_retryable(e):
+                raise
+            logger.warning("Inventory transaction retry %d/%d: %s", attempt, attempts - 1, e.orig)
+            time.sleep(RETRY_BACKOFF_S * attempt * (1 + random.random()))
+        except Exception:
+            db.rollback()
+            raise
+    raise AssertionError("unreachable")
+
+
+def lock_lots(db: Session, lot_ids: Iterable[str]) -> Dict[str, models.IngredientIntakeList]:
+    """Row-lock the given lots (sorted by id) and return them freshly loaded, keyed by intake_lot_id."""
+    ids = sorted({i for i in lot_ids if i})
+    if not ids:
+        return {}
+    Lot = models.IngredientIntakeList
+    lots = (
+        db.query(Lot)
+        .filter(Lot.intake_lot_id.in_(ids))
+        .order_by(Lot.intake_lot_id)
+        .with_for_update()
+        .populate_existing()
+        .all()
+    )
+    return {lot.intake_lot_id: lot for lot in lots}
+
+
+def lock_lot(db: Session, intake_lot_id: str) -> Optional[models.IngredientIntakeList]:
+    return lock_lots(db, [intake_lot_id]).get(intake_lot_id)
+
+
+def move_stock(
+    db: Session,
+    lot: models.IngredientIntakeList,
+    delta: float,
+    movement_type: str,
+    reason: str = "",
+    moved_by: Optional[str] = None,
+    reference: Optional[str] = None,
+    remark: Optional[str] = None,
+) -> float:
+    """Add `delta` to a locked lot's remain_vol and log it to the ledger. Returns the new volume."""
+    prev_vol = lot.remain_vol or 0.0
+    new_vol = prev_vol + delta
+    # Assigning a SQL expression makes the flush emit remain_vol = remain_vol + :delta;
+    # the attribute is expired afterwards and reloads from the row.
+    lot.remain_vol = models.IngredientIntakeList.remain_vol + delta
+    record_movement(db, lot, movement_type, prev_vol, reason=reason, moved_by=moved_by,
+                    reference=reference, remark=remark, new_vol=new_vol)
+    return new_vol
+
+
+def move_stock_grouped(
+    db: Session,
+    lot: models.IngredientIntakeList,
+    moves: Sequence[Tuple[float, Optional[str]]],
+    movement_type: str,
+    reason: str = "",
+    moved_by: Optional[str] = None,
+) -> float:
+    """Apply several (delta, reference) moves to a locked lot with one UPDATE.
+
+    The ledger still gets one row per move, with running prev/new volumes.
+    """
+    vol = lot.remain_vol or 0.0
+    for delta, reference in moves:
+        record_movement(db, lot, movement_type, vol, reason=reason, moved_by=moved_by,
+                        reference=reference, new_vol=vol + delta)
+        vol += delta
+    lot.remain_vol = models.IngredientIntakeList.remain_vol + sum(delta for delta, _ref in moves)
+    return vol
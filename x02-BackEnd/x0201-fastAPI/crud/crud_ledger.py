@@ -0,0 +1,252 @@
+import logging
+import sys
+from datetime import date, datetime, time, timedelta
+from pathlib import Path
+
+# Ensure parent dir (x0201-fastAPI/) is on sys.path so models/schemas resolve
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from sqlalchemy import and_, case, func, or_, select  # type: ignore[import-untyped]
+from sqlalchemy.orm import Session  # type: ignore[import-untyped]
+from typing import Dict, Iterable, List, Optional, Tuple
+import models  # type: ignore[import-untyped]
+
+logger = logging.getLogger(__name__)
+
+# (ts, id) of the last row of the previous page
+LedgerCursor = Tuple[datetime, int]
+
+
+def _signed_qty():
+    L = models.StockLedger
+    return case((L.direction == "increase", L.qty), else_=-L.qty)
+
+
+def _day_start(day: date) -> datetime:
+    return datetime.combine(day, time.min)
+
+
+# ---------------------------------------------------------------------------
+# Writes (called inside the caller's transaction, no commit)
+# ---------------------------------------------------------------------------
+
+def record_movement(
+    db: Session,
+    lot: models.IngredientIntakeList,
+    movement_type: str,
+    prev_vol: float,
+    reason: str = "",
+    moved_by: Optional[str] = None,
+    reference: Optional[str] = None,
+    remark: Optional[str] = None,
+    new_vol: Optional[float] = None,
+) -> None:
+    """Append the change of `lot.remain_vol` from `prev_vol` to the ledger."""
+    new_vol = lot.remain_vol if new_vol is None else new_vol
+    delta = (new_vol or 0) - (prev_vol or 0)
+    if not delta:
+        return
+    db.add(models.StockLedger(
+        ts=datetime.now(),
+        intake_lot_id=lot.intake_lot_id,
+        mat_sap_code=lot.mat_sap_code,
+        re_code=lot.re_code,
+        material_description=lot.material_description,
+        movement_type=movement_type,
+        direction="increase" if delta > 0 else "decrease",
+        qty=abs(delta),
+        prev_vol=prev_vol,
+        new_vol=new_vol,
+        reason=reason,
+        remark=remark,
+        moved_by=moved_by,
+        reference=reference,
+    ))
+
+
+def backfill_stock_ledger(db: Session) -> int:
+    """Seed an empty ledger from intakes, adjustments and prebatch usage. Returns row count."""
+    L = models.StockLedger
+    Lot = models.IngredientIntakeList
+    Adj = models.StockAdjustment
+    Rec = models.PreBatchRec
+    RecFrom = models.PreBatchRecFrom
+
+    if db.query(L.id).first() is not None:
+        raise ValueError("stock_ledger is not empty; backfill only seeds a new ledger")
+
+    rows: List[dict] = []
+    for lot in db.execute(select(
+        Lot.intake_lot_id, Lot.mat_sap_code, Lot.re_code, Lot.material_description,
+        Lot.intake_vol, Lot.intake_at, Lot.intake_by,
+    )):
+        rows.append({
+            "ts": lot.intake_at or datetime.now(), "intake_lot_id": lot.intake_lot_id,
+            "mat_sap_code": lot.mat_sap_code, "re_code": lot.re_code,
+            "material_description": lot.material_description,
+            "movement_type": "intake", "direction": "increase", "qty": lot.intake_vol or 0,
+            "prev_vol": 0.0, "new_vol": lot.intake_vol, "reason": "Intake", "moved_by": lot.intake_by,
+        })
+
+    for a in db.execute(select(Adj)).scalars():
+        rows.append({
+            "ts": a.adjusted_at or datetime.now(), "intake_lot_id": a.intake_lot_id,
+            "mat_sap_code": a.mat_sap_code, "re_code": a.re_code,
+            "material_description": a.material_description,
+            "movement_type": "adjustment", "direction": a.adjust_type, "qty": a.adjust_qty,
+            "prev_vol": a.prev_remain_vol, "new_vol": a.new_remain_vol,
+            "reason": a.adjust_reason, "remark": a.remark, "moved_by": a.adjusted_by,
+        })
+
+    usage_cols = (Lot.mat_sap_code.label("lot_mat"), Lot.material_description, Rec.re_code, Rec.batch_record_id)
+    multi = (
+        select(RecFrom.intake_lot_id.label("lot"), RecFrom.take_volume.label("vol"),
+               RecFrom.created_at.label("ts"), *usage_cols)
+        .join(Rec, Rec.id == RecFrom.prebatch_rec_id)
+        .outerjoin(Lot, Lot.intake_lot_id == RecFrom.intake_lot_id)
+    )
+    single = (
+        select(Rec.intake_lot_id.label("lot"), Rec.net_volume.label("vol"),
+               Rec.created_at.label("ts"), *usage_cols)
+        .outerjoin(Lot, Lot.intake_lot_id == Rec.intake_lot_id)
+        .where(
+            Rec.intake_lot_id.isnot(None),
+            ~select(RecFrom.id).where(RecFrom.prebatch_rec_id == Rec.id).exists(),
+        )
+    )
+    for stmt in (multi, single):
+        for u in db.execute(stmt):
+            rows.append({
+                "ts": u.ts or datetime.now(), "intake_lot_id": u.lot,
+                "mat_sap_code": u.lot_mat, "re_code": u.re_code,
+                "material_description": u.material_description,
+                "movement_type": "prebatch", "direction": "decrease", "qty": u.vol or 0,
+                "reason": "Pre-batch", "reference": u.batch_record_id,
+            })
+
+    rows.sort(key=lambda r: r["ts"])
+    db.bulk_insert_mappings(L, rows)
+    db.commit()
+    logger.info("Backfilled stock_ledger: %d rows", len(rows))
+    return len(rows)
+
+
+# ---------------------------------------------------------------------------
+# Reads
+# ---------------------------------------------------------------------------
+
+def get_stock_movements(
+    db: Session,
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    intake_lot_id: Optional[str] = None,
+    re_code: Optional[str] = None,
+    cursor: Optional[LedgerCursor] = None,
+    limit: int = 500,
+) -> List[models.StockLedger]:
+    """Newest-first ledger page; pass the (ts, id) of the last row as `cursor` for the next one."""
+    L = models.StockLedger
+    q = db.query(L)
+    if intake_lot_id:
+        q = q.filter(L.intake_lot_id == intake_lot_id)
+    if re_code:
+        q = q.filter(L.re_code == re_code)
+    if date_from:
+        q = q.filter(L.ts >= date_from)
+    if date_to:
+        q = q.filter(L.ts < date_to)
+    if cursor:
+        ts, last_id = cursor
+        q = q.filter(or_(L.ts < ts, and_(L.ts == ts, L.id < last_id)))
+    return q.order_by(L.ts.desc(), L.id.desc()).limit(limit).all()
+
+
+# ---------------------------------------------------------------------------
+# Snapshots / as-of
+# ---------------------------------------------------------------------------
+# A snapshot row for day D holds the lot's remain_vol after every ledger row
+# with ts < D + 1 day, and is only written for lots that moved on D. So for
+# any lot, no ledger row lies between its latest snapshot and the latest
+# snapshot run, and an as-of read replays just the ledger after that run.
+
+def _latest_snapshots(db: Session, on_or_before: date, lot_ids=None) -> Dict[str, float]:
+    S = models.StockSnapshot
+    latest = select(S.intake_lot_id, func.max(S.snapshot_date).label("snapshot_date")).where(
+        S.snapshot_date <= on_or_before
+    )
+    if lot_ids is not None:
+        latest = latest.where(S.intake_lot_id.in_(lot_ids))
+    latest = latest.group_by(S.intake_lot_id).subquery()
+    rows = db.query(S.intake_lot_id, S.remain_vol).join(latest, and_(
+        S.intake_lot_id == latest.c.intake_lot_id, S.snapshot_date == latest.c.snapshot_date,
+    ))
+    return dict(rows.all())
+
+
+def take_stock_snapshots(db: Session, up_to: Optional[date] = None) -> int:
+    """Write daily snapshots for every day after the last run up to `up_to` (default yesterday).
+
+    Returns the number of snapshot rows written.
+    """
+    S = models.StockSnapshot
+    L = models.StockLedger
+    up_to = up_to or date.today() - timedelta(days=1)
+    last_run = db.query(func.max(S.snapshot_date)).scalar()
+    if last_run and last_run >= up_to:
+        return 0
+
+    volumes = _latest_snapshots(db, last_run) if last_run else {}
+    q = db.query(L.intake_lot_id, L.ts, _signed_qty().label("delta")).filter(L.ts < _day_start(up_to + timedelta(days=1)))
+    if last_run:
+        q = q.filter(L.ts >= _day_start(last_run + timedelta(days=1)))
+
+    snapshots: List[dict] = []
+    day: Optional[date] = None
+    moved: set = set()
+
+    def close_day():
+        if day is not None:
+            snapshots.extend({"snapshot_date": day, "intake_lot_id": lot, "remain_vol": volumes[lot]} for lot in moved)
+
+    for r in q.order_by(L.ts, L.id).yield_per(5000):
+        if r.ts.date() != day:
+            close_day()
+            day, moved = r.ts.date(), set()
+        volumes[r.intake_lot_id] = volumes.get(r.intake_lot_id, 0.0) + (r.delta or 0)
+        moved.add(r.intake_lot_id)
+    close_day()
+
+    # Inserted after the ledger cursor is exhausted (MySQL cannot interleave with a streaming cursor)
+    db.bulk_insert_mappings(S, snapshots)
+    total = len(snapshots)
+    db.commit()
+    logger.info("Wrote %d stock snapshot rows up to %s", total, up_to)
+    return total
+
+
+def rebuild_stock_snapshots(db: Session, up_to: Optional[date] = None) -> int:
+    """Drop all snapshots and recompute them from the ledger."""
+    db.query(models.StockSnapshot).delete(synchronize_session=False)
+    db.flush()
+    return take_stock_snapshots(db, up_to)
+
+
+def get_stock_as_of(db: Session, as_of: datetime, lot_ids: Optional[Iterable] = None) -> Dict[str, float]:
+    """remain_vol per lot at `as_of`: latest snapshot before that day + ledger replay since the last run.
+
+    `lot_ids` may be a list or a select() of intake_lot_id; lots absent from the
+    result had no stock recorded by then.
+    """
+    S = models.StockSnapshot
+    L = models.StockLedger
+    last_run = db.query(func.max(S.snapshot_date)).filter(S.snapshot_date < as_of.date()).scalar()
+    volumes = _latest_snapshots(db, last_run, lot_ids) if last_run else {}
+
+    q = db.query(L.intake_lot_id, func.sum(_signed_qty())).filter(L.ts <= as_of)
+    if last_run:
+        q = q.filter(L.ts >= _day_start(last_run + timedelta(days=1)))
+    if lot_ids is not None:
+        q = q.filter(L.intake_lot_id.in_(lot_ids))
+    for lot, delta in q.group_by(L.intake_lot_id):
+        volumes[lot] = volumes.get(lot, 0.0) + (delta or 0)
+    return volumes
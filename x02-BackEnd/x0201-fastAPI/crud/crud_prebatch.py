@@ -1,24 +1,38 @@
+import hashlib
 import logging
 import sys
+from collections import defaultdict
 from pathlib import Path
 
 # Ensure parent dir (x0201-fastAPI/) is on sys.path so models/schemas resolve
 sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
 
+from sqlalchemy import and_, func, inspect, or_, select, update  # type: ignore[import-untyped]
 from sqlalchemy.orm import Session, joinedload, selectinload  # type: ignore[import-untyped]
+from sqlalchemy.orm.attributes import set_committed_value  # type: ignore[import-untyped]
 from sqlalchemy.exc import IntegrityError, SQLAlchemyError  # type: ignore[import-untyped]
 from typing import List, Optional
+import barcodes  # type: ignore[import-untyped]
+import lot_reservations  # type: ignore[import-untyped]
 import models  # type: ignore[import-untyped]
 import schemas  # type: ignore[import-untyped]
+from .crud_box import add_bag, box_of, lock_boxes
+from .crud_genealogy import add_rec_genealogy, remove_rec_genealogy
+from .crud_consumption import apply_rec_consumption
+from .crud_inventory import lock_lots, move_stock, move_stock_grouped, run_in_transaction
 
 logger = logging.getLogger(__name__)
 
+BULK_MAX_RECS = 500
+BACKFILL_CHUNK = 1000
+
 
 def _populate_wh(records: List[models.PreBatchRec]) -> List[models.PreBatchRec]:
-    """Populate transient `wh` and `batch_id` fields from the eager-loaded PreBatchReq relationship."""
+    """Populate the transient `wh` field (and a not yet backfilled `batch_id`) from the eager-loaded PreBatchReq."""
     for rec in records:
         rec.wh = rec.req.wh if rec.req else "-"
-        rec.batch_id = rec.req.batch_id if rec.req else None  # type: ignore[attr-defined]
+        if rec.batch_id is None and rec.req:
+            set_committed_value(rec, "batch_id", rec.req.batch_id)
     return records
 
 
@@ -51,85 +65,200 @@ def get_prebatch_recs_by_plan(db: Session, plan_id: str) -> List[models.PreBatch
 
 def get_prebatch_recs_by_batch(db: Session, batch_id: str) -> List[models.PreBatchRec]:
     """Get PreBatch records for a specific batch."""
-    records = _base_rec_query(db).join(
-        models.PreBatchReq, models.PreBatchRec.req_id == models.PreBatchReq.id
-    ).filter(models.PreBatchReq.batch_id == batch_id).all()
+    records = _base_rec_query(db).filter(models.PreBatchRec.batch_id == batch_id).all()
     return _populate_wh(records)
 
 
-def _deduct_inventory(db: Session, re_code: str, intake_lot_id: str, volume: float):
-    """Deduct `volume` from the matching inventory lot."""
-    inv = db.query(models.IngredientIntakeList).filter(
-        models.IngredientIntakeList.intake_lot_id == intake_lot_id,
-        models.IngredientIntakeList.re_code == re_code,
-    ).first()
-    if inv:
-        inv.remain_vol = (inv.remain_vol or 0) - volume
-
-
-def _restore_inventory(db: Session, re_code: str, intake_lot_id: str, volume: float):
-    """Restore `volume` to the matching inventory lot."""
-    inv = db.query(models.IngredientIntakeList).filter(
-        models.IngredientIntakeList.intake_lot_id == intake_lot_id,
-        models.IngredientIntakeList.re_code == re_code,
-    ).first()
-    if inv:
-        inv.remain_vol = (inv.remain_vol or 0) + volume
-
+def _lock_reqs(db: Session, req_ids):
+    """Row-lock the requirements' batches, then the requirements (both in id order).
+
+    Returns ({req_id: req}, {batch_db_id: batch}). Every status change of a
+    batch's requirements goes through the batch row lock, so the counters
+    below cannot drift under concurrent stations.
+    """
+    ids = sorted(set(req_ids))
+    if not ids:
+        return {}, {}
+    batch_db_ids = sorted({b for (b,) in db.query(models.PreBatchReq.batch_db_id).filter(models.PreBatchReq.id.in_(ids))})
+    batches = db.query(models.ProductionBatch).filter(
+        models.ProductionBatch.id.in_(batch_db_ids)
+    ).order_by(models.ProductionBatch.id).with_for_update().populate_existing().all()
+    reqs = db.query(models.PreBatchReq).filter(
+        models.PreBatchReq.id.in_(ids)
+    ).order_by(models.PreBatchReq.id).with_for_update().populate_existing().all()
+    return {r.id: r for r in reqs}, {b.id: b for b in batches}
+
+
+def _lock_req(db: Session, req_id: int):
+    """Single-requirement form of _lock_reqs; returns (req, batch)."""
+    reqs, batches = _lock_reqs(db, [req_id])
+    req = reqs.get(req_id)
+    return (req, batches.get(req.batch_db_id)) if req else (None, None)
+
+
+def _set_req_status(req: models.PreBatchReq, status: int, batch: Optional[models.ProductionBatch]):
+    """Set req.status, moving batch.reqs_completed when it enters or leaves Completed."""
+    step = (status == 2) - (req.status == 2)
+    req.status = status
+    if batch is not None and step:
+        batch.reqs_completed = (batch.reqs_completed or 0) + step
+
+
+def _rec_draws(record: schemas.PreBatchRecCreate):
+    """Inventory draws of a new bag — multi-lot origins or the single lot on the rec."""
+    if record.origins:
+        return [(o.intake_lot_id, o.mat_sap_code, o.take_volume) for o in record.origins]
+    if record.intake_lot_id:
+        return [(record.intake_lot_id, record.mat_sap_code, record.net_volume or 0)]
+    return []
+
+
+def _decompose_barcode(db_record: models.PreBatchRec, req: Optional[models.PreBatchReq]):
+    """Store the barcode's batch (and package_no, if not sent) and build prebatch_id from them.
+
+    The batch comes from the requirement when there is one, else from the parsed barcode.
+    """
+    parsed = barcodes.parse_bag_barcode(db_record.batch_record_id, db_record.re_code, db_record.plan_id)
+    db_record.batch_id = (req.batch_id if req else None) or (parsed.batch_id if parsed else None)
+    if db_record.package_no is None and parsed:
+        db_record.package_no = parsed.package_no
+    if not db_record.prebatch_id and db_record.recode_batch_id and db_record.re_code and db_record.batch_id:
+        db_record.prebatch_id = barcodes.format_prebatch_id(db_record.batch_id, db_record.re_code,
+                                                            db_record.recode_batch_id)
+
+
+def _load_created_at(db: Session, recs: List[models.PreBatchRec]):
+    """Fetch created_at of flushed bags in one query where the INSERT did not return it (MySQL)."""
+    Rec = models.PreBatchRec
+    missing = {r.id: r for r in recs if "created_at" in inspect(r).unloaded}
+    if missing:
+        for rec_id, created_at in db.query(Rec.id, Rec.created_at).filter(Rec.id.in_(list(missing))):
+            set_committed_value(missing[rec_id], "created_at", created_at)
+
+
+def _add_rec_rows(db: Session, db_record: models.PreBatchRec, record: schemas.PreBatchRecCreate, draws):
+    """Origins, genealogy, daily consumption and reservation draw-down of a flushed bag."""
+    for intake_lot_id, mat_sap_code, take_volume in draws if record.origins else []:
+        db.add(models.PreBatchRecFrom(
+            prebatch_rec_id=db_record.id,
+            intake_lot_id=intake_lot_id,
+            mat_sap_code=mat_sap_code,
+            take_volume=take_volume,
+        ))
+    add_rec_genealogy(db, db_record, draws)
+    apply_rec_consumption(db, db_record, draws)
+    refs = (db_record.batch_record_id, db_record.batch_id)
+    for intake_lot_id, _mat, take_volume in draws:
+        lot_reservations.draw_on_commit(db, intake_lot_id, refs, take_volume)
+
+
+def _count_bag(db_record: models.PreBatchRec, req: models.PreBatchReq, batch: Optional[models.ProductionBatch],
+               box: Optional[models.PreBatchBox] = None):
+    """Advance the requirement status, progress, batch and box counters for one new bag."""
+    if box is not None:
+        add_bag(box, db_record, +1, expected=0 if req.bag_count else (db_record.total_packages or 1))
+    req.packaged_volume = (req.packaged_volume or 0.0) + (db_record.net_volume or 0.0)
+    req.bag_count = (req.bag_count or 0) + 1
+    if batch:
+        batch.bags_weighed = (batch.bags_weighed or 0) + 1
+    if db_record.package_no and db_record.total_packages and db_record.package_no >= db_record.total_packages:
+        _set_req_status(req, 2, batch)  # Completed
+    elif req.status == 0:
+        _set_req_status(req, 1, batch)  # In-Progress
+
+
+def _finalize_if_prepared(batch: Optional[models.ProductionBatch]):
+    """Auto-finalize batch when ALL requirements are completed."""
+    if batch and batch.reqs_total and batch.reqs_completed >= batch.reqs_total:
+        batch.batch_prepare = True
+        if batch.status in ("Created", "In-Progress"):
+            batch.status = "Prepared"
+
+
+def _move_draws(db: Session, re_code: str, draws, sign: int, reference: str):
+    """Lock the drawn lots in id order and move `sign * volume` on each lot matching `re_code`."""
+    lots = lock_lots(db, [lot_id for lot_id, _mat, _vol in draws])
+    movement_type, reason = ("prebatch", "Pre-batch") if sign < 0 else ("prebatch_restore", "Pre-batch deleted")
+    for intake_lot_id, _mat, volume in draws:
+        lot = lots.get(intake_lot_id)
+        if lot is not None and lot.re_code == re_code:
+            move_stock(db, lot, sign * (volume or 0), movement_type, reason=reason, reference=reference)
+
+
+def _create_prebatch_rec(db: Session, record: schemas.PreBatchRecCreate) -> models.PreBatchRec:
+    db_record = models.PreBatchRec(**record.model_dump(exclude={'origins'}))
+    draws = _rec_draws(record)
+    # Take the lot locks before any other write so every station acquires them in the same order
+    _move_draws(db, db_record.re_code, draws, -1, db_record.batch_record_id)
+
+    # Requirement, its batch and box, locked for the counter update below
+    req, batch = _lock_req(db, db_record.req_id) if db_record.req_id else (None, None)
+    box = box_of(lock_boxes(db, [req]), req) if req else None
+    _decompose_barcode(db_record, req)
+
+    db.add(db_record)
+    db.flush()
+    _add_rec_rows(db, db_record, record, draws)
+
+    # Update requirement status
+    if req:
+        _count_bag(db_record, req, batch, box)
+        _finalize_if_prepared(batch)
+    return db_record
+
+
+# Fields that must match for a repeated batch_record_id to count as a replay
+_REPLAY_FIELDS = ("req_id", "re_code", "package_no", "net_volume", "intake_lot_id")
+
+
+def _request_hash(record: schemas.PreBatchRecCreate) -> str:
+    return hashlib.sha256(record.model_dump_json().encode()).hexdigest()
+
+
+def find_prebatch_replay(db: Session, record: schemas.PreBatchRecCreate,
+                         idempotency_key: Optional[str] = None) -> Optional[models.PreBatchRec]:
+    """Return the bag an earlier delivery of this request created, if any.
+
+    Matched by Idempotency-Key when given, else by batch_record_id. Raises
+    ValueError when the key or batch_record_id was used for a different bag.
+    """
+    if idempotency_key:
+        seen = db.get(models.IdempotencyKey, idempotency_key)
+        if seen is not None:
+            if seen.request_hash != _request_hash(record):
+                raise ValueError(f"Idempotency-Key '{idempotency_key}' was used for a different request")
+            rec = _base_rec_query(db).filter(models.PreBatchRec.id == seen.prebatch_rec_id).first()
+            if rec is not None:
+                return _populate_wh([rec])[0]
+
+    rec = _base_rec_query(db).filter(models.PreBatchRec.batch_record_id == record.batch_record_id).first()
+    if rec is None:
+        return None
+    # package_no left out of the request was parsed from the barcode on create
+    fields = _REPLAY_FIELDS if record.package_no is not None else tuple(f for f in _REPLAY_FIELDS if f != "package_no")
+    if any(getattr(rec, f) != getattr(record, f) for f in fields):
+        raise ValueError(f"batch_record_id '{record.batch_record_id}' already exists with different values")
+    return _populate_wh([rec])[0]
+
+
+def create_prebatch_rec(db: Session, record: schemas.PreBatchRecCreate,
+                        idempotency_key: Optional[str] = None) -> models.PreBatchRec:
+    """Create a new PreBatch record (transaction) and update inventory.
+
+    Runs through run_in_transaction, so a deadlock between stations replays the
+    whole record. `idempotency_key` is stored in the same transaction (see
+    find_prebatch_replay).
+    """
+    def work():
+        db_record = _create_prebatch_rec(db, record)
+        if idempotency_key:
+            db.query(models.IdempotencyKey).filter(models.IdempotencyKey.key == idempotency_key).delete()
+            db.add(models.IdempotencyKey(key=idempotency_key, request_hash=_request_hash(record),
+                                         prebatch_rec_id=db_record.id))
+        return db_record
 
-def create_prebatch_rec(db: Session, record: schemas.PreBatchRecCreate) -> models.PreBatchRec:
-    """Create a new PreBatch record (transaction) and update inventory."""
     try:
-        record_data = record.model_dump(exclude={'origins'})
-        db_record = models.PreBatchRec(**record_data)
-
-        # Auto-format prebatch_id
-        if not db_record.prebatch_id and db_record.recode_batch_id and db_record.re_code:
-            batch_id_str = ""
-            if db_record.req_id:
-                req = db.query(models.PreBatchReq).filter(models.PreBatchReq.id == db_record.req_id).first()
-                if req:
-                    batch_id_str = req.batch_id
-            if not batch_id_str and db_record.batch_record_id:
-                batch_id_str = db_record.batch_record_id.split(f"-{db_record.re_code}")[0]
-            if batch_id_str:
-                db_record.prebatch_id = f"{batch_id_str}{db_record.re_code}{db_record.recode_batch_id}"
-
-        db.add(db_record)
-        db.flush()
-
-        # Inventory deduction — multi-lot or single-lot
-        if record.origins:
-            for origin in record.origins:
-                db.add(models.PreBatchRecFrom(
-                    prebatch_rec_id=db_record.id,
-                    intake_lot_id=origin.intake_lot_id,
-                    mat_sap_code=origin.mat_sap_code,
-                    take_volume=origin.take_volume,
-                ))
-                _deduct_inventory(db, db_record.re_code, origin.intake_lot_id, origin.take_volume)
-        elif db_record.intake_lot_id:
-            _deduct_inventory(db, db_record.re_code, db_record.intake_lot_id, db_record.net_volume or 0)
-
-        # Update requirement status
-        if db_record.req_id:
-            req = db.query(models.PreBatchReq).filter(models.PreBatchReq.id == db_record.req_id).first()
-            if req:
-                if db_record.package_no and db_record.total_packages and db_record.package_no >= db_record.total_packages:
-                    req.status = 2  # Completed
-                elif req.status == 0:
-                    req.status = 1  # In-Progress
-
-                # Auto-finalize batch when ALL requirements are completed
-                batch = req.batch
-                if batch:
-                    all_reqs = db.query(models.PreBatchReq).filter(models.PreBatchReq.batch_db_id == batch.id).all()
-                    if all(r.status == 2 for r in all_reqs):
-                        batch.batch_prepare = True
-                        if batch.status in ("Created", "In-Progress"):
-                            batch.status = "Prepared"
-
-        db.commit()
+        db_record = run_in_transaction(db, work)
         db.refresh(db_record)
         return db_record
     except IntegrityError as e:
@@ -146,34 +275,129 @@ def create_prebatch_rec(db: Session, record: schemas.PreBatchRecCreate) -> model
         raise RuntimeError(f"Unexpected error: {e}")
 
 
+def create_prebatch_recs_bulk(db: Session, records: List[schemas.PreBatchRecCreate]) -> List[dict]:
+    """Create a station's run of bags in one transaction.
+
+    Items that fail validation (duplicate or existing batch_record_id, unknown
+    requirement or lot, lot of another ingredient) are reported and skipped;
+    the rest are committed together, with one stock UPDATE per lot. Returns one
+    {"index", "batch_record_id", "ok", "id", "error"} per item, in input order.
+    """
+    if len(records) > BULK_MAX_RECS:
+        raise ValueError(f"At most {BULK_MAX_RECS} records per request")
+
+    def work():
+        results = [{"index": i, "batch_record_id": r.batch_record_id, "ok": False, "id": None, "error": None}
+                   for i, r in enumerate(records)]
+        draws = [_rec_draws(r) for r in records]
+        # Same lock order as the single-bag path: lots, then batches, then requirements, then boxes
+        lots = lock_lots(db, [lot_id for d in draws for lot_id, _mat, _vol in d])
+        reqs, batches = _lock_reqs(db, [r.req_id for r in records if r.req_id])
+        existing = {b for (b,) in db.query(models.PreBatchRec.batch_record_id).filter(
+            models.PreBatchRec.batch_record_id.in_([r.batch_record_id for r in records])
+        )}
+
+        valid: List[int] = []
+        for i, r in enumerate(records):
+            error = None
+            if r.batch_record_id in existing:
+                error = f"Duplicate batch_record_id '{r.batch_record_id}'"
+            elif r.req_id and r.req_id not in reqs:
+                error = f"Requirement {r.req_id} not found"
+            else:
+                for lot_id, _mat, _vol in draws[i]:
+                    if lot_id not in lots:
+                        error = f"Lot '{lot_id}' not found"
+                    elif lots[lot_id].re_code != r.re_code:
+                        error = f"Lot '{lot_id}' is not {r.re_code}"
+                    if error:
+                        break
+            if error:
+                results[i]["error"] = error
+            else:
+                existing.add(r.batch_record_id)
+                valid.append(i)
+
+        boxes = lock_boxes(db, {reqs[records[i].req_id] for i in valid if records[i].req_id})
+
+        moves = defaultdict(list)
+        for i in valid:
+            for lot_id, _mat, volume in draws[i]:
+                moves[lot_id].append((-(volume or 0), records[i].batch_record_id))
+        for lot_id in sorted(moves):
+            move_stock_grouped(db, lots[lot_id], moves[lot_id], "prebatch", reason="Pre-batch")
+
+        db_records = {}
+        for i in valid:
+            db_record = models.PreBatchRec(**records[i].model_dump(exclude={'origins'}))
+            _decompose_barcode(db_record, reqs.get(db_record.req_id))
+            db.add(db_record)
+            db_records[i] = db_record
+        db.flush()
+        _load_created_at(db, list(db_records.values()))
+
+        for i, db_record in db_records.items():
+            _add_rec_rows(db, db_record, records[i], draws[i])
+            if db_record.req_id:
+                req = reqs[db_record.req_id]
+                _count_bag(db_record, req, batches.get(req.batch_db_id), box_of(boxes, req))
+            results[i].update(ok=True, id=db_record.id)
+        for batch in batches.values():
+            _finalize_if_prepared(batch)
+        return results
+
+    try:
+        return run_in_transaction(db, work)
+    except SQLAlchemyError as e:
+        db.rollback()
+        logger.error("SQLAlchemy error in create_prebatch_recs_bulk: %s", e)
+        raise RuntimeError(f"Database error: {e}")
+
+
+def _delete_prebatch_rec(db: Session, record_id: int) -> bool:
+    db_record = db.query(models.PreBatchRec).filter(models.PreBatchRec.id == record_id).first()
+    if not db_record:
+        return False
+
+    # 1. Restore inventory — prefer origins (multi-lot), fall back to single lot
+    origins = db.query(models.PreBatchRecFrom).filter(
+        models.PreBatchRecFrom.prebatch_rec_id == record_id
+    ).all()
+
+    if origins:
+        draws = [(o.intake_lot_id, o.mat_sap_code, o.take_volume) for o in origins]
+    elif db_record.intake_lot_id:
+        draws = [(db_record.intake_lot_id, db_record.mat_sap_code, db_record.net_volume or 0)]
+    else:
+        draws = []
+    _move_draws(db, db_record.re_code, draws, +1, db_record.batch_record_id)
+    apply_rec_consumption(db, db_record, draws, sign=-1)
+
+    # 2. Revert requirement status
+    if db_record.req_id:
+        req, batch = _lock_req(db, db_record.req_id)
+        if req:
+            req.packaged_volume = (req.packaged_volume or 0.0) - (db_record.net_volume or 0.0)
+            req.bag_count = max((req.bag_count or 0) - 1, 0)
+            box = box_of(lock_boxes(db, [req]), req)
+            add_bag(box, db_record, -1, expected=0 if req.bag_count else (db_record.total_packages or 1))
+            if batch:
+                batch.bags_weighed = max((batch.bags_weighed or 0) - 1, 0)
+            _set_req_status(req, 1, batch)  # Back to In-Progress
+
+    # 3. Delete record (origins cascade via FK), its genealogy edges and idempotency keys
+    remove_rec_genealogy(db, record_id)
+    db.query(models.IdempotencyKey).filter(
+        models.IdempotencyKey.prebatch_rec_id == record_id
+    ).delete(synchronize_session=False)
+    db.delete(db_record)
+    return True
+
+
 def delete_prebatch_rec(db: Session, record_id: int) -> bool:
     """Delete a PreBatch record and revert inventory consumption (supports multi-lot origins)."""
     try:
-        db_record = db.query(models.PreBatchRec).filter(models.PreBatchRec.id == record_id).first()
-        if not db_record:
-            return False
-
-        # 1. Restore inventory — prefer origins (multi-lot), fall back to single lot
-        origins = db.query(models.PreBatchRecFrom).filter(
-            models.PreBatchRecFrom.prebatch_rec_id == record_id
-        ).all()
-
-        if origins:
-            for origin in origins:
-                _restore_inventory(db, db_record.re_code, origin.intake_lot_id, origin.take_volume)
-        elif db_record.intake_lot_id:
-            _restore_inventory(db, db_record.re_code, db_record.intake_lot_id, db_record.net_volume or 0)
-
-        # 2. Revert requirement status
-        if db_record.req_id:
-            req = db.query(models.PreBatchReq).filter(models.PreBatchReq.id == db_record.req_id).first()
-            if req:
-                req.status = 1  # Back to In-Progress
-
-        # 3. Delete record (origins cascade via FK)
-        db.delete(db_record)
-        db.commit()
-        return True
+        return run_in_transaction(db, lambda: _delete_prebatch_rec(db, record_id))
     except Exception as e:
         db.rollback()
         logger.error("Error deleting prebatch record %d: %s", record_id, e)
@@ -193,15 +417,25 @@ def get_prebatch_reqs_by_batch(db: Session, batch_id: str) -> List[models.PreBat
 
 def update_prebatch_req_status(db: Session, batch_id: str, re_code: str, status: int) -> bool:
     """Update requirement status (0=Pending, 1=In-Progress, 2=Completed)."""
-    req = db.query(models.PreBatchReq).filter(
+    req_id = db.query(models.PreBatchReq.id).filter(
         models.PreBatchReq.batch_id == batch_id,
         models.PreBatchReq.re_code == re_code,
-    ).first()
+    ).scalar()
+    return req_id is not None and update_prebatch_req_status_by_id(db, req_id, status) is not None
+
+
+def update_prebatch_req_status_by_id(db: Session, req_id: int, status: int) -> Optional[models.PreBatchReq]:
+    """Update one requirement's status and its batch's completed counter."""
+    def work():
+        req, batch = _lock_req(db, req_id)
+        if req:
+            _set_req_status(req, status, batch)
+        return req
+
+    req = run_in_transaction(db, work)
     if req:
-        req.status = status
-        db.commit()
-        return True
-    return False
+        db.refresh(req)
+    return req
 
 
 def get_prebatch_req(db: Session, req_id: int) -> Optional[models.PreBatchReq]:
@@ -261,6 +495,7 @@ def ensure_prebatch_reqs_for_batch(db: Session, batch_id: str) -> bool:
                 wh=wh_loc,
                 status=0,
             ))
+        batch.reqs_total = (batch.reqs_total or 0) + len(ingredient_info)
 
         db.commit()
         return True
@@ -268,3 +503,84 @@ def ensure_prebatch_reqs_for_batch(db: Session, batch_id: str) -> bool:
         db.rollback()
         logger.error("Error creating requirements for %s: %s", batch_id, e)
         return False
+
+
+def rebuild_batch_counters(db: Session) -> int:
+    """Recount reqs_total / reqs_completed / bags_weighed for every batch. Returns batches updated."""
+    B = models.ProductionBatch
+    Req = models.PreBatchReq
+    Rec = models.PreBatchRec
+    reqs = select(func.count(Req.id)).where(Req.batch_db_id == B.id)
+    bags = select(func.count(Rec.id)).join(Req, Rec.req_id == Req.id).where(Req.batch_db_id == B.id)
+    result = db.execute(update(B).values(
+        reqs_total=reqs.scalar_subquery(),
+        reqs_completed=reqs.where(Req.status == 2).scalar_subquery(),
+        bags_weighed=bags.scalar_subquery(),
+    ).execution_options(synchronize_session=False))
+    db.commit()
+    logger.info("Rebuilt pre-batch counters for %d batches", result.rowcount)
+    return result.rowcount
+
+
+def rebuild_req_progress(db: Session) -> int:
+    """Recount packaged_volume / bag_count for every requirement. Returns requirements updated.
+
+    Bags saved before req_id was recorded are matched on their barcode's batch
+    and re_code (run backfill_rec_barcodes first on older databases).
+    """
+    Req = models.PreBatchReq
+    Rec = models.PreBatchRec
+    own = or_(
+        Rec.req_id == Req.id,
+        and_(Rec.req_id.is_(None), Rec.batch_id == Req.batch_id, Rec.re_code == Req.re_code),
+    )
+    result = db.execute(update(Req).values(
+        packaged_volume=select(func.coalesce(func.sum(Rec.net_volume), 0.0)).where(own).scalar_subquery(),
+        bag_count=select(func.count(Rec.id)).where(own).scalar_subquery(),
+    ).execution_options(synchronize_session=False))
+    db.commit()
+    logger.info("Rebuilt packaged volume for %d requirements", result.rowcount)
+    return result.rowcount
+
+
+def backfill_rec_barcodes(db: Session) -> int:
+    """Fill prebatch_recs.batch_id (and a missing package_no) for bags saved before it existed.
+
+    Bags with a requirement take its batch_id in one UPDATE; the rest, and any
+    bag still missing package_no, are parsed from batch_record_id in chunks.
+    Returns the number of row updates.
+    """
+    Req = models.PreBatchReq
+    Rec = models.PreBatchRec
+    result = db.execute(update(Rec).where(Rec.batch_id.is_(None), Rec.req_id.isnot(None)).values(
+        batch_id=select(Req.batch_id).where(Req.id == Rec.req_id).scalar_subquery(),
+    ).execution_options(synchronize_session=False))
+    db.commit()
+    total = result.rowcount
+
+    last_id = 0
+    while True:
+        rows = db.query(Rec.id, Rec.batch_record_id, Rec.re_code, Rec.plan_id, Rec.batch_id, Rec.package_no).filter(
+            Rec.id > last_id, or_(Rec.batch_id.is_(None), Rec.package_no.is_(None))
+        ).order_by(Rec.id).limit(BACKFILL_CHUNK).all()
+        if not rows:
+            break
+        last_id = rows[-1].id
+        updates = []
+        for r in rows:
+            parsed = barcodes.parse_bag_barcode(r.batch_record_id, r.re_code, r.plan_id)
+            if parsed is None:
+                continue
+            values = {"id": r.id}
+            if r.batch_id is None:
+                values["batch_id"] = parsed.batch_id
+            if r.package_no is None and parsed.package_no is not None:
+                values["package_no"] = parsed.package_no
+            if len(values) > 1:
+                updates.append(values)
+        if updates:
+            db.bulk_update_mappings(Rec, updates)
+            db.commit()
+            total += len(updates)
+    logger.info("Backfilled barcode parts for %d bags", total)
+    return total
@@ -1,10 +1,13 @@
+from sqlalchemy import insert
 from sqlalchemy.orm import Session, joinedload, selectinload
 from sqlalchemy.exc import IntegrityError, SQLAlchemyError
 from typing import Optional, List
 from datetime import date, datetime
 import math
 import models
+import report_cache
 import schemas
+from .crud_sequence import allocate_ids
 
 # Production Plan CRUD
 def get_production_plans(db: Session, skip: int = 0, limit: int = 1000) -> List[models.ProductionPlan]:
@@ -13,10 +16,43 @@ def get_production_plans(db: Session, skip: int = 0, limit: int = 1000) -> List[
         selectinload(models.ProductionPlan.batches).lazyload(models.ProductionBatch.reqs)
     ).order_by(models.ProductionPlan.created_at.desc()).offset(skip).limit(limit).all()
 
+def _max_plan_sequence(db: Session, prefix: str) -> int:
+    """Highest plan sequence already used under `prefix` ("P001-260305-") in plans or batches."""
+    from sqlalchemy import func as sa_func
+
+    # Check max sequence in production_plans
+    max_plan_id = db.query(sa_func.max(models.ProductionPlan.plan_id)).filter(
+        models.ProductionPlan.plan_id.like(f"{prefix}%")
+    ).scalar()
+
+    seq_from_plans = 0
+    if max_plan_id:
+        try:
+            # plan_id = "P001-260305-001" → suffix = "001"
+            suffix = max_plan_id[len(prefix):]
+            seq_from_plans = int(suffix)
+        except (ValueError, IndexError):
+            seq_from_plans = 0
+
+    # Also check max sequence in production_batches
+    max_batch_id = db.query(sa_func.max(models.ProductionBatch.batch_id)).filter(
+        models.ProductionBatch.batch_id.like(f"{prefix}%")
+    ).scalar()
+
+    seq_from_batches = 0
+    if max_batch_id:
+        try:
+            # batch_id = "P001-260305-003-001" → suffix = "003-001", take first part
+            suffix = max_batch_id[len(prefix):]
+            plan_seq_part = suffix.split("-")[0]
+            seq_from_batches = int(plan_seq_part)
+        except (ValueError, IndexError):
+            seq_from_batches = 0
+
+    return max(seq_from_plans, seq_from_batches)
+
 def create_production_plan(db: Session, plan_data: schemas.ProductionPlanCreate) -> models.ProductionPlan:
     try:
-        from sqlalchemy import func as sa_func
-
         # Calculate Number of Batches if Total Volume and Batch Size are provided
         num_batches = plan_data.num_batches
         if not num_batches and plan_data.total_volume and plan_data.batch_size and plan_data.batch_size > 0:
@@ -39,39 +75,11 @@ def create_production_plan(db: Session, plan_data: schemas.ProductionPlanCreate)
         plant_num = int(plant_match.group(1)) if plant_match else 1
         plant_code = f"P{plant_num:03d}"
         
-        # Find max existing sequence for this plant+date
+        # Next number of this plant's series for today (id_sequences row, locked
+        # until the commit below); seeded once from plan/batch ids made before it existed
         prefix = f"{plant_code}-{date_str}-"
-
-        # Check max sequence in production_plans
-        max_plan_id = db.query(sa_func.max(models.ProductionPlan.plan_id)).filter(
-            models.ProductionPlan.plan_id.like(f"{prefix}%")
-        ).scalar()
-        
-        seq_from_plans = 0
-        if max_plan_id:
-            try:
-                # plan_id = "P001-260305-001" → suffix = "001"
-                suffix = max_plan_id[len(prefix):]
-                seq_from_plans = int(suffix)
-            except (ValueError, IndexError):
-                seq_from_plans = 0
-
-        # Also check max sequence in production_batches
-        max_batch_id = db.query(sa_func.max(models.ProductionBatch.batch_id)).filter(
-            models.ProductionBatch.batch_id.like(f"{prefix}%")
-        ).scalar()
-
-        seq_from_batches = 0
-        if max_batch_id:
-            try:
-                # batch_id = "P001-260305-003-001" → suffix = "003-001", take first part
-                suffix = max_batch_id[len(prefix):]
-                plan_seq_part = suffix.split("-")[0]
-                seq_from_batches = int(plan_seq_part)
-            except (ValueError, IndexError):
-                seq_from_batches = 0
-
-        sequence = max(seq_from_plans, seq_from_batches) + 1
+        sequence = allocate_ids(db, "plan", scope=plant_code, day=today,
+                                seed=lambda: _max_plan_sequence(db, prefix))[0]
         plan_id_str = f"{plant_code}-{date_str}-{sequence:02d}"
 
         # === SINGLE TRANSACTION: Plan + History + Batches + Requirements ===
@@ -106,12 +114,22 @@ def create_production_plan(db: Session, plan_data: schemas.ProductionPlanCreate)
         # Automatically Create Batches and Requirements
         if num_batches and num_batches > 0:
             # 1. Fetch SKU and its steps for the recipe
-            sku = db.query(models.Sku).filter(models.Sku.sku_id == plan_data.sku_id).first()
+            sku = db.query(models.Sku).options(selectinload(models.Sku.steps)).filter(
+                models.Sku.sku_id == plan_data.sku_id
+            ).first()
             recipe_steps = sku.steps if sku else []
             std_batch_size = sku.std_batch_size if sku else 0
 
-            # 2. Pre-calculate ingredient info ONCE (not per-batch)
-            # This avoids N×M queries to the remote DB
+            # 2. Pre-calculate ingredient info ONCE (not per-batch), with one IN query
+            # for all the recipe's ingredients
+            re_codes = list(dict.fromkeys(step.re_code for step in recipe_steps if step.re_code))
+            ingredients = {}
+            if re_codes:
+                for ing in db.query(models.Ingredient.re_code, models.Ingredient.name, models.Ingredient.warehouse).filter(
+                    models.Ingredient.re_code.in_(re_codes)
+                ).order_by(models.Ingredient.id):
+                    ingredients.setdefault(ing.re_code, ing)
+
             ingredient_template = {}  # {re_code: {'qty': total_per_batch, 'name': name, 'wh': warehouse}}
             for step in recipe_steps:
                 if not step.re_code:
@@ -119,42 +137,53 @@ def create_production_plan(db: Session, plan_data: schemas.ProductionPlanCreate)
                 step_req = step.require or 0
                 if std_batch_size and std_batch_size > 0:
                     step_req = (step_req / std_batch_size) * plan_data.batch_size
-                
+
                 if step.re_code not in ingredient_template:
-                    ing = db.query(models.Ingredient).filter(models.Ingredient.re_code == step.re_code).first()
+                    ing = ingredients.get(step.re_code)
                     ing_name = ing.name if ing else step.re_code
                     wh_loc = ing.warehouse if ing and ing.warehouse else "-"
                     ingredient_template[step.re_code] = {'qty': 0, 'name': ing_name, 'wh': wh_loc}
-                
+
                 ingredient_template[step.re_code]['qty'] += step_req
 
-            # 3. Create batches and requirements using pre-fetched data
-            for i in range(1, num_batches + 1):
-                batch_id_str = f"{plan_id_str}-{i:03d}"
-                
-                db_batch = models.ProductionBatch(
-                    plan_id=db_plan.id,
-                    batch_id=batch_id_str,
-                    sku_id=plan_data.sku_id,
-                    plant=plan_data.plant,
-                    batch_size=plan_data.batch_size,
-                    status="Created"
-                )
-                db.add(db_batch)
-                db.flush()
-
-                for re_code, info in ingredient_template.items():
-                    db_req = models.PreBatchReq(
-                        batch_db_id=db_batch.id,
-                        plan_id=db_plan.plan_id,
-                        batch_id=batch_id_str,
-                        re_code=re_code,
-                        ingredient_name=info['name'],
-                        required_volume=round(info['qty'], 4),
-                        wh=info['wh'],
-                        status=0
-                    )
-                    db.add(db_req)
+            # 3. Insert batches, then requirements, each as one executemany. The
+            # batches' primary keys come back with the insert where the dialect
+            # supports executemany RETURNING (SQLite, MariaDB); MySQL has no
+            # RETURNING, so there they are read back once, keyed by batch_id.
+            batch_ids = [f"{plan_id_str}-{i:03d}" for i in range(1, num_batches + 1)]
+            batch_stmt = insert(models.ProductionBatch)
+            returning = db.get_bind().dialect.insert_executemany_returning
+            if returning:
+                batch_stmt = batch_stmt.returning(models.ProductionBatch.batch_id, models.ProductionBatch.id)
+            inserted = db.execute(batch_stmt, [{
+                "plan_id": db_plan.id,
+                "batch_id": batch_id_str,
+                "sku_id": plan_data.sku_id,
+                "plant": plan_data.plant,
+                "batch_size": plan_data.batch_size,
+                "status": "Created",
+                "reqs_total": len(ingredient_template),
+            } for batch_id_str in batch_ids])
+
+            if ingredient_template:
+                if returning:
+                    batch_db_ids = dict(inserted.all())
+                else:
+                    batch_db_ids = dict(db.query(models.ProductionBatch.batch_id, models.ProductionBatch.id).filter(
+                        models.ProductionBatch.plan_id == db_plan.id
+                    ).all())
+                db.execute(insert(models.PreBatchReq), [{
+                    "batch_db_id": batch_db_ids[batch_id_str],
+                    "plan_id": db_plan.plan_id,
+                    "batch_id": batch_id_str,
+                    "re_code": re_code,
+                    "ingredient_name": info['name'],
+                    "required_volume": round(info['qty'], 4),
+                    "wh": info['wh'],
+                    "status": 0,
+                } for batch_id_str in batch_ids for re_code, info in ingredient_template.items()])
+            # Core inserts bypass the ORM flush hooks that invalidate cached reports
+            report_cache.touch(db, report_cache.plan_scope(db_plan.plan_id))
 
         # Single commit for everything: plan + history + batches + requirements
         db.commit()
@@ -0,0 +1,113 @@
+import logging
+import sys
+from pathlib import Path
+
+# Ensure parent dir (x0201-fastAPI/) is on sys.path so models/schemas resolve
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import pandas as pd
+from sqlalchemy import select  # type: ignore[import-untyped]
+from sqlalchemy.exc import SQLAlchemyError  # type: ignore[import-untyped]
+from sqlalchemy.orm import Session  # type: ignore[import-untyped]
+from typing import List, Optional, Sequence
+import models  # type: ignore[import-untyped]
+from .crud_inventory import lock_lots, move_stock, run_in_transaction
+
+logger = logging.getLogger(__name__)
+
+RECONCILE_COLUMNS = [
+    "intake_lot_id", "re_code", "mat_sap_code", "status", "intake_vol",
+    "taken_vol", "adjusted_vol", "expected_vol", "remain_vol", "diff",
+]
+
+
+def _expected_balances(db: Session, lot_ids: Optional[Sequence[str]] = None) -> pd.DataFrame:
+    """expected_vol = intake_vol − Σ pre-batch takes ± Σ adjustments, for every lot (or `lot_ids`) in one pass."""
+    Lot = models.IngredientIntakeList
+    Rec = models.PreBatchRec
+    RecFrom = models.PreBatchRecFrom
+    Adj = models.StockAdjustment
+    conn = db.connection()
+
+    def only(stmt, column):
+        return stmt if lot_ids is None else stmt.where(column.in_(lot_ids))
+
+    lots = pd.read_sql(only(select(
+        Lot.intake_lot_id, Lot.re_code, Lot.mat_sap_code, Lot.status, Lot.intake_vol, Lot.remain_vol,
+    ), Lot.intake_lot_id), conn)
+    takes = pd.concat([
+        pd.read_sql(only(select(RecFrom.intake_lot_id, RecFrom.take_volume), RecFrom.intake_lot_id), conn),
+        # Single-lot bags carry the lot on the rec and have no origin rows
+        pd.read_sql(only(select(Rec.intake_lot_id, Rec.net_volume.label("take_volume")).where(
+            Rec.intake_lot_id.isnot(None),
+            ~select(RecFrom.id).where(RecFrom.prebatch_rec_id == Rec.id).exists(),
+        ), Rec.intake_lot_id), conn),
+    ])
+    adjs = pd.read_sql(only(select(Adj.intake_lot_id, Adj.adjust_type, Adj.adjust_qty), Adj.intake_lot_id), conn)
+
+    taken = takes.groupby("intake_lot_id")["take_volume"].sum().rename("taken_vol")
+    adjs["signed"] = adjs["adjust_qty"].where(adjs["adjust_type"] == "increase", -adjs["adjust_qty"])
+    adjusted = adjs.groupby("intake_lot_id")["signed"].sum().rename("adjusted_vol")
+
+    df = lots.set_index("intake_lot_id").join(taken).join(adjusted)
+    df[["intake_vol", "remain_vol", "taken_vol", "adjusted_vol"]] = \
+        df[["intake_vol", "remain_vol", "taken_vol", "adjusted_vol"]].astype(float).fillna(0.0)
+    df["expected_vol"] = df["intake_vol"] - df["taken_vol"] + df["adjusted_vol"]
+    df["diff"] = df["remain_vol"] - df["expected_vol"]
+    return df.reset_index()
+
+
+def _repair_lots(db: Session, lot_ids: List[str], tolerance: float, repaired_by: str) -> int:
+    """Lock the lots, recompute their expected balances under the lock and move remain_vol onto them.
+
+    Bags and adjustments lock a lot before drawing from it, so nothing can change
+    a locked lot between the recount and the move.
+    """
+    repaired = 0
+    for start in range(0, len(lot_ids), 1000):
+        chunk = lot_ids[start:start + 1000]
+        locked = lock_lots(db, chunk)
+        for row in _expected_balances(db, chunk).itertuples():
+            lot = locked.get(row.intake_lot_id)
+            if lot is None:
+                continue
+            delta = row.expected_vol - (lot.remain_vol or 0.0)
+            if abs(delta) > tolerance:
+                move_stock(db, lot, delta, "reconcile", reason="Reconciliation", moved_by=repaired_by)
+                repaired += 1
+    return repaired
+
+
+def reconcile_inventory(db: Session, tolerance: float = 1e-4, repair: bool = False,
+                        repaired_by: str = "reconcile") -> dict:
+    """Compare every lot's remain_vol with its expected balance; optionally move it to the expected value.
+
+    The report reads without locks; a repair re-checks each differing lot under
+    its row lock, so bags committed in between are not lost.
+
+    Returns {"lots_checked", "discrepancies": [...], "total_abs_diff", "repaired"}.
+    """
+    df = _expected_balances(db)
+    bad = df[df["diff"].abs() > tolerance].sort_values("diff", key=lambda s: s.abs(), ascending=False)
+    out = bad[RECONCILE_COLUMNS].round(6).astype(object)
+    discrepancies: List[dict] = out.where(out.notna(), None).to_dict("records")
+
+    repaired = 0
+    if repair and discrepancies:
+        lot_ids = sorted(bad["intake_lot_id"])
+        # End the report's read so the recount after the locks sees every committed bag
+        db.rollback()
+        try:
+            repaired = run_in_transaction(db, lambda: _repair_lots(db, lot_ids, tolerance, repaired_by))
+        except SQLAlchemyError as e:
+            db.rollback()
+            logger.error("Error repairing inventory: %s", e)
+            raise RuntimeError(f"Database error: {e}")
+        logger.info("Reconciliation repaired %d lots", repaired)
+
+    return {
+        "lots_checked": len(df),
+        "discrepancies": discrepancies,
+        "total_abs_diff": round(float(bad["diff"].abs().sum()), 6),
+        "repaired": repaired,
+    }
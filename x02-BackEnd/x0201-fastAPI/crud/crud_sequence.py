@@ -0,0 +1,78 @@
+import logging
+import sys
+from datetime import date
+from pathlib import Path
+
+# Ensure parent dir (x0201-fastAPI/) is on sys.path so models/schemas resolve
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from sqlalchemy.exc import IntegrityError  # type: ignore[import-untyped]
+from sqlalchemy.orm import Session  # type: ignore[import-untyped]
+from typing import Callable, Optional
+import models  # type: ignore[import-untyped]
+
+logger = logging.getLogger(__name__)
+
+# Numbered IDs (plan_id, intake_lot_id) come from one id_sequences row per
+# (kind, scope, day). allocate_ids() locks that row and moves next_value past a
+# whole block, so a bulk caller needs one round trip however many IDs it takes
+# and two callers can never be handed the same number. The row stays locked
+# until the caller's transaction ends: allocate first, commit soon. A rolled-back
+# transaction gives its block back.
+
+
+def _lock_sequence(db: Session, kind: str, scope: str, day: date) -> Optional[models.IdSequence]:
+    S = models.IdSequence
+    return (
+        db.query(S)
+        .filter(S.kind == kind, S.scope == scope, S.day == day)
+        .with_for_update()
+        .populate_existing()
+        .first()
+    )
+
+
+def allocate_ids(
+    db: Session,
+    kind: str,
+    count: int = 1,
+    scope: str = "",
+    day: Optional[date] = None,
+    seed: Optional[Callable[[], int]] = None,
+) -> range:
+    """Reserve `count` consecutive numbers of the (kind, scope, day) series.
+
+    `seed()` returns the highest number already in use for the series (IDs made
+    before the series existed); it is only called when the row is first created.
+    """
+    if count < 1:
+        raise ValueError("count must be at least 1")
+    day = day or date.today()
+    seq = _lock_sequence(db, kind, scope, day)
+    if seq is None:
+        try:
+            with db.begin_nested():
+                db.add(models.IdSequence(kind=kind, scope=scope, day=day, next_value=(seed() if seed else 0) + 1))
+        except IntegrityError:
+            pass  # Created by a concurrent transaction; lock that row instead
+        seq = _lock_sequence(db, kind, scope, day)
+    first = seq.next_value
+    seq.next_value = first + count
+    db.flush()
+    return range(first, first + count)
+
+
+def peek_next_id(
+    db: Session,
+    kind: str,
+    scope: str = "",
+    day: Optional[date] = None,
+    seed: Optional[Callable[[], int]] = None,
+) -> int:
+    """Number the next allocate_ids() call would hand out, without reserving it or locking anything."""
+    day = day or date.today()
+    S = models.IdSequence
+    next_value = db.query(S.next_value).filter(S.kind == kind, S.scope == scope, S.day == day).scalar()
+    if next_value is not None:
+        return next_value
+    return (seed() if seed else 0) + 1
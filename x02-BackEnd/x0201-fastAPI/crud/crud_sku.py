@@ -1,8 +1,9 @@
 from sqlalchemy.orm import Session, joinedload
 from sqlalchemy.exc import IntegrityError, SQLAlchemyError
-from typing import Optional, List
+from typing import Dict, Optional, List
 import models
 import schemas
+import report_cache
 
 # Sku CRUD
 def get_sku_by_sku_id(db: Session, sku_id: str) -> Optional[models.Sku]:
@@ -65,6 +66,7 @@ def update_sku(db: Session, sku_db_id: int, sku_update: schemas.SkuCreate) -> Op
         if 'steps' in sku_update.dict(exclude_unset=True):
             # Delete existing steps using sku_id (string)
             db.query(models.SkuStep).filter(models.SkuStep.sku_id == db_sku.sku_id).delete()
+            report_cache.touch(db, report_cache.sku_scope(db_sku.sku_id))
             
             if sku_update.steps:
                 for step in sku_update.steps:
@@ -139,6 +141,27 @@ def duplicate_sku(db: Session, dup_data: schemas.SkuDuplicate) -> models.Sku:
         db.rollback()
         raise e
 
+# SkuStep tolerances
+def get_sku_tolerances(db: Session, sku_id: str) -> Dict[str, Optional[float]]:
+    """re_code -> high_tol of the SKU's first step for that ingredient.
+
+    Cached per SKU until one of its steps is written (see report_cache). The
+    returned dict is shared between requests and must not be mutated.
+    """
+    def compute(session: Session) -> Dict[str, Optional[float]]:
+        rows = (
+            session.query(models.SkuStep.re_code, models.SkuStep.high_tol)
+            .filter(models.SkuStep.sku_id == sku_id)
+            .order_by(models.SkuStep.id)
+            .all()
+        )
+        tolerances: Dict[str, Optional[float]] = {}
+        for re_code, high_tol in rows:
+            tolerances.setdefault(re_code, high_tol)
+        return tolerances
+
+    return report_cache.get_or_compute(db, "sku-tolerances", sku_id, [report_cache.sku_scope(sku_id)], compute)
+
 # SkuAction CRUD
 def get_sku_actions(db: Session, skip: int = 0, limit: int = 100) -> List[models.SkuAction]:
     return db.query(models.SkuAction).offset(skip).limit(limit).all()
@@ -0,0 +1,136 @@
+"""
+Lot Reservations
+================
+Soft, in-process holds on lot volume while a station is weighing.
+
+A reservation (lot, volume, station, ref, expires_at) does not touch
+remain_vol; it only lowers the lot's available-to-promise
+(remain_vol − reserved) seen by the FEFO allocator, lot lookup and other
+stations' reservations. Holds end in one of three ways:
+
+- TTL: expired entries are dropped on the next access
+- explicit release (DELETE /allocations/reservations/{id})
+- commit: a bag drawing from the lot with batch_record_id or batch_id equal to
+  the reservation's `ref` draws the hold down by the volume taken, once the
+  bag's transaction commits (rolled-back bags keep the hold)
+
+The store is per process; main.py runs a single uvicorn worker.
+"""
+import threading
+import uuid
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional
+
+from sqlalchemy import event  # type: ignore[import-untyped]
+from sqlalchemy.orm import Session  # type: ignore[import-untyped]
+
+DEFAULT_TTL_S = 300
+MAX_TTL_S = 3600
+EPS = 1e-6
+
+_PENDING_KEY = "lot_reservation_draws"
+
+_lock = threading.Lock()
+_reservations: Dict[str, dict] = {}
+
+
+def _purge(now: datetime) -> None:
+    for rid in [rid for rid, r in _reservations.items() if r["expires_at"] <= now]:
+        del _reservations[rid]
+
+
+def _reserved(lot_ids: Optional[Iterable[str]], exclude_station: Optional[str]) -> Dict[str, float]:
+    wanted = set(lot_ids) if lot_ids is not None else None
+    totals: Dict[str, float] = {}
+    for r in _reservations.values():
+        if wanted is not None and r["intake_lot_id"] not in wanted:
+            continue
+        if exclude_station is not None and r["station"] == exclude_station:
+            continue
+        totals[r["intake_lot_id"]] = totals.get(r["intake_lot_id"], 0.0) + r["volume"]
+    return totals
+
+
+# ---------------------------------------------------------------------------
+# Reserve / release
+# ---------------------------------------------------------------------------
+
+def reserve(intake_lot_id: str, volume: float, station: str, remain_vol: float,
+            ref: Optional[str] = None, ttl_s: int = DEFAULT_TTL_S) -> dict:
+    """Hold `volume` of a lot for `station`; ValueError if available-to-promise is short."""
+    now = datetime.now()
+    ttl_s = max(1, min(ttl_s, MAX_TTL_S))
+    with _lock:
+        _purge(now)
+        available = (remain_vol or 0.0) - _reserved([intake_lot_id], None).get(intake_lot_id, 0.0)
+        if volume > available + EPS:
+            raise ValueError(f"Only {round(max(available, 0.0), 6)} available on lot '{intake_lot_id}'")
+        reservation = {
+            "id": uuid.uuid4().hex,
+            "intake_lot_id": intake_lot_id,
+            "volume": volume,
+            "station": station,
+            "ref": ref,
+            "created_at": now,
+            "expires_at": now + timedelta(seconds=ttl_s),
+        }
+        _reservations[reservation["id"]] = reservation
+        return dict(reservation)
+
+
+def release(reservation_id: str) -> bool:
+    with _lock:
+        return _reservations.pop(reservation_id, None) is not None
+
+
+def reserved_volumes(lot_ids: Optional[Iterable[str]] = None, exclude_station: Optional[str] = None) -> Dict[str, float]:
+    """Live reserved volume per lot, optionally ignoring one station's own holds."""
+    with _lock:
+        _purge(datetime.now())
+        return _reserved(lot_ids, exclude_station)
+
+
+def list_reservations(intake_lot_id: Optional[str] = None, station: Optional[str] = None) -> List[dict]:
+    with _lock:
+        _purge(datetime.now())
+        return [dict(r) for r in _reservations.values()
+                if (intake_lot_id is None or r["intake_lot_id"] == intake_lot_id)
+                and (station is None or r["station"] == station)]
+
+
+def clear() -> None:
+    with _lock:
+        _reservations.clear()
+
+
+# ---------------------------------------------------------------------------
+# Release on commit
+# ---------------------------------------------------------------------------
+
+def draw_on_commit(db: Session, intake_lot_id: str, refs: Iterable[Optional[str]], volume: float) -> None:
+    """Queue a bag's take against holds on `intake_lot_id` whose ref is in `refs`."""
+    db.info.setdefault(_PENDING_KEY, []).append((intake_lot_id, {r for r in refs if r}, volume or 0.0))
+
+
+@event.listens_for(Session, "after_commit")
+def _apply_draws(db: Session) -> None:
+    draws = db.info.pop(_PENDING_KEY, None)
+    if not draws:
+        return
+    with _lock:
+        for intake_lot_id, refs, volume in draws:
+            for r in sorted(_reservations.values(), key=lambda r: r["created_at"]):
+                if volume <= EPS:
+                    break
+                if r["intake_lot_id"] != intake_lot_id or r["ref"] not in refs:
+                    continue
+                taken = min(r["volume"], volume)
+                r["volume"] -= taken
+                volume -= taken
+                if r["volume"] <= EPS:
+                    del _reservations[r["id"]]
+
+
+@event.listens_for(Session, "after_rollback")
+def _drop_draws(db: Session) -> None:
+    db.info.pop(_PENDING_KEY, None)
@@ -15,6 +15,7 @@ Routers:
 - plants_router: /plants/*
 - monitoring_router: /server-status/*
 - views_router: /api/v_* (database views)
+- allocations_router: /allocations/* (FEFO lot allocation)
 
 Author: xDev
 Version: 1.0.0
@@ -42,7 +43,8 @@ from routers import (
     warehouses_router,
     translations_router,
     stock_adjustments_router,
-    reports_router
+    reports_router,
+    allocations_router
 )
 
 # =============================================================================
@@ -80,6 +82,8 @@ app.add_middleware(
     allow_credentials=False,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "Idempotent-Replay", "ETag", "X-Sync-Token", "X-Deleted-Plans",
+                    "X-Sync-Reset"],
 )
 
 # =============================================================================
@@ -92,7 +96,7 @@ all_routers = [
     production_router, plants_router, monitoring_router,
     views_router, warehouses_router, translations_router,
     stock_adjustments_router,
-    reports_router
+    reports_router, allocations_router
 ]
 
 for router in all_routers:
@@ -5,7 +5,7 @@ All database tables and read-only views for the xMixing system.
 """
 from sqlalchemy import (  # type: ignore[import-untyped]
     Column, Integer, String, Enum, TIMESTAMP, text, DateTime,
-    JSON, Float, ForeignKey, Date, Boolean, func,
+    JSON, Float, ForeignKey, Date, Boolean, Index, UniqueConstraint, func,
 )
 from sqlalchemy.orm import relationship  # type: ignore[import-untyped]
 from database import Base  # type: ignore[import-untyped]
@@ -119,6 +119,13 @@ class IngredientIntakeList(Base):
     history = relationship("IngredientIntakeHistory", back_populates="intake_record", cascade="all, delete-orphan")
     packages = relationship("IntakePackageReceive", back_populates="intake_record", cascade="all, delete-orphan")
 
+    __table_args__ = (
+        # Active-stock scans (expiry alert): status equality, expire_date range, remain_vol > 0 from the index
+        Index("ix_intake_active_expiry", "status", "expire_date", "remain_vol"),
+        # FEFO allocation: lots of one ingredient in expiry order
+        Index("ix_intake_fefo", "re_code", "expire_date", "remain_vol"),
+    )
+
 
 class IngredientIntakeHistory(Base):
     __tablename__ = "ingredient_intake_history"
@@ -279,6 +286,12 @@ class ProductionPlan(Base):
     updated_at = Column(TIMESTAMP, server_default=text("CURRENT_TIMESTAMP"), onupdate=func.now())
     batches = relationship("ProductionBatch", back_populates="plan", cascade="all, delete-orphan")
 
+    __table_args__ = (
+        # GET /production-plans/: keyset pages and updated_since deltas
+        Index("ix_plans_created_id", "created_at", "id"),
+        Index("ix_plans_updated_at", "updated_at"),
+    )
+
 
 class ProductionBatch(Base):
     __tablename__ = "production_batches"
@@ -302,10 +315,19 @@ class ProductionBatch(Base):
     fh_delivered_by = Column(String(50), nullable=True)
     spp_delivered_at = Column(TIMESTAMP, nullable=True)   # SPP delivered to Production Hall
     spp_delivered_by = Column(String(50), nullable=True)
+    # Pre-batch progress, kept in step with prebatch_reqs/recs by crud_prebatch
+    reqs_total = Column(Integer, default=0)
+    reqs_completed = Column(Integer, default=0)
+    bags_weighed = Column(Integer, default=0)
     created_at = Column(TIMESTAMP, server_default=text("CURRENT_TIMESTAMP"))
     updated_at = Column(TIMESTAMP, server_default=text("CURRENT_TIMESTAMP"), onupdate=func.now())
     plan = relationship("ProductionPlan", back_populates="batches")
 
+    __table_args__ = (
+        # Plans whose batches changed since a delta-sync token
+        Index("ix_batches_updated_plan", "updated_at", "plan_id"),
+    )
+
 
 # ── PreBatch ─────────────────────────────────────────────────────────────────
 
@@ -320,10 +342,18 @@ class PreBatchReq(Base):
     required_volume = Column(Float)
     wh = Column(String(50))
     status = Column(Integer, default=0)  # 0=Pending, 1=In-Progress, 2=Completed
+    # Weighed so far, kept in step with prebatch_recs by crud_prebatch
+    packaged_volume = Column(Float, default=0.0)
+    bag_count = Column(Integer, default=0)
     created_at = Column(TIMESTAMP, server_default=text("CURRENT_TIMESTAMP"))
     updated_at = Column(TIMESTAMP, server_default=text("CURRENT_TIMESTAMP"), onupdate=func.now())
     batch = relationship("ProductionBatch", backref="reqs")
 
+    __table_args__ = (
+        # Plans whose requirements changed since a delta-sync token
+        Index("ix_reqs_updated_plan", "updated_at", "plan_id"),
+    )
+
 
 class PreBatchRec(Base):
     __tablename__ = "prebatch_recs"
@@ -331,6 +361,7 @@ class PreBatchRec(Base):
     req_id = Column(Integer, ForeignKey("prebatch_reqs.id"), nullable=True)
     batch_record_id = Column(String(100), unique=True, nullable=False, index=True)
     plan_id = Column(String(50), index=True)
+    batch_id = Column(String(100), nullable=True)   # batch part of batch_record_id, set on write (see barcodes)
     re_code = Column(String(50), index=True)
     package_no = Column(Integer)
     total_packages = Column(Integer)
@@ -351,6 +382,11 @@ class PreBatchRec(Base):
     req = relationship("PreBatchReq", backref="recs")
     origins = relationship("PreBatchRecFrom", back_populates="prebatch_rec", cascade="all, delete-orphan")
 
+    __table_args__ = (
+        # Bag lookups by batch (recheck box, packing, batch record) and by barcode parts
+        Index("ix_prebatch_recs_batch_re_pkg", "batch_id", "re_code", "package_no"),
+    )
+
 
 class PreBatchRecFrom(Base):
     __tablename__ = "prebatch_rec_from"
@@ -363,6 +399,99 @@ class PreBatchRecFrom(Base):
     prebatch_rec = relationship("PreBatchRec", back_populates="origins")
 
 
+class PreBatchBox(Base):
+    """One warehouse box of a batch; counters kept in step with its bags by crud_box."""
+    __tablename__ = "prebatch_boxes"
+    id = Column(Integer, primary_key=True, index=True)
+    batch_db_id = Column(Integer, ForeignKey("production_batches.id"), nullable=False)
+    batch_id = Column(String(100), nullable=False, index=True)
+    plan_id = Column(String(50), index=True)
+    wh = Column(String(20), nullable=False)                # prebatch_reqs.wh of the bags it holds
+    expected_bags = Column(Integer, default=0)             # total_packages of each weighed requirement
+    bag_count = Column(Integer, default=0)
+    packed_count = Column(Integer, default=0)
+    recheck_ok = Column(Integer, default=0)
+    recheck_error = Column(Integer, default=0)
+    closed_at = Column(TIMESTAMP, nullable=True)
+    closed_by = Column(String(50), nullable=True)
+    created_at = Column(TIMESTAMP, server_default=text("CURRENT_TIMESTAMP"))
+    updated_at = Column(TIMESTAMP, server_default=text("CURRENT_TIMESTAMP"), onupdate=func.now())
+
+    __table_args__ = (
+        UniqueConstraint("batch_db_id", "wh", name="uq_prebatch_box_batch_wh"),
+    )
+
+
+class IdSequence(Base):
+    """Next free number of one ID series, e.g. ("plan", "P001", 2026-03-05). Allocated by crud_sequence."""
+    __tablename__ = "id_sequences"
+    kind = Column(String(30), primary_key=True)
+    scope = Column(String(50), primary_key=True, default="")
+    day = Column(Date, primary_key=True)
+    next_value = Column(Integer, nullable=False, default=1)
+    updated_at = Column(TIMESTAMP, server_default=text("CURRENT_TIMESTAMP"), onupdate=func.now())
+
+
+class SyncTombstone(Base):
+    """A deleted plan, batch or requirement, for GET /production-plans/ deltas. Written by plan_sync."""
+    __tablename__ = "sync_tombstones"
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    table_name = Column(String(50), nullable=False)   # "*": rows were wiped outside the ORM, clients reload
+    row_id = Column(Integer, nullable=True)
+    plan_db_id = Column(Integer, nullable=True)       # production_plans.id, when known without a load
+    plan_code = Column(String(50), nullable=True)     # production_plans.plan_id, when known without a load
+    deleted_at = Column(TIMESTAMP, server_default=text("CURRENT_TIMESTAMP"), index=True)
+
+
+class IdempotencyKey(Base):
+    """Client Idempotency-Key of a POST /prebatch-recs/, written in the bag's own transaction."""
+    __tablename__ = "idempotency_keys"
+    key = Column(String(100), primary_key=True)
+    request_hash = Column(String(64), nullable=False)
+    prebatch_rec_id = Column(Integer, nullable=False, index=True)
+    created_at = Column(TIMESTAMP, server_default=text("CURRENT_TIMESTAMP"))
+
+
+# ── Traceability ─────────────────────────────────────────────────────────────
+
+class BatchGenealogy(Base):
+    """Lot → prebatch bag → batch/plan edges, maintained by the prebatch rec CRUD path."""
+    __tablename__ = "batch_genealogy"
+    __table_args__ = (
+        Index("ix_batch_genealogy_lot_batch", "intake_lot_id", "batch_id"),
+        Index("ix_batch_genealogy_batch_lot", "batch_id", "intake_lot_id"),
+    )
+    id = Column(Integer, primary_key=True, index=True)
+    intake_lot_id = Column(String(50), nullable=False)
+    prebatch_rec_id = Column(Integer, ForeignKey("prebatch_recs.id"), nullable=False, index=True)
+    batch_record_id = Column(String(100))
+    batch_id = Column(String(100))
+    plan_id = Column(String(50), index=True)
+    re_code = Column(String(50))
+    mat_sap_code = Column(String(50))
+    wh = Column(String(50))            # Box = batch_id + wh
+    take_volume = Column(Float, nullable=False)
+    created_at = Column(TIMESTAMP, server_default=text("CURRENT_TIMESTAMP"))
+
+
+# ── Reporting Rollups ────────────────────────────────────────────────────────
+
+class DailyIngredientConsumption(Base):
+    """Per-day consumption rollup, maintained by the prebatch rec CRUD path."""
+    __tablename__ = "daily_ingredient_consumption"
+    __table_args__ = (
+        UniqueConstraint("consumption_date", "plant", "mat_sap_code", "re_code", name="uq_daily_consumption_key"),
+    )
+    id = Column(Integer, primary_key=True, index=True)
+    consumption_date = Column(Date, nullable=False, index=True)
+    plant = Column(String(50), nullable=False, default="")
+    mat_sap_code = Column(String(50), nullable=False, default="")
+    re_code = Column(String(50), nullable=False, default="")
+    total_volume = Column(Float, nullable=False, default=0)
+    txn_count = Column(Integer, nullable=False, default=0)
+    updated_at = Column(TIMESTAMP, server_default=text("CURRENT_TIMESTAMP"), onupdate=func.now())
+
+
 # ── Reference Tables ─────────────────────────────────────────────────────────
 
 class Plant(Base):
@@ -406,6 +535,48 @@ class StockAdjustment(Base):
     adjusted_at = Column(TIMESTAMP, server_default=text("CURRENT_TIMESTAMP"))
 
 
+# ── Stock Ledger ─────────────────────────────────────────────────────────────
+
+class StockLedger(Base):
+    """Append-only log of every remain_vol change of an intake lot."""
+    __tablename__ = "stock_ledger"
+    id = Column(Integer, primary_key=True, index=True)
+    ts = Column(TIMESTAMP, nullable=False, server_default=text("CURRENT_TIMESTAMP"))
+    intake_lot_id = Column(String(50), nullable=False)
+    mat_sap_code = Column(String(50))
+    re_code = Column(String(50))
+    material_description = Column(String(200))
+    movement_type = Column(String(20), nullable=False)  # intake | intake_edit | intake_delete | prebatch | prebatch_restore | adjustment | reconcile
+    direction = Column(String(10), nullable=False)      # 'increase' or 'decrease'
+    qty = Column(Float, nullable=False)
+    prev_vol = Column(Float)
+    new_vol = Column(Float)
+    reason = Column(String(50))
+    remark = Column(String(255))
+    moved_by = Column(String(50))
+    reference = Column(String(100))                     # batch_record_id for prebatch movements
+
+    __table_args__ = (
+        Index("ix_stock_ledger_lot_ts", "intake_lot_id", "ts"),
+        Index("ix_stock_ledger_re_code_ts", "re_code", "ts"),
+        Index("ix_stock_ledger_ts_id", "ts", "id"),
+    )
+
+
+class StockSnapshot(Base):
+    """End-of-day remain_vol per lot, written only for lots that moved that day."""
+    __tablename__ = "stock_snapshots"
+    id = Column(Integer, primary_key=True, index=True)
+    snapshot_date = Column(Date, nullable=False, index=True)
+    intake_lot_id = Column(String(50), nullable=False)
+    remain_vol = Column(Float, nullable=False)
+    created_at = Column(TIMESTAMP, server_default=text("CURRENT_TIMESTAMP"))
+
+    __table_args__ = (
+        UniqueConstraint("intake_lot_id", "snapshot_date", name="uq_stock_snapshot_lot_date"),
+    )
+
+
 # ── Database Views (Read-Only) ───────────────────────────────────────────────
 
 class VSkuMasterDetail(Base):
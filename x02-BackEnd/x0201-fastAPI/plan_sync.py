@@ -0,0 +1,61 @@
+"""
+Plan Sync
+=========
+Deletions for the `updated_since` deltas of GET /production-plans/.
+
+A delta only finds rows by their updated_at, so a deleted row would never
+reach a client. Every flush that deletes a plan, batch or requirement writes a
+sync_tombstones row instead: a deleted plan is reported to the client by id,
+and a plan that lost a batch or requirement is sent again in full.
+
+Deletes that bypass the ORM (raw SQL in maintenance scripts) must call
+`record_reset()`, or insert a sync_tombstones row with table_name "*" when
+the script does not import the app; a delta spanning a reset tells the
+client to reload the whole list, since ids may have been reused.
+"""
+from datetime import datetime
+from typing import List, Tuple
+
+from sqlalchemy import event, insert, text  # type: ignore[import-untyped]
+from sqlalchemy.orm import Session  # type: ignore[import-untyped]
+
+import models  # type: ignore[import-untyped]
+
+RESET = "*"
+
+
+def _tombstone(obj):
+    if isinstance(obj, models.ProductionPlan):
+        return models.SyncTombstone(table_name="production_plans", row_id=obj.id, plan_db_id=obj.id,
+                                    plan_code=obj.plan_id)
+    if isinstance(obj, models.ProductionBatch):
+        return models.SyncTombstone(table_name="production_batches", row_id=obj.id, plan_db_id=obj.plan_id)
+    if isinstance(obj, models.PreBatchReq):
+        return models.SyncTombstone(table_name="prebatch_reqs", row_id=obj.id, plan_code=obj.plan_id)
+    return None
+
+
+@event.listens_for(Session, "before_flush")
+def _record_deletes(db: Session, flush_context, instances) -> None:
+    for obj in list(db.deleted):
+        tombstone = _tombstone(obj)
+        if tombstone is not None:
+            db.add(tombstone)
+
+
+def record_reset(conn) -> None:
+    """Mark every client's plan list as stale (after raw-SQL deletes on `conn`)."""
+    conn.execute(insert(models.SyncTombstone).values(table_name=RESET))
+
+
+def deletions_since(db: Session, since: datetime) -> Tuple[bool, List[int]]:
+    """(reset, deleted plan ids) recorded at or after `since`."""
+    # Raw SQL, bound like the rest of the delta query (the ORM TIMESTAMP type
+    # adds microseconds on SQLite, which would skip same-second tombstones)
+    rows = db.execute(text("""
+        SELECT table_name, row_id FROM sync_tombstones
+        WHERE deleted_at >= :since AND table_name IN (:reset, 'production_plans')
+    """), {"since": since, "reset": RESET}).fetchall()
+    if any(r.table_name == RESET for r in rows):
+        return True, []
+    return False, sorted({r.row_id for r in rows})
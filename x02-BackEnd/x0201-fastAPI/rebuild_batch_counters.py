@@ -0,0 +1,26 @@
+from database import SessionLocal
+from crud.crud_box import rebuild_boxes
+from crud.crud_prebatch import rebuild_batch_counters, rebuild_req_progress
+
+
+def rebuild():
+    db = SessionLocal()
+    try:
+        print("Recounting production_batches.reqs_total / reqs_completed / bags_weighed...")
+        count = rebuild_batch_counters(db)
+        print(f"Successfully updated {count} batches.")
+        print("Recounting prebatch_reqs.packaged_volume / bag_count...")
+        count = rebuild_req_progress(db)
+        print(f"Successfully updated {count} requirements.")
+        print("Recounting prebatch_boxes...")
+        count = rebuild_boxes(db)
+        print(f"Successfully updated {count} boxes.")
+    except Exception as e:
+        db.rollback()
+        print(f"Error during rebuild: {e}")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    rebuild()
@@ -0,0 +1,39 @@
+"""
+Backfill daily_ingredient_consumption from batch_genealogy.
+
+Usage:
+    python rebuild_daily_consumption.py                      # full rebuild
+    python rebuild_daily_consumption.py 2026-01-01 2026-01-31  # date range only
+"""
+import sys
+from datetime import date
+
+import models
+from database import Base, SessionLocal, engine
+from crud.crud_genealogy import rebuild_genealogy
+from crud.crud_consumption import rebuild_daily_consumption
+
+
+def rebuild(date_from=None, date_to=None):
+    Base.metadata.create_all(bind=engine, tables=[
+        models.BatchGenealogy.__table__,
+        models.DailyIngredientConsumption.__table__,
+    ])
+    db = SessionLocal()
+    try:
+        if db.query(models.BatchGenealogy.id).first() is None:
+            print("batch_genealogy is empty, rebuilding it first...")
+            rebuild_genealogy(db)
+        print(f"Rebuilding daily_ingredient_consumption ({date_from or 'start'} → {date_to or 'today'})...")
+        count = rebuild_daily_consumption(db, date_from, date_to)
+        print(f"Successfully wrote {count} rollup rows.")
+    except Exception as e:
+        db.rollback()
+        print(f"Error during rebuild: {e}")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    args = [date.fromisoformat(a) for a in sys.argv[1:3]]
+    rebuild(*args)
@@ -0,0 +1,21 @@
+import models  # noqa: F401  (registers batch_genealogy on Base)
+from database import Base, SessionLocal, engine
+from crud.crud_genealogy import rebuild_genealogy
+
+
+def rebuild():
+    Base.metadata.create_all(bind=engine, tables=[models.BatchGenealogy.__table__])
+    db = SessionLocal()
+    try:
+        print("Rebuilding batch_genealogy from prebatch_recs / prebatch_rec_from...")
+        count = rebuild_genealogy(db)
+        print(f"Successfully wrote {count} genealogy edges.")
+    except Exception as e:
+        db.rollback()
+        print(f"Error during rebuild: {e}")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    rebuild()
@@ -0,0 +1,35 @@
+"""
+Check every intake lot's remain_vol against intake − pre-batch takes ± adjustments.
+
+Usage:
+    python reconcile_inventory.py           # report discrepancies
+    python reconcile_inventory.py --repair  # also set remain_vol to the expected balance
+"""
+import sys
+import time
+
+from database import SessionLocal
+from crud.crud_reconcile import reconcile_inventory
+
+
+def reconcile(repair=False):
+    db = SessionLocal()
+    try:
+        started = time.perf_counter()
+        result = reconcile_inventory(db, repair=repair)
+        for d in result["discrepancies"][:50]:
+            print(f"  {d['intake_lot_id']:<30} remain={d['remain_vol']:>12.4f} expected={d['expected_vol']:>12.4f} diff={d['diff']:>+10.4f}")
+        if len(result["discrepancies"]) > 50:
+            print(f"  ... {len(result['discrepancies']) - 50} more")
+        print(f"Checked {result['lots_checked']} lots in {time.perf_counter() - started:.2f}s: "
+              f"{len(result['discrepancies'])} discrepancies (total |diff| {result['total_abs_diff']}), "
+              f"{result['repaired']} repaired.")
+    except Exception as e:
+        db.rollback()
+        print(f"Error during reconciliation: {e}")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    reconcile(repair="--repair" in sys.argv)
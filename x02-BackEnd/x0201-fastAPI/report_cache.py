@@ -0,0 +1,220 @@
+"""
+Report Cache
+============
+In-process cache for report payloads, keyed by (report, params, data version).
+
+Each cached report names the scopes it reads: "plan:<plan_id>" for a plan's
+batches, reqs and bags, "sku:<sku_id>" for a SKU's recipe steps, and "intake"
+for inventory lots. Every flush that
+touches one of those tables records the affected scopes on the session, and
+their watermarks are bumped once the transaction commits. A lookup only hits
+when the watermarks stored with the entry still match the current ones, so a
+result computed before a commit is never served after it.
+
+Writes that bypass the ORM (raw SQL, bulk statements) must call `touch()`.
+
+Polled summaries that read whole tables (dashboard counters) use
+`get_or_compute_ttl()` instead: a value lives for a fixed TTL, and concurrent
+misses on one key wait for a single computation rather than all hitting the
+database at once. A waiter gives up after TTL_WAIT_S and computes on its own,
+so one stuck computation cannot hang every poller. The two caches keep
+separate hit/miss counters.
+
+The cache is per process; main.py runs a single uvicorn worker.
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Iterable, Iterator, Set, Tuple
+
+from sqlalchemy import event, inspect  # type: ignore[import-untyped]
+from sqlalchemy.orm import Session  # type: ignore[import-untyped]
+
+import models  # type: ignore[import-untyped]
+
+MAX_ENTRIES = 256
+TTL_WAIT_S = 10.0  # longest a TTL miss waits for another caller's computation
+ALL = "*"  # bumping this scope invalidates every entry
+INTAKE = "intake"
+
+_PENDING_KEY = "report_cache_scopes"
+
+_lock = threading.Lock()
+_versions: Dict[str, int] = {}
+_entries: "OrderedDict[Tuple[str, Hashable], Tuple[tuple, Any]]" = OrderedDict()
+_stats = {"hits": 0, "misses": 0}
+_ttl_stats = {"hits": 0, "misses": 0, "wait_timeouts": 0}
+_ttl_entries: Dict[Hashable, Tuple[float, Any]] = {}
+_ttl_inflight: Dict[Hashable, threading.Event] = {}
+
+
+def plan_scope(plan_id: str) -> str:
+    return f"plan:{plan_id}"
+
+
+def sku_scope(sku_id: str) -> str:
+    return f"sku:{sku_id}"
+
+
+# ---------------------------------------------------------------------------
+# Watermarks
+# ---------------------------------------------------------------------------
+
+def touch(db: Session, *scopes: str) -> None:
+    """Mark scopes as changed by the current transaction (bumped on commit)."""
+    db.info.setdefault(_PENDING_KEY, set()).update(scopes)
+
+
+def _snapshot(scopes: Tuple[str, ...]) -> tuple:
+    return tuple(_versions.get(s, 0) for s in (ALL, *scopes))
+
+
+def _attr_values(obj, attr: str) -> Iterator:
+    """Current and pre-change values of `attr`, so moves invalidate both sides."""
+    hist = inspect(obj).attrs[attr].history
+    values = (*hist.unchanged, *hist.added, *hist.deleted)
+    if not values:
+        # Expired by an earlier commit and not reloaded since: load it now
+        values = (getattr(obj, attr),)
+    for val in values:
+        if val is not None:
+            yield val
+
+
+def _scopes_of(db: Session, obj) -> Set[str]:
+    if isinstance(obj, models.IngredientIntakeList):
+        return {INTAKE}
+    if isinstance(obj, (models.Sku, models.SkuStep)):
+        return {sku_scope(s) for s in _attr_values(obj, "sku_id")}
+    if isinstance(obj, (models.ProductionPlan, models.PreBatchReq, models.PreBatchRec)):
+        return {plan_scope(p) for p in _attr_values(obj, "plan_id")}
+    if isinstance(obj, models.ProductionBatch):
+        plan = obj.plan
+        if plan is None and obj.plan_id is not None:
+            plan = db.get(models.ProductionPlan, obj.plan_id)
+        return {plan_scope(plan.plan_id)} if plan is not None else {ALL}
+    if isinstance(obj, models.PreBatchRecFrom):
+        rec = obj.prebatch_rec
+        if rec is None and obj.prebatch_rec_id is not None:
+            rec = db.get(models.PreBatchRec, obj.prebatch_rec_id)
+        return {plan_scope(rec.plan_id)} if rec is not None and rec.plan_id else {ALL}
+    return set()
+
+
+@event.listens_for(Session, "before_flush")
+def _collect_scopes(db: Session, flush_context, instances) -> None:
+    scopes: Set[str] = set()
+    for obj in (*db.new, *db.dirty, *db.deleted):
+        scopes |= _scopes_of(db, obj)
+    if scopes:
+        touch(db, *scopes)
+
+
+@event.listens_for(Session, "after_commit")
+def _bump_scopes(db: Session) -> None:
+    scopes = db.info.pop(_PENDING_KEY, None)
+    if not scopes:
+        return
+    with _lock:
+        for s in scopes:
+            _versions[s] = _versions.get(s, 0) + 1
+
+
+# ---------------------------------------------------------------------------
+# Lookup
+# ---------------------------------------------------------------------------
+
+def get_or_compute(db: Session, report: str, params: Hashable, scopes: Iterable[str],
+                   compute: Callable[[Session], Any]) -> Any:
+    """Return the cached value for (report, params) or compute and store it.
+
+    On a miss `compute` runs on its own short-lived session bound to `db`'s
+    engine: its transaction starts after the watermarks are read, so the value
+    is at least as new as they are, and the caller's session (its loaded
+    objects, flushed work and row locks) is left alone. The returned value is
+    shared between requests and must not be mutated.
+    """
+    key = (report, params)
+    scopes = tuple(scopes)
+    with _lock:
+        snap = _snapshot(scopes)
+        entry = _entries.get(key)
+        if entry is not None and entry[0] == snap:
+            _entries.move_to_end(key)
+            _stats["hits"] += 1
+            return entry[1]
+        _stats["misses"] += 1
+
+    with Session(bind=db.get_bind()) as fresh:
+        value = compute(fresh)
+
+    with _lock:
+        # A commit landed while computing: keep the value out, the next call recomputes
+        if _snapshot(scopes) == snap:
+            _entries[key] = (snap, value)
+            _entries.move_to_end(key)
+            while len(_entries) > MAX_ENTRIES:
+                _entries.popitem(last=False)
+    return value
+
+
+def get_or_compute_ttl(key: Hashable, ttl_s: float, compute: Callable[[], Any],
+                       wait_s: float = TTL_WAIT_S) -> Any:
+    """Return the value computed for `key` less than `ttl_s` seconds ago, or compute it.
+
+    Only one caller computes a missing key; the others wait for its result. If
+    that computation fails, the next waiter takes over; if it is still running
+    after `wait_s`, a waiter computes the value itself without caching it. The
+    returned value is shared between requests and must not be mutated.
+    """
+    deadline = time.monotonic() + wait_s
+    while True:
+        with _lock:
+            entry = _ttl_entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                _ttl_stats["hits"] += 1
+                return entry[1]
+            pending = _ttl_inflight.get(key)
+            if pending is None:
+                pending = _ttl_inflight[key] = threading.Event()
+                _ttl_stats["misses"] += 1
+                break
+        if not pending.wait(max(0.0, deadline - time.monotonic())):
+            with _lock:
+                _ttl_stats["wait_timeouts"] += 1
+            return compute()
+
+    try:
+        value = compute()
+        with _lock:
+            _ttl_entries[key] = (time.monotonic() + ttl_s, value)
+        return value
+    finally:
+        with _lock:
+            del _ttl_inflight[key]
+        pending.set()
+
+
+def _hit_rate(counters: dict) -> float:
+    total = counters["hits"] + counters["misses"]
+    return round(counters["hits"] / total, 4) if total else 0.0
+
+
+def stats() -> dict:
+    """Counters of the report cache, with the TTL cache's own under "ttl"."""
+    with _lock:
+        return {
+            **_stats,
+            "hit_rate": _hit_rate(_stats),
+            "entries": len(_entries),
+            "max_entries": MAX_ENTRIES,
+            "ttl": {**_ttl_stats, "hit_rate": _hit_rate(_ttl_stats), "entries": len(_ttl_entries)},
+        }
+
+
+def clear() -> None:
+    with _lock:
+        _entries.clear()
+        _ttl_entries.clear()
+        _stats["hits"] = _stats["misses"] = 0
+        _ttl_stats["hits"] = _ttl_stats["misses"] = _ttl_stats["wait_timeouts"] = 0
@@ -0,0 +1,111 @@
+"""
+Report Export
+=============
+Streams report rows as CSV, NDJSON or XLSX.
+
+Rows are consumed lazily from an iterator, so memory stays flat as long as the
+caller feeds it from a server-side cursor (see router_reports).
+"""
+import csv
+import io
+import json
+import tempfile
+from datetime import date, datetime
+from itertools import chain
+from typing import Iterable, Iterator, List, Optional
+
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+
+EXPORT_FORMATS = {
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+}
+CHUNK_ROWS = 1000
+
+
+def check_format(fmt: Optional[str]) -> Optional[str]:
+    """Validate the `?format=` query value; None means the regular JSON response."""
+    if fmt is None:
+        return None
+    fmt = fmt.lower()
+    if fmt not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Invalid format: {fmt}. Must be one of {', '.join(EXPORT_FORMATS)}.")
+    return fmt
+
+
+def _cell(value):
+    """Flatten a value for tabular formats (CSV/XLSX)."""
+    if value is None:
+        return ""
+    if isinstance(value, (list, dict)):
+        return json.dumps(value, default=str)
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return value
+
+
+def _csv_chunks(rows: Iterable[dict], columns: List[str]) -> Iterator[str]:
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(columns)
+    for n, row in enumerate(rows, 1):
+        writer.writerow([_cell(row.get(c)) for c in columns])
+        if n % CHUNK_ROWS == 0:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate(0)
+    yield buf.getvalue()
+
+
+def _ndjson_chunks(rows: Iterable[dict]) -> Iterator[str]:
+    lines: List[str] = []
+    for row in rows:
+        lines.append(json.dumps(row, default=str))
+        if len(lines) >= CHUNK_ROWS:
+            yield "\n".join(lines) + "\n"
+            lines = []
+    if lines:
+        yield "\n".join(lines) + "\n"
+
+
+def _xlsx_chunks(rows: Iterable[dict], columns: List[str], title: str) -> Iterator[bytes]:
+    from openpyxl import Workbook
+
+    # write_only spools rows to disk instead of keeping a cell tree in memory
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(title[:31])
+    ws.append(columns)
+    for row in rows:
+        ws.append([_cell(row.get(c)) for c in columns])
+    with tempfile.TemporaryFile() as tmp:
+        wb.save(tmp)
+        tmp.seek(0)
+        while chunk := tmp.read(64 * 1024):
+            yield chunk
+
+
+def stream_export(rows: Iterable[dict], fmt: str, filename: str, columns: Optional[List[str]] = None) -> StreamingResponse:
+    """Wrap a row iterator in a StreamingResponse of the requested format.
+
+    If `columns` is omitted they are taken from the first row.
+    """
+    rows = iter(rows)
+    if columns is None:
+        first = next(rows, None)
+        columns = list(first.keys()) if first else []
+        rows = chain([first], rows) if first is not None else iter(())
+
+    if fmt == "csv":
+        body = _csv_chunks(rows, columns)
+    elif fmt == "ndjson":
+        body = _ndjson_chunks(rows)
+    else:
+        body = _xlsx_chunks(rows, columns, filename)
+
+    return StreamingResponse(
+        body,
+        media_type=EXPORT_FORMATS[fmt],
+        headers={"Content-Disposition": f'attachment; filename="{filename}.{fmt}"'},
+    )
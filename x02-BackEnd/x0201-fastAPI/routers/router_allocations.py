@@ -0,0 +1,73 @@
+"""
+Allocations Router
+==================
+Server-side lot selection for pre-batch weighing.
+
+`POST /allocations/fefo` splits the requested volume of each ingredient over
+active lots, first-expiry-first-out, so stations no longer download the whole
+intake table to pick lots themselves. The result is a plan only; stock moves
+when the bags are recorded.
+
+`/allocations/reservations` holds lot volume for a station while it weighs
+(see lot_reservations.py); the allocator and lot lookup leave held volume out.
+"""
+from fastapi import APIRouter, Depends, HTTPException
+from sqlalchemy.orm import Session  # type: ignore[import-untyped]
+
+from database import get_db  # type: ignore[import-untyped]
+import crud  # type: ignore[import-untyped]
+import lot_reservations  # type: ignore[import-untyped]
+import models  # type: ignore[import-untyped]
+import schemas  # type: ignore[import-untyped]
+
+router = APIRouter(prefix="/allocations", tags=["Allocations"])
+
+
+@router.post("/fefo")
+def allocate_fefo(payload: schemas.FefoRequest, db: Session = Depends(get_db)):
+    """FEFO multi-lot split for explicit lines, or for every open requirement of a batch/plan."""
+    needs = [line.model_dump() for line in payload.lines]
+    if payload.batch_id or payload.plan_id:
+        needs += crud.fefo_needs_for_batches(db, batch_id=payload.batch_id, plan_id=payload.plan_id)
+    if not needs:
+        raise HTTPException(status_code=400, detail="Nothing to allocate: give lines, batch_id or plan_id")
+    if payload.reserve and not payload.station:
+        raise HTTPException(status_code=400, detail="reserve needs a station")
+    try:
+        return crud.allocate_fefo(db, needs, include_expired=payload.include_expired, station=payload.station,
+                                  reserve=payload.reserve, ttl_s=payload.ttl_s)
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+
+# ── Lot Reservations ────────────────────────────────────────────────────────
+
+@router.post("/reservations", response_model=schemas.LotReservation, status_code=201)
+def create_reservation(payload: schemas.LotReservationCreate, db: Session = Depends(get_db)):
+    """Hold lot volume for a station until TTL, release, or the bag that uses it commits."""
+    lot = (
+        db.query(models.IngredientIntakeList)
+        .filter(models.IngredientIntakeList.intake_lot_id == payload.intake_lot_id)
+        .first()
+    )
+    if not lot:
+        raise HTTPException(status_code=404, detail=f"Lot '{payload.intake_lot_id}' not found")
+    try:
+        return lot_reservations.reserve(lot.intake_lot_id, payload.volume, payload.station, lot.remain_vol,
+                                        ref=payload.ref, ttl_s=payload.ttl_s)
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+
+@router.get("/reservations", response_model=list[schemas.LotReservation])
+def list_reservations(intake_lot_id: str | None = None, station: str | None = None):
+    """Live (unexpired) reservations, optionally for one lot or station."""
+    return lot_reservations.list_reservations(intake_lot_id=intake_lot_id, station=station)
+
+
+@router.delete("/reservations/{reservation_id}")
+def release_reservation(reservation_id: str):
+    """Release a reservation before its TTL."""
+    if not lot_reservations.release(reservation_id):
+        raise HTTPException(status_code=404, detail="Reservation not found")
+    return {"status": "success"}
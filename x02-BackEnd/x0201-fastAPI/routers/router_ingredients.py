@@ -199,8 +199,24 @@ def get_ingredient_intake_lists(skip: int = 0, limit: int = 1000, db: Session =
 
 @router.get("/ingredient-intake-next-id")
 def get_next_intake_id(db: Session = Depends(get_db)):
-    """Get next auto-generated intake ID."""
-    return {"next_id": crud.get_next_intake_id(db)}
+    """Preview the next auto-generated intake ID. Nothing is reserved.
+
+    Create the intake without intake_lot_id to have the ID assigned on save,
+    or POST here to reserve one up front.
+    """
+    try:
+        return {"next_id": crud.peek_next_intake_id(db)}
+    except RuntimeError:
+        raise HTTPException(status_code=500, detail="Database error")
+
+
+@router.post("/ingredient-intake-next-id")
+def reserve_next_intake_id(db: Session = Depends(get_db)):
+    """Reserve the next auto-generated intake ID; it is used up even if no intake is saved with it."""
+    try:
+        return {"next_id": crud.get_next_intake_id(db)}
+    except RuntimeError:
+        raise HTTPException(status_code=500, detail="Database error")
 
 
 @router.post("/migrate-add-intake-to")
@@ -289,6 +305,7 @@ async def bulk_import_ingredient_intake(file: UploadFile = File(...), db: Sessio
         reader = csv.DictReader(io.StringIO(decoded))
         imported_count = 0
         errors = []
+        rows = []
 
         for i, row in enumerate(reader):
             try:
@@ -307,8 +324,7 @@ async def bulk_import_ingredient_intake(file: UploadFile = File(...), db: Sessio
                     errors.append(f"Row {i+1}: Invalid volume numbers")
                     continue
 
-                item = schemas.IngredientIntakeListCreate(
-                    intake_lot_id=crud.get_next_intake_id(db),
+                rows.append((i, schemas.IngredientIntakeListCreate(
                     intake_from=row_clean.get('Storage Location') or row_clean.get('Storage Loca'),
                     mat_sap_code=mat_code,
                     re_code=row_clean.get('Re-Code'),
@@ -322,11 +338,18 @@ async def bulk_import_ingredient_intake(file: UploadFile = File(...), db: Sessio
                     status='Active',
                     intake_by='import',
                     manufacturing_date=parse_date_flexible(row_clean.get('Date of Manufacture'))
-                )
-                
-                crud.create_ingredient_intake_list(db, item)
+                )))
+
+            except Exception as e:
+                errors.append(f"Row {i+1}: {str(e)}")
+
+        # One sequence allocation for every row that passed validation above. A row
+        # the database then rejects leaves its number unused (a gap in the series).
+        intake_ids = crud.allocate_intake_ids(db, len(rows)) if rows else []
+        for intake_lot_id, (i, item) in zip(intake_ids, rows):
+            try:
+                crud.create_ingredient_intake_list(db, item.model_copy(update={"intake_lot_id": intake_lot_id}))
                 imported_count += 1
-                
             except Exception as e:
                 errors.append(f"Row {i+1}: {str(e)}")
 
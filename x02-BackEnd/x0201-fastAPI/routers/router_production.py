@@ -4,16 +4,20 @@ Production Router
 Production plans, batches, and related endpoints.
 """
 
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, Header, HTTPException, Response
 from sqlalchemy.orm import Session
-from sqlalchemy import func, text
+from sqlalchemy import case, func, text
 from typing import List, Optional
-from datetime import datetime
+from datetime import datetime, timedelta
+import hashlib
 import logging
 
 import crud
 import models
 import schemas
+import barcodes
+import plan_sync
+import report_cache
 from database import get_db
 
 from pydantic import BaseModel
@@ -30,20 +34,105 @@ router = APIRouter(tags=["Production"])
 # PRODUCTION PLAN ENDPOINTS
 # =============================================================================
 
+# Changes stamped within this many seconds of the DB clock may still be
+# committing; they are left out of ETags and repeated in the next delta.
+SYNC_MARGIN_S = 5
+
+
+def _as_datetime(value) -> Optional[datetime]:
+    # Raw SQL returns TIMESTAMPs as strings on SQLite
+    return datetime.fromisoformat(value) if isinstance(value, str) else value
+
+
+def _parse_plan_cursor(cursor: str) -> tuple[str, int]:
+    # The timestamp is passed back exactly as the database returned it
+    try:
+        ts, last_id = cursor.rsplit("|", 1)
+        datetime.fromisoformat(ts)
+        return ts, int(last_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid cursor: {cursor}")
+
+
 @router.get("/production-plans/")
-def get_production_plans(skip: int = 0, limit: int = 1000, db: Session = Depends(get_db)):
-    """Get all production plans with their batches (lightweight, no reqs)."""
+def get_production_plans(
+    response: Response,
+    skip: int = 0,
+    limit: int = 1000,
+    updated_since: Optional[datetime] = None,
+    cursor: Optional[str] = None,
+    if_none_match: Optional[str] = Header(None),
+    db: Session = Depends(get_db),
+):
+    """Get all production plans with their batches (lightweight, no reqs), newest first.
+
+    - `X-Sync-Token` response header: pass it back as `updated_since` to get only
+      plans whose plan, batch or requirement rows changed since this response.
+      A delta also lists deleted plans in `X-Deleted-Plans` (comma-separated
+      ids) and re-sends plans that lost a batch or requirement; with
+      `X-Sync-Reset: 1` the body is the full list and replaces the client's.
+    - `X-Next-Cursor`: pass it as `cursor` for the next page (keyset on created_at, id).
+    - `ETag` / `If-None-Match`: 304 with no body when nothing has changed.
+    """
     from sqlalchemy import text as sql_text, bindparam
-    
+
+    # 0. Change stamp of the three tables (index-only MAX lookups) for ETag / sync token.
+    # Deletes move the tombstone id; the plan count and max id catch any left unrecorded.
+    stamp = db.execute(sql_text("""
+        SELECT (SELECT MAX(updated_at) FROM production_plans) AS plans_at,
+               (SELECT MAX(updated_at) FROM production_batches) AS batches_at,
+               (SELECT MAX(updated_at) FROM prebatch_reqs) AS reqs_at,
+               (SELECT COUNT(*) FROM production_plans) AS plan_count,
+               (SELECT MAX(id) FROM production_plans) AS plan_max_id,
+               (SELECT MAX(id) FROM sync_tombstones) AS tombstone_id,
+               CURRENT_TIMESTAMP AS db_now
+    """)).one()
+    settled_at = _as_datetime(stamp.db_now) - timedelta(seconds=SYNC_MARGIN_S)
+    headers = {"X-Sync-Token": str(settled_at)}
+    latest = max((_as_datetime(t) for t in (stamp.plans_at, stamp.batches_at, stamp.reqs_at) if t), default=None)
+    if latest is None or latest <= settled_at:
+        # updated_since is left out: a delta client's merged list is current as long
+        # as the tables have not changed, whichever token it sends next
+        digest = hashlib.sha1(repr((tuple(stamp[:-1]), skip, limit, cursor)).encode()).hexdigest()
+        headers["ETag"] = f'W/"{digest}"'
+        if if_none_match == headers["ETag"]:
+            return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+
     # 1. Fetch plans
-    plans = db.execute(sql_text("""
+    where = []
+    params: dict = {"skip": skip, "limit": limit}
+    if updated_since:
+        reset, deleted_plans = plan_sync.deletions_since(db, updated_since)
+        if reset:
+            response.headers["X-Sync-Reset"] = "1"
+            updated_since = None
+        else:
+            response.headers["X-Deleted-Plans"] = ",".join(map(str, deleted_plans))
+    if updated_since:
+        where.append("""(updated_at >= :since
+            OR id IN (SELECT plan_id FROM production_batches WHERE updated_at >= :since)
+            OR plan_id IN (SELECT plan_id FROM prebatch_reqs WHERE updated_at >= :since)
+            OR id IN (SELECT plan_db_id FROM sync_tombstones WHERE deleted_at >= :since)
+            OR plan_id IN (SELECT plan_code FROM sync_tombstones WHERE deleted_at >= :since))""")
+        params["since"] = updated_since
+    if cursor:
+        params["cursor_ts"], params["cursor_id"] = _parse_plan_cursor(cursor)
+        where.append("(created_at < :cursor_ts OR (created_at = :cursor_ts AND id < :cursor_id))")
+        params["skip"] = 0
+    plans_stmt = sql_text(f"""
         SELECT id, plan_id, sku_id, sku_name, plant, total_volume, total_plan_volume,
                batch_size, num_batches, start_date, finish_date, status,
                flavour_house, spp, created_by, updated_by, created_at, updated_at
         FROM production_plans
-        ORDER BY created_at DESC
+        {"WHERE " + " AND ".join(where) if where else ""}
+        ORDER BY created_at DESC, id DESC
         LIMIT :limit OFFSET :skip
-    """), {"skip": skip, "limit": limit}).fetchall()
+    """)
+    plans = db.execute(plans_stmt, params).fetchall()
+    if plans and len(plans) == limit:
+        last = plans[-1]
+        response.headers["X-Next-Cursor"] = f"{last.created_at}|{last.id}"
     
     plan_ids = [p.id for p in plans]
     
@@ -54,6 +143,7 @@ def get_production_plans(skip: int = 0, limit: int = 1000, db: Session = Depends
             sql_text("""
                 SELECT id, plan_id, batch_id, sku_id, plant, batch_size, status,
                        flavour_house, spp, batch_prepare, ready_to_product, production, done,
+                       reqs_total, reqs_completed, bags_weighed,
                        fh_boxed_at, spp_boxed_at, fh_delivered_at, fh_delivered_by,
                        spp_delivered_at, spp_delivered_by, created_at, updated_at
                 FROM production_batches
@@ -73,6 +163,8 @@ def get_production_plans(skip: int = 0, limit: int = 1000, db: Session = Depends
                 "spp": bool(b.spp), "batch_prepare": bool(b.batch_prepare),
                 "ready_to_product": bool(b.ready_to_product),
                 "production": bool(b.production), "done": bool(b.done),
+                "reqs_total": b.reqs_total or 0, "reqs_completed": b.reqs_completed or 0,
+                "bags_weighed": b.bags_weighed or 0,
                 "fh_boxed_at": b.fh_boxed_at, "spp_boxed_at": b.spp_boxed_at,
                 "fh_delivered_at": b.fh_delivered_at, "fh_delivered_by": b.fh_delivered_by,
                 "spp_delivered_at": b.spp_delivered_at, "spp_delivered_by": b.spp_delivered_by,
@@ -115,17 +207,18 @@ def get_production_plans(skip: int = 0, limit: int = 1000, db: Session = Depends
     sku_ids = list(set(p.sku_id for p in plans if p.sku_id))
     phase_map: dict = {}  # sku_id -> re_code -> phases
     if sku_ids:
+        # Distinct phases joined in Python (GROUP_CONCAT ... ORDER BY is MySQL-only)
         phase_rows = db.execute(sql_text("""
-            SELECT sku_id, re_code, GROUP_CONCAT(DISTINCT phase_number ORDER BY phase_number) AS phases
+            SELECT DISTINCT sku_id, re_code, phase_number
             FROM sku_steps
-            WHERE sku_id IN :sku_ids
-            GROUP BY sku_id, re_code
+            WHERE sku_id IN :sku_ids AND phase_number IS NOT NULL
         """).bindparams(bindparam("sku_ids", expanding=True)),
         {"sku_ids": sku_ids}).fetchall()
+        phase_sets: dict = {}
         for pr in phase_rows:
-            if pr.sku_id not in phase_map:
-                phase_map[pr.sku_id] = {}
-            phase_map[pr.sku_id][pr.re_code] = pr.phases or ""
+            phase_sets.setdefault(pr.sku_id, {}).setdefault(pr.re_code, set()).add(pr.phase_number)
+        for sku_id, by_re_code in phase_sets.items():
+            phase_map[sku_id] = {re_code: ",".join(sorted(phases)) for re_code, phases in by_re_code.items()}
     
     # 5. Assemble result
     result = []
@@ -204,6 +297,9 @@ def get_ready_to_deliver(db: Session = Depends(get_db)):
     batches = db.query(models.ProductionBatch).filter(
         (models.ProductionBatch.fh_boxed_at.isnot(None)) | (models.ProductionBatch.spp_boxed_at.isnot(None)),
     ).all()
+    boxes_by_batch: dict = {}
+    for box in crud.get_boxes(db, batch_ids=[b.batch_id for b in batches]) if batches else []:
+        boxes_by_batch.setdefault(box.batch_id, []).append(crud.box_summary(box))
     result = []
     for b in batches:
         result.append({
@@ -218,6 +314,7 @@ def get_ready_to_deliver(db: Session = Depends(get_db)):
             "fh_delivered_by": b.fh_delivered_by,
             "spp_delivered_at": b.spp_delivered_at.isoformat() if b.spp_delivered_at else None,
             "spp_delivered_by": b.spp_delivered_by,
+            "boxes": boxes_by_batch.get(b.batch_id, []),
         })
     return result
 
@@ -263,21 +360,20 @@ def get_production_batch_by_id_str(batch_id_str: str, db: Session = Depends(get_
 def get_prebatch_records_summary(batch_id: str, db: Session = Depends(get_db)):
     """
     Returns a summary of prebatch records grouped by ingredient.
-    Matches records by either batch_record_id prefix or plan_id.
+    Matches records by batch_id, or by plan_id when given a plan ID.
     """
-    # Try searching by full batch ID prefix first
-    records = db.query(models.PreBatchRec).filter(
-        models.PreBatchRec.batch_record_id.like(f"{batch_id}%")
-    ).all()
+    # Try searching by the bags' batch first
+    records = db.query(models.PreBatchRec).filter(models.PreBatchRec.batch_id == batch_id).all()
     
     # If no records found, try searching by plan_id if the batch_id looks like a Plan ID
     # or find records where plan_id matches the prefix of the batch_id
+    if not records:
+        records = db.query(models.PreBatchRec).filter(models.PreBatchRec.plan_id == batch_id).all()
     if not records:
         # Example batch_id: plan-Line-3-2026-02-07-003-003
         # Extract plan part: plan-Line-3-2026-02-07-003
-        plan_part = "-".join(batch_id.split("-")[:-1]) if "-" in batch_id else batch_id
         records = db.query(models.PreBatchRec).filter(
-            models.PreBatchRec.plan_id == plan_part
+            models.PreBatchRec.plan_id == barcodes.batch_plan_id(batch_id)
         ).all()
     
     summary = {}
@@ -315,20 +411,26 @@ def get_prebatch_reqs_by_batch(batch_id: str, db: Session = Depends(get_db)):
     """Get prebatch requirements filtered by batch ID."""
     reqs = crud.get_prebatch_reqs_by_batch(db, batch_id=batch_id)
     for r in reqs:
-        # Sum actual volume from prebatch_recs for this batch + re_code
-        recs = db.query(models.PreBatchRec).filter(
-            models.PreBatchRec.batch_record_id.like(f"{batch_id}-{r.re_code}%")
-        ).all()
-        r.total_packaged = round(sum(prec.net_volume or 0 for prec in recs), 4)
+        r.total_packaged = round(r.packaged_volume or 0, 4)
     return reqs
 
 @router.get("/prebatch-reqs/summary-by-plan/{plan_id}")
 def get_prebatch_reqs_summary_by_plan(plan_id: str, db: Session = Depends(get_db)):
     """Get ingredient requirements summarized across all batches for a plan."""
-    reqs = db.query(models.PreBatchReq).filter(models.PreBatchReq.plan_id == plan_id).all()
-    
+    Req = models.PreBatchReq
+    rows = db.query(
+        Req.re_code,
+        func.min(Req.ingredient_name).label("ingredient_name"),
+        func.sum(Req.required_volume).label("total_required"),
+        func.sum(Req.packaged_volume).label("total_packaged"),
+        func.count(Req.id).label("batch_count"),
+        func.max(Req.required_volume).label("per_batch"),
+        func.min(Req.wh).label("wh"),
+        func.sum(case((Req.status == 2, 1), else_=0)).label("completed_batches"),
+    ).filter(Req.plan_id == plan_id).group_by(Req.re_code).order_by(func.min(Req.id)).all()
+
     # Pre-fetch warehouse from ingredients table by re_code
-    re_codes = list(set(r.re_code for r in reqs if r.re_code))
+    re_codes = [r.re_code for r in rows if r.re_code]
     ing_wh_map: dict = {}
     if re_codes:
         ings = db.query(models.Ingredient.re_code, models.Ingredient.warehouse).filter(
@@ -337,80 +439,54 @@ def get_prebatch_reqs_summary_by_plan(plan_id: str, db: Session = Depends(get_db
         for ing in ings:
             if ing.re_code and ing.warehouse:
                 ing_wh_map[ing.re_code] = ing.warehouse
-    
-    # Group by re_code and sum required_volume
-    summary: dict = {}
-    for req in reqs:
-        if req.re_code not in summary:
-            # Calculate total packaged for this plan + re_code
-            recs = db.query(models.PreBatchRec).filter(
-                models.PreBatchRec.plan_id == plan_id,
-                models.PreBatchRec.re_code == req.re_code
-            ).all()
-            total_pkg = sum(r.net_volume or 0 for r in recs)
-
-            summary[req.re_code] = {
-                "re_code": req.re_code,
-                "ingredient_name": req.ingredient_name,
-                "total_required": 0,
-                "total_packaged": round(total_pkg, 4),
-                "batch_count": 0,
-                "per_batch": req.required_volume or 0,
-                "wh": ing_wh_map.get(req.re_code, req.wh or "-"),
-                "status": 0,  # 0=Pending, 1=InProgress, 2=Done
-                "completed_batches": 0
-            }
-        summary[req.re_code]["total_required"] += req.required_volume or 0
-        summary[req.re_code]["batch_count"] += 1
-        if req.status == 2:
-            summary[req.re_code]["completed_batches"] += 1
-    
-    # Determine status per ingredient
-    for key in summary:
-        s = summary[key]
-        if s["completed_batches"] >= s["batch_count"] and s["batch_count"] > 0:
-            s["status"] = 2  # All batches done
-        elif s["completed_batches"] > 0:
-            s["status"] = 1  # Some batches done
-        s["total_required"] = round(s["total_required"], 4)
-    
-    return list(summary.values())
+
+    summary = []
+    for r in rows:
+        completed = int(r.completed_batches or 0)
+        if completed >= r.batch_count and r.batch_count > 0:
+            status = 2  # All batches done
+        elif completed > 0:
+            status = 1  # Some batches done
+        else:
+            status = 0
+        summary.append({
+            "re_code": r.re_code,
+            "ingredient_name": r.ingredient_name,
+            "total_required": round(r.total_required or 0, 4),
+            "total_packaged": round(r.total_packaged or 0, 4),
+            "batch_count": r.batch_count,
+            "per_batch": r.per_batch or 0,
+            "wh": ing_wh_map.get(r.re_code, r.wh or "-"),
+            "status": status,  # 0=Pending, 1=InProgress, 2=Done
+            "completed_batches": completed,
+        })
+    return summary
 
 @router.get("/prebatch-reqs/batches-by-ingredient/{plan_id}/{re_code}")
 def get_batches_for_ingredient(plan_id: str, re_code: str, db: Session = Depends(get_db)):
     """Get per-batch detail for a specific ingredient within a plan."""
-    reqs = db.query(models.PreBatchReq).filter(
-        models.PreBatchReq.plan_id == plan_id,
-        models.PreBatchReq.re_code == re_code
-    ).order_by(models.PreBatchReq.batch_id).all()
-    
-    result = []
-    for req in reqs:
-        # Sum actual volume from prebatch_recs for this batch + re_code
-        recs = db.query(models.PreBatchRec).filter(
-            models.PreBatchRec.batch_record_id.like(f"{req.batch_id}-{re_code}%")
-        ).all()
-        actual = sum(r.net_volume or 0 for r in recs)
-        
-        result.append({
-            "batch_id": req.batch_id,
-            "required_volume": req.required_volume or 0,
-            "actual_volume": round(actual, 4),
-            "status": req.status,  # 0=Wait, 1=Batch, 2=Done
-            "req_id": req.id
-        })
-    
-    return result
+    Req = models.PreBatchReq
+    reqs = db.query(
+        Req.id, Req.batch_id, Req.required_volume, Req.packaged_volume, Req.status,
+    ).filter(
+        Req.plan_id == plan_id,
+        Req.re_code == re_code
+    ).order_by(Req.batch_id).all()
+
+    return [{
+        "batch_id": req.batch_id,
+        "required_volume": req.required_volume or 0,
+        "actual_volume": round(req.packaged_volume or 0, 4),
+        "status": req.status,  # 0=Wait, 1=Batch, 2=Done
+        "req_id": req.id
+    } for req in reqs]
 
 @router.put("/prebatch-reqs/{req_id}/status")
 def update_prebatch_req_status_by_id(req_id: int, status: int, db: Session = Depends(get_db)):
     """Update the status of a prebatch requirement by its ID. 0=Pending, 1=In-Progress, 2=Completed."""
-    req = db.query(models.PreBatchReq).filter(models.PreBatchReq.id == req_id).first()
+    req = crud.update_prebatch_req_status_by_id(db, req_id, status)
     if not req:
         raise HTTPException(status_code=404, detail="Requirement not found")
-    req.status = status
-    db.commit()
-    db.refresh(req)
     return {"id": req.id, "status": req.status}
 
 @router.get("/prebatch-recs/by-batch/{batch_id}", response_model=List[schemas.PreBatchRec])
@@ -446,9 +522,49 @@ def get_prebatch_recs_by_plan(plan_id: str, db: Session = Depends(get_db)):
     return crud.get_prebatch_recs_by_plan(db, plan_id=plan_id)
 
 @router.post("/prebatch-recs/", response_model=schemas.PreBatchRec)
-def create_prebatch_rec(record: schemas.PreBatchRecCreate, db: Session = Depends(get_db)):
-    """Create a new prebatch record (transaction)."""
-    return crud.create_prebatch_rec(db=db, record=record)
+def create_prebatch_rec(
+    record: schemas.PreBatchRecCreate,
+    response: Response,
+    idempotency_key: Optional[str] = Header(None, max_length=100),
+    db: Session = Depends(get_db),
+):
+    """Create a new prebatch record (transaction).
+
+    Safe to retry: a repeat with the same `Idempotency-Key` header (or, without
+    one, the same batch_record_id and values) returns the bag created by the
+    first delivery, flagged `Idempotent-Replay: true`, without touching stock.
+    A key or batch_record_id reused for a different bag is a 409.
+    """
+    def replay():
+        try:
+            rec = crud.find_prebatch_replay(db, record, idempotency_key)
+        except ValueError as e:
+            raise HTTPException(status_code=409, detail=str(e))
+        if rec is not None:
+            response.headers["Idempotent-Replay"] = "true"
+        return rec
+
+    rec = replay()
+    if rec is not None:
+        return rec
+    try:
+        return crud.create_prebatch_rec(db=db, record=record, idempotency_key=idempotency_key)
+    except ValueError as e:
+        # Lost a race with a concurrent delivery of the same request
+        rec = replay()
+        if rec is not None:
+            return rec
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.post("/prebatch-recs/bulk", response_model=List[schemas.PreBatchRecBulkResult])
+def create_prebatch_recs_bulk(records: List[schemas.PreBatchRecCreate], db: Session = Depends(get_db)):
+    """Create a run of prebatch records in one transaction; returns a result per item."""
+    try:
+        return crud.create_prebatch_recs_bulk(db=db, records=records)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except RuntimeError:
+        raise HTTPException(status_code=500, detail="Database error")
 
 @router.delete("/prebatch-recs/{record_id}")
 def delete_prebatch_rec(record_id: int, db: Session = Depends(get_db)):
@@ -467,18 +583,24 @@ class PackingStatusUpdate(BaseModel):
 @router.patch("/prebatch-recs/{record_id}/packing-status")
 def update_packing_status(record_id: int, data: PackingStatusUpdate, db: Session = Depends(get_db)):
     """Update the packing status of a prebatch record (0=Unpacked, 1=Packed)."""
-    rec = db.query(models.PreBatchRec).filter(models.PreBatchRec.id == record_id).first()
-    if not rec:
+    row = (
+        db.query(models.PreBatchRec, models.PreBatchReq.batch_db_id, models.PreBatchReq.wh)
+        .outerjoin(models.PreBatchReq, models.PreBatchReq.id == models.PreBatchRec.req_id)
+        .filter(models.PreBatchRec.id == record_id)
+        .first()
+    )
+    if not row:
         raise HTTPException(status_code=404, detail="Record not found")
-
-    rec.packing_status = data.packing_status
-    if data.packing_status == 1:
-        rec.packed_at = datetime.now()
-        rec.packed_by = data.packed_by or "operator"
-    else:
-        rec.packed_at = None
-        rec.packed_by = None
-
+    rec, batch_db_id, wh = row
+
+    packed = data.packing_status == 1
+    try:
+        crud.change_bag_status(db, rec.id, batch_db_id, wh, packing_status=data.packing_status,
+                               packed_at=datetime.now() if packed else None,
+                               packed_by=(data.packed_by or "operator") if packed else None)
+    except ValueError as e:
+        db.rollback()
+        raise HTTPException(status_code=409, detail=str(e))
     db.commit()
     db.refresh(rec)
     return {
@@ -492,6 +614,15 @@ def update_packing_status(record_id: int, data: PackingStatusUpdate, db: Session
 # PACKING & DELIVERY ENDPOINTS
 # =============================================================================
 
+@router.get("/prebatch-boxes/")
+def get_prebatch_boxes(plan_id: Optional[str] = None, batch_id: Optional[str] = None, db: Session = Depends(get_db)):
+    """Warehouse boxes with their bag counters (expected, weighed, packed, rechecked OK/error)."""
+    if not plan_id and not batch_id:
+        raise HTTPException(status_code=400, detail="plan_id or batch_id is required")
+    boxes = crud.get_boxes(db, batch_ids=[batch_id] if batch_id else None, plan_id=plan_id)
+    return [crud.box_summary(b) for b in boxes]
+
+
 @router.patch("/production-batches/by-batch-id/{batch_id_str}/box-close")
 def close_box(batch_id_str: str, data: schemas.BoxCloseRequest, db: Session = Depends(get_db)):
     """Mark a warehouse box as closed (Boxed) for a batch."""
@@ -509,6 +640,7 @@ def close_box(batch_id_str: str, data: schemas.BoxCloseRequest, db: Session = De
         batch.spp_boxed_at = now
     else:
         raise HTTPException(status_code=400, detail=f"Invalid warehouse: {wh}. Must be FH or SPP.")
+    crud.close_box(db, batch, wh, closed_by=data.operator, closed_at=now)
 
     db.commit()
     db.refresh(batch)
@@ -561,78 +693,126 @@ def deliver_batch(batch_id_str: str, data: schemas.DeliveryRequest, db: Session
 # DASHBOARD & ANALYTICS
 # =============================================================================
 
+# Dashboards poll the summary; every client in one window shares one query
+STATS_TTL_S = 5
+
+
+def _production_summary(db: Session, today_start: datetime) -> dict:
+    """Plan/batch counters per plant and today's bags per warehouse, in one UNION ALL round trip."""
+    from sqlalchemy import literal, select, union_all
+
+    Plan = models.ProductionPlan
+    Batch = models.ProductionBatch
+    Rec = models.PreBatchRec
+    Req = models.PreBatchReq
+
+    def flag(cond):
+        return func.sum(case((cond, 1), else_=0))
+
+    plant = func.coalesce(Plan.plant, "-")
+    batch_plant = func.coalesce(Batch.plant, "-")
+    wh = func.coalesce(Req.wh, "-")
+    stmt = union_all(
+        select(literal("plans").label("kind"), plant.label("k"), func.count().label("total"),
+               flag(Plan.status == "In-Progress").label("a"), flag(Plan.status == "Completed").label("b"))
+        .group_by(plant),
+        select(literal("batches"), batch_plant, func.count(), flag(Batch.status == "Created"), literal(0))
+        .group_by(batch_plant),
+        select(literal("records_today"), wh, func.count(), literal(0), literal(0))
+        .select_from(Rec).outerjoin(Req, Req.id == Rec.req_id)
+        .where(Rec.created_at >= today_start).group_by(wh),
+    )
+
+    rows = db.execute(stmt).all()
+
+    plans = {"total": 0, "active": 0, "completed": 0}
+    batches = {"total": 0, "pending": 0}
+    by_plant: dict = {}
+    records_by_wh: dict = {}
+    for kind, key, total, a, b in rows:
+        a, b = int(a or 0), int(b or 0)
+        if kind == "plans":
+            counts = {"total": total, "active": a, "completed": b}
+            for name, value in counts.items():
+                plans[name] += value
+            by_plant.setdefault(key, {})["plans"] = counts
+        elif kind == "batches":
+            counts = {"total": total, "pending": a}
+            for name, value in counts.items():
+                batches[name] += value
+            by_plant.setdefault(key, {})["batches"] = counts
+        else:
+            records_by_wh[key] = total
+    for counts in by_plant.values():
+        counts.setdefault("plans", {"total": 0, "active": 0, "completed": 0})
+        counts.setdefault("batches", {"total": 0, "pending": 0})
+
+    return {
+        "plans": plans,
+        "batches": batches,
+        "records_today": sum(records_by_wh.values()),
+        "by_plant": by_plant,
+        "records_today_by_warehouse": records_by_wh,
+        "timestamp": datetime.now(),
+    }
+
+
 @router.get("/production-stats/summary")
 def get_production_summary_stats(db: Session = Depends(get_db)):
-    """Get high-level production summary stats for dashboard."""
-    total_plans = db.query(models.ProductionPlan).count()
-    active_plans = db.query(models.ProductionPlan).filter(models.ProductionPlan.status == "In-Progress").count()
-    completed_plans = db.query(models.ProductionPlan).filter(models.ProductionPlan.status == "Completed").count()
-    
-    total_batches = db.query(models.ProductionBatch).count()
-    pending_batches = db.query(models.ProductionBatch).filter(models.ProductionBatch.status == "Created").count()
-    
-    # Simple count of records today
+    """Get high-level production summary stats for dashboard.
+
+    Cached for STATS_TTL_S seconds; concurrent pollers share one computation
+    (the session only connects on a miss).
+    """
     today_start = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
-    records_today = db.query(models.PreBatchRec).filter(models.PreBatchRec.created_at >= today_start).count()
-    
-    return {
-        "plans": {
-            "total": total_plans,
-            "active": active_plans,
-            "completed": completed_plans
-        },
-        "batches": {
-            "total": total_batches,
-            "pending": pending_batches
-        },
-        "records_today": records_today,
-        "timestamp": datetime.now()
-    }
+    return report_cache.get_or_compute_ttl(
+        ("production-stats", today_start), STATS_TTL_S, lambda: _production_summary(db, today_start),
+    )
 
 # =============================================================================
 # RE-CHECK / VERIFICATION LOGIC
 # =============================================================================
 
+def _recheck_tolerance(tolerances: dict, re_code: str, target_vol: Optional[float]) -> float:
+    """Allowed |net - target| for a bag, from the SKU's compiled tolerance map."""
+    if re_code not in tolerances:
+        return 0.05 # Default 50g if not found
+    high_tol = tolerances[re_code]
+    # Use high_tol if available, else 1% of target
+    return high_tol if high_tol and high_tol > 0 else (target_vol or 0) * 0.01
+
 @router.get("/prebatch-recs/recheck-box/{box_id}")
 def get_recheck_box_details(box_id: str, db: Session = Depends(get_db)):
     """
     Get all bags for a box/batch with target volumes and tolerances for re-check.
+
+    Bags and their requirement targets load in one query, the plan in a
+    second; tolerances come from the cached per-SKU map.
     """
-    # 1. Find all bags actually weighed for this box
-    records = db.query(models.PreBatchRec).filter(
-        models.PreBatchRec.batch_record_id.like(f"{box_id}%")
-    ).all()
+    # 1. Find all bags actually weighed for this box, with the requirement target
+    bag_query = db.query(models.PreBatchRec, models.PreBatchReq.required_volume).outerjoin(
+        models.PreBatchReq, models.PreBatchReq.id == models.PreBatchRec.req_id
+    )
+    rows = bag_query.filter(models.PreBatchRec.batch_id == box_id).all()
 
-    if not records:
-        # Maybe box_id is a partial or plan_id, try finding by plan_id
-        records = db.query(models.PreBatchRec).filter(
-            models.PreBatchRec.plan_id == box_id
-        ).all()
+    if not rows:
+        # Maybe box_id is a plan_id, try finding by plan_id
+        rows = bag_query.filter(models.PreBatchRec.plan_id == box_id).all()
 
-    if not records:
+    if not rows:
         raise HTTPException(status_code=404, detail="No packing bags found for this Box ID")
 
     # Get Plan and SKU to find tolerances
-    plan_id = records[0].plan_id
+    plan_id = rows[0][0].plan_id
     plan = db.query(models.ProductionPlan).filter(models.ProductionPlan.plan_id == plan_id).first()
     sku_id = plan.sku_id if plan else None
+    sku_name = plan.sku_name if plan else "Unknown"
+    tolerances = crud.get_sku_tolerances(db, sku_id) if sku_id else {}
 
     result_bags = []
-    for r in records:
-        # Get target from requirement
-        req = db.query(models.PreBatchReq).filter(models.PreBatchReq.id == r.req_id).first()
-        target_vol = req.required_volume if req else r.total_volume
-        
-        # Get tolerance from SKU steps
-        tolerance = 0.05 # Default 50g if not found
-        if sku_id:
-            step = db.query(models.SkuStep).filter(
-                models.SkuStep.sku_id == sku_id,
-                models.SkuStep.re_code == r.re_code
-            ).first()
-            if step:
-                # Use high_tol if available, else 1% of target
-                tolerance = step.high_tol if step.high_tol > 0 else (target_vol * 0.01)
+    for r, required_volume in rows:
+        target_vol = required_volume if required_volume is not None else r.total_volume
+        tolerance = _recheck_tolerance(tolerances, r.re_code, target_vol)
 
         result_bags.append({
             "id": r.id,
@@ -653,8 +833,8 @@ def get_recheck_box_details(box_id: str, db: Session = Depends(get_db)):
         "box_id": box_id,
         "plan_id": plan_id,
         "sku_id": sku_id,
-        "sku_name": plan.sku_name if plan else "Unknown",
-        "total_bags": len(records),
+        "sku_name": sku_name,
+        "total_bags": len(rows),
         "bags": result_bags
     }
 
@@ -662,40 +842,49 @@ def get_recheck_box_details(box_id: str, db: Session = Depends(get_db)):
 def verify_bag_scan(data: RecheckBagRequest, db: Session = Depends(get_db)):
     """
     Verify a single bag scan against a box.
+
+    One indexed read (bag + requirement target + plan SKU), an in-memory
+    tolerance check, then the box and bag row locks, a compare-and-set UPDATE
+    of the bag's recheck columns and one of its box's counters.
     """
-    # 1. Find the bag
-    bag = db.query(models.PreBatchRec).filter(models.PreBatchRec.batch_record_id == data.bag_barcode).first()
-    if not bag:
+    # 1. Find the bag with its target and SKU
+    row = (
+        db.query(models.PreBatchRec, models.PreBatchReq.required_volume, models.ProductionPlan.sku_id,
+                 models.PreBatchReq.batch_db_id, models.PreBatchReq.wh)
+        .outerjoin(models.PreBatchReq, models.PreBatchReq.id == models.PreBatchRec.req_id)
+        .outerjoin(models.ProductionPlan, models.ProductionPlan.plan_id == models.PreBatchRec.plan_id)
+        .filter(models.PreBatchRec.batch_record_id == data.bag_barcode)
+        .first()
+    )
+    if not row:
         raise HTTPException(status_code=404, detail=f"Bag barcode {data.bag_barcode} not found")
-
-    # 2. Verify it belongs to the box (prefix match)
-    if not bag.batch_record_id.startswith(data.box_id) and bag.plan_id != data.box_id:
+    bag, required_volume, sku_id, batch_db_id, wh = row
+
+    # 2. Verify it belongs to the box (its batch or plan)
+    bag_batch_id = bag.batch_id
+    if bag_batch_id is None:
+        parsed = barcodes.parse_bag_barcode(bag.batch_record_id, bag.re_code, bag.plan_id)
+        bag_batch_id = parsed.batch_id if parsed else None
+    if bag_batch_id != data.box_id and bag.plan_id != data.box_id:
         raise HTTPException(status_code=400, detail="Bag does not belong to this Box")
 
     # 3. Get target and tolerance
-    req = db.query(models.PreBatchReq).filter(models.PreBatchReq.id == bag.req_id).first()
-    target_vol = req.required_volume if req else bag.total_volume
-    
-    plan = db.query(models.ProductionPlan).filter(models.ProductionPlan.plan_id == bag.plan_id).first()
-    tolerance = 0.05
-    if plan:
-        step = db.query(models.SkuStep).filter(
-            models.SkuStep.sku_id == plan.sku_id,
-            models.SkuStep.re_code == bag.re_code
-        ).first()
-        if step:
-            tolerance = step.high_tol if step.high_tol > 0 else (target_vol * 0.01)
+    target_vol = required_volume if required_volume is not None else bag.total_volume
+    tolerances = crud.get_sku_tolerances(db, sku_id) if sku_id else {}
+    tolerance = _recheck_tolerance(tolerances, bag.re_code, target_vol)
 
     # 4. Perform check
     is_ok = abs((bag.net_volume or 0) - (target_vol or 0)) <= tolerance
 
-    # 5. Update Status
-    bag.recheck_status = 1 if is_ok else 2
-    bag.recheck_at = datetime.now()
-    bag.recheck_by = data.operator
-    db.commit()
-
-    return {
+    # 5. Update Status (and the box's recheck counters) under the box and bag locks
+    try:
+        crud.change_bag_status(db, bag.id, batch_db_id, wh, recheck_status=1 if is_ok else 2,
+                               recheck_at=datetime.now(), recheck_by=data.operator)
+    except ValueError as e:
+        db.rollback()
+        raise HTTPException(status_code=409, detail=str(e))
+    # Built before the commit expires `bag`, so no reload follows the UPDATE
+    result = {
         "status": "OK" if is_ok else "ERROR",
         "message": "Verify Success" if is_ok else "Weight Mismatch",
         "bag": {
@@ -707,28 +896,30 @@ def verify_bag_scan(data: RecheckBagRequest, db: Session = Depends(get_db)):
             "diff": (bag.net_volume or 0) - (target_vol or 0)
         }
     }
+    db.commit()
+    return result
 
 @router.patch("/production-batches/{batch_id}/release")
 def release_batch_to_production(batch_id: str, db: Session = Depends(get_db)):
     """
     Final approval for a box/batch. 
-    Only permits if all bags are re-checked OK.
+    Only permits if all bags are re-checked OK (read from the batch's box
+    counters, plus its bags saved without a requirement, which are in no box).
     """
     batch = db.query(models.ProductionBatch).filter(models.ProductionBatch.batch_id == batch_id).first()
     if not batch:
         raise HTTPException(status_code=404, detail="Batch not found")
 
-    bags = db.query(models.PreBatchRec).filter(
-        models.PreBatchRec.batch_record_id.like(f"{batch_id}%")
-    ).all()
+    totals = crud.get_batch_box_totals(db, batch_id)
+    for column, n in crud.get_unboxed_bag_totals(db, batch_id).items():
+        totals[column] += n
 
-    if not bags:
+    if not totals["bag_count"]:
         raise HTTPException(status_code=400, detail="No bags found for this batch to verify")
 
-    all_ok = all(b.recheck_status == 1 for b in bags)
-    
-    if not all_ok:
-        pending_count = sum(1 for b in bags if b.recheck_status != 1)
+    pending_count = totals["bag_count"] - totals["recheck_ok"]
+
+    if pending_count > 0:
         raise HTTPException(
             status_code=400, 
             detail=f"Re-check incomplete. {pending_count} bag(s) still pending or have errors."
@@ -760,7 +951,11 @@ def sync_prebatch_warehouse(db: Session = Depends(get_db)):
         SET pr.wh = i.warehouse
         WHERE i.warehouse IS NOT NULL AND i.warehouse != '' AND pr.wh != i.warehouse
     """))
+    # Raw UPDATEs skip the ORM flush, so invalidate cached reports explicitly
+    report_cache.touch(db, report_cache.ALL)
     db.commit()
+    if r0b.rowcount or r2.rowcount:
+        crud.rebuild_boxes(db)  # Requirements moved to another warehouse's box
     return {
         "status": "success",
         "ssp_to_spp": r0a.rowcount + r0b.rowcount,
@@ -2,13 +2,21 @@
 Reports Router
 ==============
 Unified endpoints for all printable reports across the xMixing system.
+
+Every report accepts `?format=csv|ndjson|xlsx` to stream its rows as a file
+instead of returning JSON.
 """
+from collections import defaultdict
 from datetime import datetime, timedelta
-from fastapi import APIRouter, Depends, HTTPException
+from typing import Iterator
+from fastapi import APIRouter, Depends, HTTPException, Query
 from sqlalchemy.orm import Session  # type: ignore[import-untyped]
-from sqlalchemy import func, and_  # type: ignore[import-untyped]
+from sqlalchemy import case, func, and_, or_, select  # type: ignore[import-untyped]
 
 from database import get_db  # type: ignore[import-untyped]
+from report_export import CHUNK_ROWS, check_format, stream_export  # type: ignore[import-untyped]
+import report_cache  # type: ignore[import-untyped]
+import crud  # type: ignore[import-untyped]
 import models  # type: ignore[import-untyped]
 
 router = APIRouter(prefix="/reports", tags=["Reports"])
@@ -23,16 +31,36 @@ def _parse_date(val: str | None) -> datetime | None:
         return None
 
 
+def _iso(val) -> str | None:
+    return val.isoformat() if val else None
+
+
+def _stream_rows(db: Session, stmt) -> Iterator[list]:
+    """Yield `stmt` results in chunks of CHUNK_ROWS from a server-side cursor.
+
+    Runs on its own connection so the caller's session stays free for per-chunk
+    lookups (MySQL cannot interleave queries with an open unbuffered cursor).
+    """
+    with db.get_bind().connect() as conn:
+        result = conn.execution_options(stream_results=True, yield_per=CHUNK_ROWS).execute(stmt)
+        for part in result.partitions():
+            yield part
+
+
 # ── 1. Production Daily Report ───────────────────────────────────────────────
 
 @router.get("/production-daily")
 def production_daily_report(
     date: str | None = None,
+    fmt: str | None = Query(None, alias="format"),
     db: Session = Depends(get_db),
 ):
-    """Production daily summary: plans, batches, ingredient consumption."""
+    """Production daily summary: plans, batches, ingredient consumption.
+
+    Export formats stream the ingredient consumption rows.
+    """
+    fmt = check_format(fmt)
     target_date = _parse_date(date) or datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
-    next_day = target_date + timedelta(days=1)
 
     # Plans created/active for this date
     plans = db.query(models.ProductionPlan).filter(
@@ -62,36 +90,16 @@ def production_daily_report(
             "batches": batches,
         })
 
-    # Ingredient consumption for the date (pre-batch records)
-    consumption = (
-        db.query(
-            models.PreBatchRecFrom.mat_sap_code,
-            func.sum(models.PreBatchRecFrom.take_volume).label("total_vol"),
-            func.count(models.PreBatchRecFrom.id).label("count"),
-        )
-        .filter(
-            models.PreBatchRecFrom.created_at >= target_date,
-            models.PreBatchRecFrom.created_at < next_day,
-        )
-        .group_by(models.PreBatchRecFrom.mat_sap_code)
-        .all()
-    )
+    # Ingredient consumption for the date (pre-aggregated rollup)
+    consumption_list = [{
+        "mat_sap_code": c.mat_sap_code,
+        "re_code": c.re_code,
+        "total_volume": c.total_volume,
+        "transaction_count": c.txn_count,
+    } for c in crud.get_consumption(db, target_date.date(), target_date.date())]
 
-    consumption_list = []
-    for c in consumption:
-        # Get re_code from any record
-        sample = db.query(models.PreBatchRecFrom).filter(
-            models.PreBatchRecFrom.mat_sap_code == c.mat_sap_code
-        ).first()
-        rec = db.query(models.PreBatchRec).filter(
-            models.PreBatchRec.id == sample.prebatch_rec_id
-        ).first() if sample else None
-        consumption_list.append({
-            "mat_sap_code": c.mat_sap_code,
-            "re_code": rec.re_code if rec else "",
-            "total_volume": c.total_vol,
-            "transaction_count": c.count,
-        })
+    if fmt:
+        return stream_export(consumption_list, fmt, f"production-daily-{target_date.date()}")
 
     return {
         "date": str(target_date.date()),
@@ -105,54 +113,117 @@ def production_daily_report(
     }
 
 
+@router.get("/consumption")
+def consumption_report(
+    from_date: str | None = None,
+    to_date: str | None = None,
+    plant: str | None = None,
+    by_day: bool = False,
+    fmt: str | None = Query(None, alias="format"),
+    db: Session = Depends(get_db),
+):
+    """Ingredient consumption over a date range, read from the daily rollup."""
+    fmt = check_format(fmt)
+    today = datetime.now().date()
+    date_from = (_parse_date(from_date) or datetime.combine(today, datetime.min.time())).date()
+    date_to = (_parse_date(to_date) or datetime.combine(today, datetime.min.time())).date()
+
+    rows = crud.get_consumption(db, date_from, date_to, plant=plant, by_day=by_day)
+    items = [{
+        **({"date": str(r.consumption_date)} if by_day else {}),
+        "mat_sap_code": r.mat_sap_code,
+        "re_code": r.re_code,
+        "total_volume": r.total_volume,
+        "transaction_count": r.txn_count,
+    } for r in rows]
+
+    if fmt:
+        return stream_export(items, fmt, f"consumption-{date_from}-{date_to}")
+
+    return {
+        "from_date": str(date_from),
+        "to_date": str(date_to),
+        "plant": plant,
+        "items": items,
+        "summary": {
+            "total_volume": sum(i["total_volume"] or 0 for i in items),
+            "transaction_count": sum(i["transaction_count"] or 0 for i in items),
+        },
+    }
+
+
 # ── 2. Pre-Batch Summary Report ─────────────────────────────────────────────
 
+PREBATCH_SUMMARY_COLUMNS = [
+    "batch_record_id", "plan_id", "re_code", "mat_sap_code", "package_no", "total_packages",
+    "net_volume", "total_volume", "total_request_volume", "recheck_status", "packing_status",
+    "created_at", "origins",
+]
+
+
+def _iter_prebatch_summary(db: Session, date_from: datetime | None, date_to: datetime | None) -> Iterator[dict]:
+    """Stream prebatch recs newest-first, with origins fetched in bulk per chunk."""
+    Rec = models.PreBatchRec
+    RecFrom = models.PreBatchRecFrom
+    stmt = select(
+        Rec.id, Rec.batch_record_id, Rec.plan_id, Rec.re_code, Rec.mat_sap_code,
+        Rec.package_no, Rec.total_packages, Rec.net_volume, Rec.total_volume,
+        Rec.total_request_volume, Rec.recheck_status, Rec.packing_status, Rec.created_at,
+    )
+    if date_from:
+        stmt = stmt.where(Rec.created_at >= date_from)
+    if date_to:
+        stmt = stmt.where(Rec.created_at < date_to)
+    stmt = stmt.order_by(Rec.created_at.desc(), Rec.id.desc())
+
+    for part in _stream_rows(db, stmt):
+        origins = defaultdict(list)
+        for o in db.execute(
+            select(RecFrom.prebatch_rec_id, RecFrom.intake_lot_id, RecFrom.mat_sap_code, RecFrom.take_volume)
+            .where(RecFrom.prebatch_rec_id.in_([r.id for r in part]))
+        ):
+            origins[o.prebatch_rec_id].append({
+                "intake_lot_id": o.intake_lot_id,
+                "mat_sap_code": o.mat_sap_code,
+                "take_volume": o.take_volume,
+            })
+        for r in part:
+            yield {
+                "batch_record_id": r.batch_record_id,
+                "plan_id": r.plan_id,
+                "re_code": r.re_code,
+                "mat_sap_code": r.mat_sap_code,
+                "package_no": r.package_no,
+                "total_packages": r.total_packages,
+                "net_volume": r.net_volume,
+                "total_volume": r.total_volume,
+                "total_request_volume": r.total_request_volume,
+                "recheck_status": r.recheck_status,
+                "packing_status": r.packing_status,
+                "created_at": r.created_at.isoformat() if r.created_at else None,
+                "origins": origins.get(r.id, []),
+            }
+
+
 @router.get("/prebatch-summary")
 def prebatch_summary_report(
     from_date: str | None = None,
     to_date: str | None = None,
+    fmt: str | None = Query(None, alias="format"),
     db: Session = Depends(get_db),
 ):
     """Pre-batch completion summary with ingredient variance."""
+    fmt = check_format(fmt)
     date_from = _parse_date(from_date)
     date_to = _parse_date(to_date)
     if date_to:
         date_to = date_to + timedelta(days=1)
 
-    q = db.query(models.PreBatchRec)
-    if date_from:
-        q = q.filter(models.PreBatchRec.created_at >= date_from)
-    if date_to:
-        q = q.filter(models.PreBatchRec.created_at < date_to)
-
-    records = q.order_by(models.PreBatchRec.created_at.desc()).all()
-
-    result = []
-    for rec in records:
-        origins = db.query(models.PreBatchRecFrom).filter(
-            models.PreBatchRecFrom.prebatch_rec_id == rec.id
-        ).all()
-        origin_list = [{
-            "intake_lot_id": o.intake_lot_id,
-            "mat_sap_code": o.mat_sap_code,
-            "take_volume": o.take_volume,
-        } for o in origins]
-
-        result.append({
-            "batch_record_id": rec.batch_record_id,
-            "plan_id": rec.plan_id,
-            "re_code": rec.re_code,
-            "mat_sap_code": rec.mat_sap_code,
-            "package_no": rec.package_no,
-            "total_packages": rec.total_packages,
-            "net_volume": rec.net_volume,
-            "total_volume": rec.total_volume,
-            "total_request_volume": rec.total_request_volume,
-            "recheck_status": rec.recheck_status,
-            "packing_status": rec.packing_status,
-            "created_at": rec.created_at.isoformat() if rec.created_at else None,
-            "origins": origin_list,
-        })
+    rows = _iter_prebatch_summary(db, date_from, date_to)
+    if fmt:
+        return stream_export(rows, fmt, "prebatch-summary", PREBATCH_SUMMARY_COLUMNS)
+
+    result = list(rows)
 
     # Group by re_code for ingredient totals
     ingredient_totals = {}
@@ -180,12 +251,7 @@ def prebatch_summary_report(
 
 # ── 3. Batch Record Report ──────────────────────────────────────────────────
 
-@router.get("/batch-record/{batch_id}")
-def batch_record_report(
-    batch_id: str,
-    db: Session = Depends(get_db),
-):
-    """Full batch record with ingredients used."""
+def _batch_record_payload(db: Session, batch_id: str) -> dict:
     batch = db.query(models.ProductionBatch).filter(
         models.ProductionBatch.batch_id == batch_id
     ).first()
@@ -194,36 +260,54 @@ def batch_record_report(
 
     plan = batch.plan
 
-    # Get pre-batch records for this batch
-    prebatch_recs = db.query(models.PreBatchRec).filter(
-        models.PreBatchRec.plan_id == plan.plan_id if plan else False,
-    ).all()
-
-    # Filter to batch-relevant re_codes from reqs
-    reqs = db.query(models.PreBatchReq).filter(
-        models.PreBatchReq.batch_id == batch_id
-    ).all()
+    # reqs ⟕ recs ⟕ rec_from ⟕ intake lots in one round trip, scoped to this batch
+    Req = models.PreBatchReq
+    Rec = models.PreBatchRec
+    RecFrom = models.PreBatchRecFrom
+    Lot = models.IngredientIntakeList
+    lot_col = func.coalesce(RecFrom.intake_lot_id, Rec.intake_lot_id)
+    stmt = (
+        select(
+            Req.id.label("req_id"), Req.re_code, Req.ingredient_name, Req.required_volume, Req.wh, Req.status,
+            Rec.id.label("rec_id"), Rec.batch_record_id, Rec.mat_sap_code.label("rec_mat"), Rec.net_volume,
+            RecFrom.id.label("from_id"), RecFrom.mat_sap_code.label("from_mat"), RecFrom.take_volume,
+            lot_col.label("intake_lot_id"), Lot.lot_id, Lot.expire_date,
+        )
+        .outerjoin(Rec, or_(
+            Rec.req_id == Req.id,
+            # Legacy bags without req_id: match on the batch parsed from their barcode
+            and_(Rec.req_id.is_(None), Rec.batch_id == batch_id, Rec.re_code == Req.re_code),
+        ))
+        .outerjoin(RecFrom, RecFrom.prebatch_rec_id == Rec.id)
+        .outerjoin(Lot, Lot.intake_lot_id == lot_col)
+        .where(Req.batch_id == batch_id)
+        .order_by(Req.id, Rec.package_no, Rec.id, RecFrom.id)
+    )
 
+    reqs: dict = {}
     ingredients = []
-    for req in reqs:
-        recs = db.query(models.PreBatchRec).filter(
-            models.PreBatchRec.plan_id == plan.plan_id if plan else "",
-            models.PreBatchRec.re_code == req.re_code,
-        ).all()
-        for rec in recs:
-            origins = db.query(models.PreBatchRecFrom).filter(
-                models.PreBatchRecFrom.prebatch_rec_id == rec.id
-            ).all()
-            for o in origins:
-                ingredients.append({
-                    "re_code": req.re_code,
-                    "ingredient_name": req.ingredient_name,
-                    "mat_sap_code": o.mat_sap_code,
-                    "intake_lot_id": o.intake_lot_id,
-                    "required_volume": req.required_volume,
-                    "actual_volume": o.take_volume,
-                    "batch_record_id": rec.batch_record_id,
-                })
+    for r in db.execute(stmt):
+        reqs.setdefault(r.req_id, {
+            "re_code": r.re_code,
+            "ingredient_name": r.ingredient_name,
+            "required_volume": r.required_volume,
+            "wh": r.wh,
+            "status": r.status,
+        })
+        # Bags without origin rows drew their whole net volume from rec.intake_lot_id
+        if r.rec_id is None or r.intake_lot_id is None:
+            continue
+        ingredients.append({
+            "re_code": r.re_code,
+            "ingredient_name": r.ingredient_name,
+            "mat_sap_code": r.from_mat if r.from_id is not None else r.rec_mat,
+            "intake_lot_id": r.intake_lot_id,
+            "lot_id": r.lot_id,
+            "expire_date": _iso(r.expire_date),
+            "required_volume": r.required_volume,
+            "actual_volume": r.take_volume if r.from_id is not None else r.net_volume,
+            "batch_record_id": r.batch_record_id,
+        })
 
     return {
         "batch": {
@@ -241,24 +325,56 @@ def batch_record_report(
             "finish_date": str(plan.finish_date) if plan and plan.finish_date else None,
         },
         "ingredients": ingredients,
-        "reqs": [{
-            "re_code": r.re_code,
-            "ingredient_name": r.ingredient_name,
-            "required_volume": r.required_volume,
-            "wh": r.wh,
-            "status": r.status,
-        } for r in reqs],
+        "reqs": list(reqs.values()),
     }
 
 
+@router.get("/batch-record/{batch_id}")
+def batch_record_report(
+    batch_id: str,
+    fmt: str | None = Query(None, alias="format"),
+    db: Session = Depends(get_db),
+):
+    """Full batch record with ingredients used.
+
+    Export formats stream the ingredient (lot usage) rows.
+    """
+    fmt = check_format(fmt)
+    plan_id = db.query(models.ProductionPlan.plan_id).join(
+        models.ProductionBatch, models.ProductionBatch.plan_id == models.ProductionPlan.id,
+    ).filter(models.ProductionBatch.batch_id == batch_id).scalar()
+    if plan_id is None:
+        raise HTTPException(status_code=404, detail="Batch not found")
+
+    report = report_cache.get_or_compute(
+        db, "batch-record", batch_id, [report_cache.plan_scope(plan_id), report_cache.INTAKE],
+        lambda s: _batch_record_payload(s, batch_id),
+    )
+    if fmt:
+        return stream_export(report["ingredients"], fmt, f"batch-record-{batch_id}")
+    return report
+
+
 # ── 4. Packing List Report ──────────────────────────────────────────────────
 
 @router.get("/packing-list/{plan_id}")
 def packing_list_report(
     plan_id: str,
+    fmt: str | None = Query(None, alias="format"),
     db: Session = Depends(get_db),
 ):
     """Packing list for a plan — all bags grouped by batch."""
+    fmt = check_format(fmt)
+    report = report_cache.get_or_compute(
+        db, "packing-list", plan_id, [report_cache.plan_scope(plan_id)],
+        lambda s: _packing_list_payload(s, plan_id),
+    )
+    if fmt:
+        return stream_export(report["bags"], fmt, f"packing-list-{plan_id}")
+    return report
+
+
+def _packing_list_payload(db: Session, plan_id: str) -> dict:
     plan = db.query(models.ProductionPlan).filter(
         models.ProductionPlan.plan_id == plan_id
     ).first()
@@ -290,6 +406,7 @@ def packing_list_report(
         "sku_name": plan.sku_name,
         "total_volume": plan.total_plan_volume,
         "bags": bags,
+        "boxes": [crud.box_summary(b) for b in crud.get_boxes(db, plan_id=plan_id)],
         "summary": {
             "total_bags": len(bags),
             "packed": sum(1 for b in bags if b["packing_status"] == 1),
@@ -301,41 +418,57 @@ def packing_list_report(
 
 # ── 5. Quality Check / Batch Recheck Report ─────────────────────────────────
 
+QUALITY_CHECK_COLUMNS = [
+    "batch_record_id", "plan_id", "re_code", "mat_sap_code", "package_no",
+    "recheck_status", "recheck_at", "recheck_by",
+]
+
+
+def _iter_quality_check(db: Session, date_from: datetime | None, date_to: datetime | None) -> Iterator[dict]:
+    Rec = models.PreBatchRec
+    stmt = select(
+        Rec.batch_record_id, Rec.plan_id, Rec.re_code, Rec.mat_sap_code, Rec.package_no,
+        Rec.recheck_status, Rec.recheck_at, Rec.recheck_by,
+    ).where(Rec.recheck_status > 0)
+    if date_from:
+        stmt = stmt.where(Rec.recheck_at >= date_from)
+    if date_to:
+        stmt = stmt.where(Rec.recheck_at < date_to)
+    stmt = stmt.order_by(Rec.recheck_at.desc())
+
+    for part in _stream_rows(db, stmt):
+        for r in part:
+            yield {
+                "batch_record_id": r.batch_record_id,
+                "plan_id": r.plan_id,
+                "re_code": r.re_code,
+                "mat_sap_code": r.mat_sap_code,
+                "package_no": r.package_no,
+                "recheck_status": r.recheck_status,  # 1=OK, 2=Error
+                "recheck_at": r.recheck_at.isoformat() if r.recheck_at else None,
+                "recheck_by": r.recheck_by,
+            }
+
+
 @router.get("/quality-check")
 def quality_check_report(
     from_date: str | None = None,
     to_date: str | None = None,
+    fmt: str | None = Query(None, alias="format"),
     db: Session = Depends(get_db),
 ):
     """Batch recheck results summary."""
+    fmt = check_format(fmt)
     date_from = _parse_date(from_date)
     date_to = _parse_date(to_date)
     if date_to:
         date_to = date_to + timedelta(days=1)
 
-    q = db.query(models.PreBatchRec).filter(
-        models.PreBatchRec.recheck_status > 0
-    )
-    if date_from:
-        q = q.filter(models.PreBatchRec.recheck_at >= date_from)
-    if date_to:
-        q = q.filter(models.PreBatchRec.recheck_at < date_to)
-
-    records = q.order_by(models.PreBatchRec.recheck_at.desc()).all()
-
-    items = []
-    for rec in records:
-        items.append({
-            "batch_record_id": rec.batch_record_id,
-            "plan_id": rec.plan_id,
-            "re_code": rec.re_code,
-            "mat_sap_code": rec.mat_sap_code,
-            "package_no": rec.package_no,
-            "recheck_status": rec.recheck_status,  # 1=OK, 2=Error
-            "recheck_at": rec.recheck_at.isoformat() if rec.recheck_at else None,
-            "recheck_by": rec.recheck_by,
-        })
+    rows = _iter_quality_check(db, date_from, date_to)
+    if fmt:
+        return stream_export(rows, fmt, "quality-check", QUALITY_CHECK_COLUMNS)
 
+    items = list(rows)
     return {
         "items": items,
         "summary": {
@@ -348,56 +481,152 @@ def quality_check_report(
 
 # ── 6. Ingredient Expiry Alert ──────────────────────────────────────────────
 
+EXPIRY_ALERT_COLUMNS = [
+    "bucket", "intake_lot_id", "mat_sap_code", "re_code", "material_description",
+    "remain_vol", "intake_to", "expire_date", "days_left",
+]
+
+
+EXPIRY_BUCKETS = ("expired", "warning", "ok", "no_expiry")
+
+
+def _expiry_bounds(warning_days: int) -> tuple[datetime, datetime]:
+    # Minute resolution keeps the report deterministic within a minute, so it can be cached
+    now = datetime.now().replace(second=0, microsecond=0)
+    return now, now + timedelta(days=warning_days)
+
+
+def _expiry_bucket_col(now: datetime, threshold: datetime):
+    Lot = models.IngredientIntakeList
+    return case(
+        (Lot.expire_date.is_(None), "no_expiry"),
+        (Lot.expire_date < now, "expired"),
+        (Lot.expire_date < threshold, "warning"),
+        else_="ok",
+    )
+
+
+def _expiry_bucket_filter(bucket: str, now: datetime, threshold: datetime):
+    # Range predicates (not the CASE) so the bucket is an index range on expire_date
+    Lot = models.IngredientIntakeList
+    return {
+        "expired": Lot.expire_date < now,
+        "warning": and_(Lot.expire_date >= now, Lot.expire_date < threshold),
+        "ok": Lot.expire_date >= threshold,
+        "no_expiry": Lot.expire_date.is_(None),
+    }[bucket]
+
+
+def _active_stock():
+    Lot = models.IngredientIntakeList
+    return (Lot.status == "Active", Lot.remain_vol > 0)
+
+
+def _expiry_counts(db: Session, now: datetime, threshold: datetime) -> dict:
+    Lot = models.IngredientIntakeList
+    bucket = _expiry_bucket_col(now, threshold)
+    rows = db.query(
+        bucket.label("bucket"), func.count().label("lots"), func.sum(Lot.remain_vol).label("volume"),
+    ).filter(*_active_stock()).group_by(bucket).all()
+    counts = {b: {"lots": 0, "volume": 0.0} for b in EXPIRY_BUCKETS}
+    for r in rows:
+        counts[r.bucket] = {"lots": r.lots, "volume": r.volume or 0.0}
+    return counts
+
+
+def _iter_expiry_alert(db: Session, now: datetime, threshold: datetime, bucket: str | None = None,
+                       skip: int = 0, limit: int | None = None) -> Iterator[dict]:
+    Lot = models.IngredientIntakeList
+    stmt = select(
+        _expiry_bucket_col(now, threshold).label("bucket"),
+        Lot.intake_lot_id, Lot.mat_sap_code, Lot.re_code, Lot.material_description,
+        Lot.remain_vol, Lot.intake_to, Lot.expire_date,
+    ).where(*_active_stock())
+    if bucket:
+        stmt = stmt.where(_expiry_bucket_filter(bucket, now, threshold))
+    stmt = stmt.order_by(Lot.expire_date.asc(), Lot.intake_lot_id).offset(skip)
+    if limit is not None:
+        stmt = stmt.limit(limit)
+
+    for part in _stream_rows(db, stmt):
+        for i in part:
+            yield {
+                "bucket": i.bucket,
+                "intake_lot_id": i.intake_lot_id,
+                "mat_sap_code": i.mat_sap_code,
+                "re_code": i.re_code or "",
+                "material_description": i.material_description or "",
+                "remain_vol": i.remain_vol,
+                "intake_to": i.intake_to or "",
+                "expire_date": i.expire_date.isoformat() if i.expire_date else None,
+                "days_left": (i.expire_date - now).days if i.expire_date else None,
+            }
+
+
+def _expiry_summary(counts: dict) -> dict:
+    return {
+        "total_lots": sum(c["lots"] for c in counts.values()),
+        "expired_count": counts["expired"]["lots"],
+        "warning_count": counts["warning"]["lots"],
+        "ok_count": counts["ok"]["lots"],
+        "no_expiry_count": counts["no_expiry"]["lots"],
+        "volumes": {b: c["volume"] for b, c in counts.items()},
+    }
+
+
+def _expiry_payload(db: Session, now: datetime, threshold: datetime, bucket: str | None,
+                    skip: int, limit: int | None, summary_only: bool) -> dict:
+    counts = _expiry_counts(db, now, threshold)
+    summary = _expiry_summary(counts)
+    if summary_only:
+        return {"summary": summary}
+    if bucket:
+        return {
+            "bucket": bucket,
+            "items": [
+                {k: v for k, v in item.items() if k != "bucket"}
+                for item in _iter_expiry_alert(db, now, threshold, bucket, skip, limit)
+            ],
+            "total": counts[bucket]["lots"],
+            "skip": skip,
+            "limit": limit,
+            "summary": summary,
+        }
+
+    buckets: dict = {b: [] for b in EXPIRY_BUCKETS}
+    for item in _iter_expiry_alert(db, now, threshold):
+        buckets[item.pop("bucket")].append(item)
+    return {**buckets, "summary": summary}
+
+
 @router.get("/expiry-alert")
 def expiry_alert_report(
+    warning_days: int = Query(30, ge=0, le=3650, description="Horizon of the 'warning' bucket"),
+    bucket: str | None = Query(None, description="expired | warning | ok | no_expiry — page one bucket"),
+    skip: int = Query(0, ge=0),
+    limit: int | None = Query(None, ge=1, le=5000),
+    summary_only: bool = False,
+    fmt: str | None = Query(None, alias="format"),
     db: Session = Depends(get_db),
 ):
-    """Ingredient expiry alert: expired, expiring soon, OK."""
-    now = datetime.now()
-    threshold = now + timedelta(days=30)
-
-    intakes = db.query(models.IngredientIntakeList).filter(
-        models.IngredientIntakeList.status == "Active",
-        models.IngredientIntakeList.remain_vol > 0,
-    ).order_by(models.IngredientIntakeList.expire_date.asc()).all()
-
-    expired = []
-    warning = []
-    ok = []
-    no_expiry = []
-
-    for i in intakes:
-        item = {
-            "intake_lot_id": i.intake_lot_id,
-            "mat_sap_code": i.mat_sap_code,
-            "re_code": i.re_code or "",
-            "material_description": i.material_description or "",
-            "remain_vol": i.remain_vol,
-            "intake_to": i.intake_to or "",
-            "expire_date": i.expire_date.isoformat() if i.expire_date else None,
-            "days_left": (i.expire_date - now).days if i.expire_date else None,
-        }
-        if not i.expire_date:
-            no_expiry.append(item)
-        elif i.expire_date < now:
-            expired.append(item)
-        elif i.expire_date < threshold:
-            warning.append(item)
-        else:
-            ok.append(item)
-
-    return {
-        "expired": expired,
-        "warning": warning,
-        "ok": ok,
-        "no_expiry": no_expiry,
-        "summary": {
-            "total_lots": len(intakes),
-            "expired_count": len(expired),
-            "warning_count": len(warning),
-            "ok_count": len(ok),
-        },
-    }
+    """Ingredient expiry alert: expired, expiring soon, OK.
+
+    Buckets are computed in SQL. `summary_only=true` returns the per-bucket
+    counts without fetching any lot; `bucket=` pages through a single bucket.
+    """
+    fmt = check_format(fmt)
+    if bucket is not None and bucket not in EXPIRY_BUCKETS:
+        raise HTTPException(status_code=400, detail=f"Invalid bucket: {bucket}. Must be one of {', '.join(EXPIRY_BUCKETS)}.")
+    now, threshold = _expiry_bounds(warning_days)
+
+    if fmt:
+        rows = _iter_expiry_alert(db, now, threshold, bucket, skip, limit)
+        return stream_export(rows, fmt, "expiry-alert", EXPIRY_ALERT_COLUMNS)
+
+    return report_cache.get_or_compute(
+        db, "expiry-alert", (now, warning_days, bucket, skip, limit, summary_only), [report_cache.INTAKE],
+        lambda s: _expiry_payload(s, now, threshold, bucket, skip, limit, summary_only),
+    )
 
 
 # ── 7. Traceability Report ──────────────────────────────────────────────────
@@ -405,9 +634,15 @@ def expiry_alert_report(
 @router.get("/traceability/{lot_or_batch_id}")
 def traceability_report(
     lot_or_batch_id: str,
+    fmt: str | None = Query(None, alias="format"),
     db: Session = Depends(get_db),
 ):
-    """End-to-end traceability: forward (lot→batch) and backward (batch→lot)."""
+    """End-to-end traceability: forward (lot→batch) and backward (batch→lot).
+
+    Both directions read the maintained `batch_genealogy` table (one indexed query each).
+    Export formats stream the used-in rows (forward) or one row per lot used (backward).
+    """
+    fmt = check_format(fmt)
     result = {"type": None, "forward": None, "backward": None}
 
     # Try as intake lot (forward trace)
@@ -417,23 +652,20 @@ def traceability_report(
 
     if intake:
         result["type"] = "forward"
-        usages = db.query(models.PreBatchRecFrom).filter(
-            models.PreBatchRecFrom.intake_lot_id == lot_or_batch_id
-        ).all()
-
-        batch_trails = []
-        for u in usages:
-            rec = db.query(models.PreBatchRec).filter(
-                models.PreBatchRec.id == u.prebatch_rec_id
-            ).first()
-            if rec:
-                batch_trails.append({
-                    "batch_record_id": rec.batch_record_id,
-                    "plan_id": rec.plan_id,
-                    "re_code": rec.re_code,
-                    "take_volume": u.take_volume,
-                    "date": u.created_at.isoformat() if u.created_at else None,
-                })
+        batch_trails = [{
+            "batch_record_id": e.batch_record_id,
+            "batch_id": e.batch_id,
+            "plan_id": e.plan_id,
+            "re_code": e.re_code,
+            "wh": e.wh,
+            "take_volume": e.take_volume,
+            "date": _iso(e.created_at),
+            "batch_status": e.batch_status,
+            "boxed_at": _iso(e.spp_boxed_at if e.wh == "SPP" else e.fh_boxed_at),
+            "delivered_at": _iso(e.spp_delivered_at if e.wh == "SPP" else e.fh_delivered_at),
+        } for e in crud.trace_forward(db, lot_or_batch_id)]
+        if fmt:
+            return stream_export(batch_trails, fmt, f"traceability-{lot_or_batch_id}")
 
         result["forward"] = {
             "lot": {
@@ -443,7 +675,7 @@ def traceability_report(
                 "material_description": intake.material_description,
                 "intake_vol": intake.intake_vol,
                 "remain_vol": intake.remain_vol,
-                "intake_at": intake.intake_at.isoformat() if intake.intake_at else None,
+                "intake_at": _iso(intake.intake_at),
             },
             "used_in": batch_trails,
         }
@@ -458,35 +690,32 @@ def traceability_report(
         result["type"] = "backward"
         plan = batch.plan
 
-        reqs = db.query(models.PreBatchReq).filter(
-            models.PreBatchReq.batch_id == lot_or_batch_id
-        ).all()
-
-        ingredients = []
-        for req in reqs:
-            recs = db.query(models.PreBatchRec).filter(
-                models.PreBatchRec.plan_id == plan.plan_id if plan else "",
-                models.PreBatchRec.re_code == req.re_code,
-            ).all()
-            lots_used = []
-            for rec in recs:
-                for o in rec.origins:
-                    lot = db.query(models.IngredientIntakeList).filter(
-                        models.IngredientIntakeList.intake_lot_id == o.intake_lot_id
-                    ).first()
-                    lots_used.append({
-                        "intake_lot_id": o.intake_lot_id,
-                        "mat_sap_code": o.mat_sap_code,
-                        "take_volume": o.take_volume,
-                        "lot_id": lot.lot_id if lot else "",
-                        "intake_from": lot.intake_from if lot else "",
-                    })
-            ingredients.append({
-                "re_code": req.re_code,
-                "ingredient_name": req.ingredient_name,
-                "required_volume": req.required_volume,
-                "lots_used": lots_used,
+        ingredients: dict = {}
+        for row in crud.trace_backward(db, lot_or_batch_id):
+            ing = ingredients.setdefault(row.re_code, {
+                "re_code": row.re_code,
+                "ingredient_name": row.ingredient_name,
+                "required_volume": row.required_volume,
+                "lots_used": [],
             })
+            if row.intake_lot_id:
+                ing["lots_used"].append({
+                    "intake_lot_id": row.intake_lot_id,
+                    "mat_sap_code": row.mat_sap_code,
+                    "take_volume": row.take_volume,
+                    "batch_record_id": row.batch_record_id,
+                    "lot_id": row.lot_id or "",
+                    "intake_from": row.intake_from or "",
+                    "expire_date": _iso(row.expire_date),
+                })
+
+        if fmt:
+            return stream_export(({
+                "re_code": ing["re_code"],
+                "ingredient_name": ing["ingredient_name"],
+                "required_volume": ing["required_volume"],
+                **lot,
+            } for ing in ingredients.values() for lot in ing["lots_used"]), fmt, f"traceability-{lot_or_batch_id}")
 
         result["backward"] = {
             "batch": {
@@ -499,8 +728,69 @@ def traceability_report(
                 "plan_id": plan.plan_id if plan else "",
                 "sku_name": plan.sku_name if plan else "",
             },
-            "ingredients": ingredients,
+            "ingredients": list(ingredients.values()),
         }
         return result
 
     raise HTTPException(status_code=404, detail="ID not found as intake lot or batch")
+
+
+@router.get("/traceability/{intake_lot_id}/recall")
+def recall_report(
+    intake_lot_id: str,
+    fmt: str | None = Query(None, alias="format"),
+    db: Session = Depends(get_db),
+):
+    """Multi-hop recall: every batch the lot reached, and every other lot in those batches.
+
+    Export formats stream the co-lot rows.
+    """
+    fmt = check_format(fmt)
+    rows = crud.trace_recall(db, intake_lot_id)
+    if not rows:
+        raise HTTPException(status_code=404, detail="Lot not used in any batch")
+
+    batches: dict = {}
+    co_lots: dict = {}
+    for r in rows:
+        b = batches.setdefault(r.batch_id, {"batch_id": r.batch_id, "plan_id": r.plan_id, "lots": set()})
+        b["lots"].add(r.intake_lot_id)
+        if r.intake_lot_id == intake_lot_id:
+            continue
+        lot = co_lots.setdefault(r.intake_lot_id, {
+            "intake_lot_id": r.intake_lot_id,
+            "lot_id": r.lot_id or "",
+            "mat_sap_code": r.mat_sap_code,
+            "re_code": r.re_code,
+            "material_description": r.material_description or "",
+            "intake_from": r.intake_from or "",
+            "batches": set(),
+            "take_volume": 0.0,
+        })
+        lot["batches"].add(r.batch_id)
+        lot["take_volume"] += r.take_volume or 0
+
+    co_lot_list = [{**l, "batches": sorted(l["batches"])} for l in co_lots.values()]
+    if fmt:
+        return stream_export(co_lot_list, fmt, f"recall-{intake_lot_id}")
+
+    return {
+        "intake_lot_id": intake_lot_id,
+        "batches": [{**b, "lots": sorted(b["lots"])} for b in batches.values()],
+        "co_lots": co_lot_list,
+        "summary": {
+            "batch_count": len(batches),
+            "co_lot_count": len(co_lots),
+        },
+    }
+
+
+# ── 8. Report Cache Stats ───────────────────────────────────────────────────
+
+@router.get("/cache-stats")
+def report_cache_stats():
+    """Hit/miss counters of the packing-list, batch-record and expiry report cache.
+
+    `ttl` holds the separate counters of the TTL cache behind /production-stats/summary.
+    """
+    return report_cache.stats()
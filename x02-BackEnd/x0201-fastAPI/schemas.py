@@ -151,7 +151,7 @@ class IngredientIntakeListBase(BaseModel):
 
 class IngredientIntakeListCreate(IngredientIntakeListBase):
     """Ingredient intake list creation model"""
-    pass
+    intake_lot_id: Optional[str] = Field(None, max_length=50)  # None: next intake-yyyy-mm-dd-nnn
 
 # Ingredient Intake History Schemas
 class IngredientIntakeHistoryBase(BaseModel):
@@ -308,6 +308,8 @@ class PreBatchRecSummary(BaseModel):
 class PreBatchReq(PreBatchReqBase):
     id: int
     total_packaged: Optional[float] = 0.0
+    packaged_volume: Optional[float] = 0.0
+    bag_count: Optional[int] = 0
     created_at: datetime
     updated_at: Optional[datetime] = None
     recs: List[PreBatchRecSummary] = []
@@ -355,6 +357,13 @@ class PreBatchRecFrom(PreBatchRecFromBase):
 class PreBatchRecCreate(PreBatchRecBase):
     origins: Optional[List[PreBatchRecFromCreate]] = None
 
+class PreBatchRecBulkResult(BaseModel):
+    index: int
+    batch_record_id: str
+    ok: bool
+    id: Optional[int] = None
+    error: Optional[str] = None
+
 class PreBatchRec(PreBatchRecBase):
     id: int
     created_at: datetime
@@ -416,6 +425,9 @@ class ProductionBatchUpdate(BaseModel):
 class ProductionBatch(ProductionBatchBase):
     id: int
     plan_id: int
+    reqs_total: Optional[int] = 0
+    reqs_completed: Optional[int] = 0
+    bags_weighed: Optional[int] = 0
     created_at: datetime
     updated_at: Optional[datetime] = None
     reqs: List[PreBatchReq] = []
@@ -494,6 +506,39 @@ class DeliveryRequest(BaseModel):
     wh: str  # 'FH' (FH→SPP) or 'SPP' (SPP→Production Hall)
     delivered_by: Optional[str] = None
 
+# FEFO Allocation Schemas
+class FefoLine(BaseModel):
+    re_code: str = Field(..., min_length=1, max_length=50)
+    volume: float = Field(..., gt=0)
+    warehouse: Optional[str] = Field(None, max_length=50)  # intake_to; None/"All" = any
+    ref: Optional[str] = Field(None, max_length=100)       # echoed back, e.g. batch_id
+
+class FefoRequest(BaseModel):
+    """Either explicit `lines`, or the open requirements of `batch_id` / `plan_id`."""
+    lines: List[FefoLine] = []
+    batch_id: Optional[str] = None
+    plan_id: Optional[str] = None
+    include_expired: bool = False
+    station: Optional[str] = Field(None, max_length=50)  # preview offers own holds; reserve replaces same-ref holds
+    reserve: bool = False                                 # hold every take for `station`
+    ttl_s: int = Field(300, gt=0, le=3600)
+
+class LotReservationCreate(BaseModel):
+    intake_lot_id: str = Field(..., min_length=1, max_length=50)
+    volume: float = Field(..., gt=0)
+    station: str = Field(..., min_length=1, max_length=50)
+    ref: Optional[str] = Field(None, max_length=100)  # batch_record_id or batch_id the volume is for
+    ttl_s: int = Field(300, gt=0, le=3600)
+
+class LotReservation(BaseModel):
+    id: str
+    intake_lot_id: str
+    volume: float
+    station: str
+    ref: Optional[str] = None
+    created_at: datetime
+    expires_at: datetime
+
 # Stock Adjustment Schemas
 class StockAdjustmentCreate(BaseModel):
     intake_lot_id: str = Field(..., min_length=1, max_length=50)
@@ -522,7 +567,6 @@ class StockAdjustment(BaseModel):
         from_attributes = True
 
 class LotLookup(BaseModel):
-    id: int
     intake_lot_id: str
     mat_sap_code: str
     re_code: Optional[str] = None
@@ -530,6 +574,9 @@ class LotLookup(BaseModel):
     remain_vol: float
     intake_vol: float
     status: str
+    as_of: Optional[datetime] = None  # set when remain_vol is a point-in-time value
+    reserved_vol: float = 0.0         # held by station reservations (current stock only)
+    available_vol: Optional[float] = None
 
     class Config:
         from_attributes = True
@@ -168,6 +168,7 @@ def create_plan(plant: str, sku: models.Sku, num_batches: int, seq: int):
                         req_id=db_req.id,
                         batch_record_id=record_id,
                         plan_id=plan_id,
+                        batch_id=batch_id,
                         re_code=re_code,
                         package_no=pkg_no,
                         total_packages=num_packages,
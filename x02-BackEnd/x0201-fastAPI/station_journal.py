@@ -0,0 +1,355 @@
+"""
+Station Journal
+===============
+Offline-first store for a weighing station's bags.
+
+The station saves each PreBatchRec to a local SQLite file (WAL mode), which
+returns at disk speed whether or not the central API / MySQL is reachable.
+A replay loop then posts the queued bags to the central
+`POST /prebatch-recs/` strictly in the order they were weighed, each with its
+own Idempotency-Key, so a delivery whose response was lost is answered from
+the first delivery instead of drawing the lot twice.
+
+Entry states:
+- pending    not yet accepted by the central API (network down, 5xx)
+- synced     created (or replayed) centrally
+- overdrawn  created centrally, but a lot it drew from ended below zero —
+             the lot was depleted by other stations while this one was offline
+- conflict   409: the key / batch_record_id is already used for another bag
+- rejected   400/404/422: the central API refused the bag
+- failed     the central API answered 5xx MAX_SERVER_ERRORS times;
+             later bags replay past it
+
+`conflicts()` lists the last four for the supervisor to resolve;
+`requeue_failed()` (or `python station_journal.py requeue`) puts failed bags
+back in the queue once the server side is fixed.
+
+Usage:
+    python station_journal.py serve      # local sidecar on STATION_PORT (default 8011)
+    python station_journal.py replay     # push pending bags once
+    python station_journal.py report     # print state counts and conflicts
+    python station_journal.py requeue    # retry failed bags on the next replay
+
+Environment: STATION_JOURNAL (default station_journal.db), CENTRAL_API_URL
+(default http://localhost:8001), STATION_PORT, STATION_REPLAY_INTERVAL_S,
+STATION_MAX_SERVER_ERRORS.
+"""
+import json
+import os
+import sqlite3
+import sys
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+JOURNAL_PATH = os.getenv("STATION_JOURNAL", "station_journal.db")
+CENTRAL_API_URL = os.getenv("CENTRAL_API_URL", "http://localhost:8001")
+STATION_PORT = int(os.getenv("STATION_PORT", "8011"))
+REPLAY_INTERVAL_S = float(os.getenv("STATION_REPLAY_INTERVAL_S", "5"))
+HTTP_TIMEOUT_S = 10
+# 5xx answers for one bag before it stops holding up the queue. Network errors
+# are not counted: an outage must not push bags out of order.
+MAX_SERVER_ERRORS = int(os.getenv("STATION_MAX_SERVER_ERRORS", "5"))
+
+PROBLEM_STATES = ("overdrawn", "conflict", "rejected", "failed")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS journal (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    idempotency_key TEXT NOT NULL UNIQUE,
+    batch_record_id TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    server_id INTEGER,
+    lot_balances TEXT,
+    created_at TEXT NOT NULL,
+    synced_at TEXT
+);
+CREATE INDEX IF NOT EXISTS ix_journal_status ON journal (status, seq);
+CREATE INDEX IF NOT EXISTS ix_journal_batch_record ON journal (batch_record_id);
+"""
+
+
+def _now() -> str:
+    return datetime.now().isoformat(timespec="milliseconds")
+
+
+def _row(r: sqlite3.Row) -> dict:
+    entry = dict(r)
+    entry["payload"] = json.loads(entry["payload"])
+    entry["lot_balances"] = json.loads(entry["lot_balances"]) if entry["lot_balances"] else None
+    return entry
+
+
+def _drawn_lots(payload: dict) -> List[str]:
+    lots = [o["intake_lot_id"] for o in payload.get("origins") or [] if o.get("intake_lot_id")]
+    if not lots and payload.get("intake_lot_id"):
+        lots = [payload["intake_lot_id"]]
+    return sorted(set(lots))
+
+
+# ---------------------------------------------------------------------------
+# Central API client
+# ---------------------------------------------------------------------------
+
+class CentralApi:
+    """Minimal stdlib HTTP client for the two calls replay needs.
+
+    Network failures raise OSError (urllib.error.URLError is one); HTTP error
+    statuses are returned, not raised.
+    """
+
+    def __init__(self, base_url: str = CENTRAL_API_URL, timeout: float = HTTP_TIMEOUT_S):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+
+    def _request(self, method: str, path: str, body: Optional[dict] = None,
+                 headers: Optional[Dict[str, str]] = None) -> Tuple[int, object]:
+        data = json.dumps(body).encode() if body is not None else None
+        req = urllib.request.Request(self.base_url + path, data=data, method=method,
+                                     headers={"Content-Type": "application/json", **(headers or {})})
+        try:
+            with urllib.request.urlopen(req, timeout=self.timeout) as resp:
+                return resp.status, json.loads(resp.read() or b"null")
+        except urllib.error.HTTPError as e:
+            try:
+                return e.code, json.loads(e.read() or b"null")
+            except ValueError:
+                return e.code, None
+
+    def post_rec(self, payload: dict, idempotency_key: str) -> Tuple[int, object]:
+        return self._request("POST", "/prebatch-recs/", payload, {"Idempotency-Key": idempotency_key})
+
+    def lot_remain(self, intake_lot_id: str) -> Optional[float]:
+        status, body = self._request("GET", f"/stock-adjustments/lot-lookup/{urllib.parse.quote(intake_lot_id, safe='')}")
+        return body.get("remain_vol") if status == 200 and isinstance(body, dict) else None
+
+
+# ---------------------------------------------------------------------------
+# Journal
+# ---------------------------------------------------------------------------
+
+class StationJournal:
+    def __init__(self, path: str = JOURNAL_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._replay_lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # WAL + NORMAL: a committed bag survives a process crash; only an OS crash
+        # can lose the last few, which the station would re-weigh anyway
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+
+    def close(self):
+        self._conn.close()
+
+    def append(self, payload: dict, idempotency_key: Optional[str] = None) -> dict:
+        """Journal one bag; returns its entry. Re-appending the same bag returns the existing entry.
+
+        Raises ValueError when the key or batch_record_id is already journalled
+        for a different bag.
+        """
+        body = json.dumps(payload, sort_keys=True)
+        batch_record_id = payload["batch_record_id"]
+        with self._lock:
+            existing = self._conn.execute(
+                "SELECT * FROM journal WHERE idempotency_key = ? OR batch_record_id = ? ORDER BY seq DESC LIMIT 1",
+                (idempotency_key or "", batch_record_id),
+            ).fetchone()
+            if existing is not None and existing["status"] not in ("conflict", "rejected"):
+                if existing["payload"] != body:
+                    raise ValueError(f"batch_record_id '{batch_record_id}' is already journalled with different values")
+                return _row(existing)
+            key = idempotency_key or uuid.uuid4().hex
+            try:
+                cur = self._conn.execute(
+                    "INSERT INTO journal (idempotency_key, batch_record_id, payload, created_at) VALUES (?, ?, ?, ?)",
+                    (key, batch_record_id, body, _now()),
+                )
+            except sqlite3.IntegrityError:
+                raise ValueError(f"Idempotency-Key '{key}' is already journalled")
+            return _row(self._conn.execute("SELECT * FROM journal WHERE seq = ?", (cur.lastrowid,)).fetchone())
+
+    def entries(self, status: Optional[str] = None, limit: int = 500) -> List[dict]:
+        with self._lock:
+            if status:
+                rows = self._conn.execute("SELECT * FROM journal WHERE status = ? ORDER BY seq LIMIT ?", (status, limit))
+            else:
+                rows = self._conn.execute("SELECT * FROM journal ORDER BY seq LIMIT ?", (limit,))
+            return [_row(r) for r in rows.fetchall()]
+
+    def counts(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._conn.execute("SELECT status, COUNT(*) FROM journal GROUP BY status").fetchall())
+
+    def conflicts(self) -> List[dict]:
+        """Bags that need a supervisor: overdrawn lots, key conflicts, rejections and repeated 5xx."""
+        placeholders = ",".join("?" * len(PROBLEM_STATES))
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT * FROM journal WHERE status IN ({placeholders}) ORDER BY seq", PROBLEM_STATES
+            ).fetchall()
+        report = []
+        for r in map(_row, rows):
+            p = r["payload"]
+            report.append({
+                "seq": r["seq"], "status": r["status"], "batch_record_id": r["batch_record_id"],
+                "re_code": p.get("re_code"), "net_volume": p.get("net_volume"),
+                "lots": _drawn_lots(p), "lot_balances": r["lot_balances"],
+                "server_id": r["server_id"], "error": r["last_error"],
+                "created_at": r["created_at"], "synced_at": r["synced_at"],
+            })
+        return report
+
+    def _finish(self, seq: int, status: str, server_id=None, error=None, lot_balances=None):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE journal SET status = ?, server_id = ?, last_error = ?, lot_balances = ?, "
+                "attempts = attempts + 1, synced_at = ? WHERE seq = ?",
+                (status, server_id, error, json.dumps(lot_balances) if lot_balances else None, _now(), seq),
+            )
+
+    def _retry_later(self, seq: int, error: str, attempted: bool = True):
+        with self._lock:
+            self._conn.execute("UPDATE journal SET attempts = attempts + ?, last_error = ? WHERE seq = ?",
+                               (int(attempted), error, seq))
+
+    def requeue_failed(self) -> int:
+        """Move failed bags back to pending with a fresh attempt count. Returns bags requeued."""
+        with self._lock:
+            return self._conn.execute(
+                "UPDATE journal SET status = 'pending', attempts = 0 WHERE status = 'failed'"
+            ).rowcount
+
+    def replay(self, api: CentralApi, limit: int = 500) -> Dict[str, int]:
+        """Post pending bags in journal order until one cannot be delivered.
+
+        Stops at the first network error or 5xx so later bags never overtake an
+        earlier one, except a bag answered 5xx MAX_SERVER_ERRORS times: it is
+        marked failed and replay carries on. Returns the number of entries
+        moved to each state.
+        """
+        done: Dict[str, int] = {}
+        with self._replay_lock:
+            for entry in self.entries("pending", limit):
+                try:
+                    status, body = api.post_rec(entry["payload"], entry["idempotency_key"])
+                except OSError as e:
+                    self._retry_later(entry["seq"], f"Central API unreachable: {e}", attempted=False)
+                    break
+                detail = body.get("detail") if isinstance(body, dict) else None
+                if status >= 500 and entry["attempts"] + 1 < MAX_SERVER_ERRORS:
+                    self._retry_later(entry["seq"], f"HTTP {status}: {detail}")
+                    break
+                if status >= 500:
+                    state, server_id, balances = "failed", None, None
+                    detail = f"HTTP {status}: {detail}"
+                elif status == 409:
+                    state, server_id, balances = "conflict", None, None
+                elif status >= 400:
+                    state, server_id, balances = "rejected", None, None
+                else:
+                    server_id = body.get("id") if isinstance(body, dict) else None
+                    balances = self._overdrawn_lots(api, entry["payload"])
+                    state = "overdrawn" if balances else "synced"
+                self._finish(entry["seq"], state, server_id, str(detail) if detail else None, balances)
+                done[state] = done.get(state, 0) + 1
+        return done
+
+    @staticmethod
+    def _overdrawn_lots(api: CentralApi, payload: dict) -> Dict[str, float]:
+        balances = {}
+        for lot_id in _drawn_lots(payload):
+            try:
+                remain = api.lot_remain(lot_id)
+            except OSError:
+                continue
+            if remain is not None and remain < -1e-6:
+                balances[lot_id] = remain
+        return balances
+
+
+# ---------------------------------------------------------------------------
+# Sidecar app
+# ---------------------------------------------------------------------------
+
+def create_app(journal: StationJournal, api: CentralApi, replay_interval_s: float = REPLAY_INTERVAL_S):
+    """Local API the station UI saves bags to; replays to the central API in the background."""
+    from fastapi import FastAPI, Header, HTTPException
+    from fastapi.middleware.cors import CORSMiddleware
+    import schemas
+
+    app = FastAPI(title="xMixing Station Journal")
+    app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])
+    stop = threading.Event()
+
+    def loop():
+        while not stop.wait(replay_interval_s):
+            try:
+                journal.replay(api)
+            except Exception as e:
+                print(f"Replay failed: {e}")
+
+    @app.on_event("startup")
+    def start_replay():
+        threading.Thread(target=loop, name="station-journal-replay", daemon=True).start()
+
+    @app.on_event("shutdown")
+    def stop_replay():
+        stop.set()
+
+    @app.post("/prebatch-recs/", status_code=202)
+    def journal_prebatch_rec(record: schemas.PreBatchRecCreate,
+                             idempotency_key: Optional[str] = Header(None, max_length=100)):
+        """Journal a bag locally; it reaches the central API on the next replay."""
+        try:
+            entry = journal.append(record.model_dump(mode="json"), idempotency_key)
+        except ValueError as e:
+            raise HTTPException(status_code=409, detail=str(e))
+        return {"seq": entry["seq"], "idempotency_key": entry["idempotency_key"], "status": entry["status"]}
+
+    @app.get("/journal")
+    def journal_status(status: Optional[str] = None, limit: int = 500):
+        return {"counts": journal.counts(), "entries": journal.entries(status, limit)}
+
+    @app.get("/journal/conflicts")
+    def journal_conflicts():
+        return journal.conflicts()
+
+    @app.post("/journal/replay")
+    def journal_replay():
+        return journal.replay(api)
+
+    return app
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else "report"
+    journal = StationJournal()
+    api = CentralApi()
+    if command == "serve":
+        import uvicorn
+        uvicorn.run(create_app(journal, api), host="0.0.0.0", port=STATION_PORT)
+    elif command == "replay":
+        print(f"Replaying {journal.path} to {api.base_url}...")
+        print(f"Result: {journal.replay(api)}")
+        print(f"Journal: {journal.counts()}")
+    elif command == "report":
+        print(f"Journal: {journal.counts()}")
+        for c in journal.conflicts():
+            print(f"  #{c['seq']} {c['status']:<9} {c['batch_record_id']} {c['re_code']} {c['net_volume']} "
+                  f"lots={c['lot_balances'] or c['lots']} {c['error'] or ''}")
+    elif command == "requeue":
+        print(f"Requeued {journal.requeue_failed()} failed bags")
+    else:
+        print(__doc__)
+        sys.exit(1)
+    journal.close()
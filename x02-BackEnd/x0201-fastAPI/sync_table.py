@@ -14,6 +14,8 @@ DB_NAME = os.getenv("DB_NAME", "xMixingControl")
 CLOUD_HOST = os.getenv("CLOUD_DB", "152.42.166.150")
 REMOTE_HOST = os.getenv("REMOTE_DB", "192.168.121.11")
 
+SYNCED_PLAN_TABLES = ("production_plans", "production_batches", "prebatch_reqs")
+
 def sync_table(table_name):
     cloud_url = f"mysql+pymysql://{DB_USER}:{DB_PASSWORD}@{CLOUD_HOST}:{DB_PORT}/{DB_NAME}"
     remote_url = f"mysql+pymysql://{DB_USER}:{DB_PASSWORD}@{REMOTE_HOST}:{DB_PORT}/{DB_NAME}"
@@ -31,6 +33,9 @@ def sync_table(table_name):
             conn.execute(text("SET FOREIGN_KEY_CHECKS = 0;"))
             conn.execute(text(f"DELETE FROM {table_name}"))
             conn.execute(text("SET FOREIGN_KEY_CHECKS = 1;"))
+            if table_name in SYNCED_PLAN_TABLES:
+                # Plan list clients reload instead of merging deltas (see plan_sync.py)
+                conn.execute(text("INSERT INTO sync_tombstones (table_name) VALUES ('*')"))
             conn.commit()
             
             print(f"Writing data to Remote.{table_name}...")
@@ -0,0 +1,33 @@
+"""
+Write daily stock snapshots from the stock ledger (run once a day, e.g. from cron).
+
+Usage:
+    python take_stock_snapshots.py              # snapshot every day up to yesterday
+    python take_stock_snapshots.py 2026-01-31   # up to a given day
+    python take_stock_snapshots.py --rebuild    # drop and recompute all snapshots
+"""
+import sys
+from datetime import date
+
+import models
+from database import Base, SessionLocal, engine
+from crud.crud_ledger import rebuild_stock_snapshots, take_stock_snapshots
+
+
+def snapshot(up_to=None, rebuild=False):
+    Base.metadata.create_all(bind=engine, tables=[models.StockSnapshot.__table__])
+    db = SessionLocal()
+    try:
+        print(f"{'Rebuilding' if rebuild else 'Taking'} stock snapshots up to {up_to or 'yesterday'}...")
+        count = (rebuild_stock_snapshots if rebuild else take_stock_snapshots)(db, up_to)
+        print(f"Successfully wrote {count} snapshot rows.")
+    except Exception as e:
+        db.rollback()
+        print(f"Error during snapshot: {e}")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    args = [a for a in sys.argv[1:] if a != "--rebuild"]
+    snapshot(date.fromisoformat(args[0]) if args else None, rebuild="--rebuild" in sys.argv)
@@ -0,0 +1,129 @@
+from datetime import datetime, timedelta
+
+import pytest
+import models
+
+
+@pytest.fixture(scope="module")
+def fefo_lots(db):
+    soon = datetime.now() + timedelta(days=10)
+    later = datetime.now() + timedelta(days=40)
+    lots = [
+        ("FEFO-EXPIRED", datetime.now() - timedelta(days=1), 50.0, "FH"),
+        ("FEFO-SOON-S", soon, 3.0, "FH"),
+        ("FEFO-SOON-L", soon, 8.0, "FH"),
+        ("FEFO-LATER", later, 20.0, "FH"),
+        ("FEFO-NOEXP", None, 100.0, "FH"),
+        ("FEFO-SPP", soon - timedelta(days=5), 30.0, "SPP"),
+    ]
+    for lot_id, expire, remain, wh in lots:
+        db.add(models.IngredientIntakeList(intake_lot_id=lot_id, lot_id=lot_id, mat_sap_code="MAT-FEFO",
+                                           re_code="RE-FEFO", intake_to=wh, expire_date=expire,
+                                           intake_vol=remain, remain_vol=remain, intake_by="tester",
+                                           status="Active"))
+    db.commit()
+
+
+def _split(allocation):
+    return [(l["intake_lot_id"], l["take_volume"]) for l in allocation["lots"]]
+
+
+def test_fefo_split_by_expiry_then_fewest_lots(client, fefo_lots):
+    result = client.post("/allocations/fefo", json={"lines": [
+        {"re_code": "RE-FEFO", "volume": 5.0, "warehouse": "FH"},
+        {"re_code": "RE-FEFO", "volume": 10.0, "warehouse": "FH"},
+        {"re_code": "RE-FEFO", "volume": 500.0, "warehouse": "FH"},
+    ]}).json()
+    first, second, third = result["allocations"]
+    # One lot covers 5 within the earliest expiry date; expired and other-warehouse lots are skipped
+    assert _split(first) == [("FEFO-SOON-L", 5.0)]
+    # Shared stock: the second line sees what the first one left
+    assert _split(second) == [("FEFO-SOON-L", 3.0), ("FEFO-SOON-S", 3.0), ("FEFO-LATER", 4.0)]
+    assert third["allocated"] == 116.0 and third["shortfall"] == 384.0
+    assert result["complete"] is False
+
+    with_expired = client.post("/allocations/fefo", json={
+        "lines": [{"re_code": "RE-FEFO", "volume": 1.0}], "include_expired": True,
+    }).json()
+    assert _split(with_expired["allocations"][0]) == [("FEFO-EXPIRED", 1.0)]
+    assert client.post("/allocations/fefo", json={}).status_code == 400
+
+
+def test_fefo_for_batch_open_requirements(client, db, fefo_lots):
+    plan = models.ProductionPlan(plan_id="FEFO-PLAN", sku_id="SKU-FEFO", num_batches=1, batch_size=10.0)
+    db.add(plan)
+    db.flush()
+    batch = models.ProductionBatch(plan_id=plan.id, batch_id="FEFO-PLAN-001", sku_id="SKU-FEFO", batch_size=10.0)
+    db.add(batch)
+    db.flush()
+    req = models.PreBatchReq(batch_db_id=batch.id, plan_id="FEFO-PLAN", batch_id="FEFO-PLAN-001",
+                             re_code="RE-FEFO", required_volume=12.0, wh="SPP", status=1)
+    db.add(req)
+    db.commit()
+    # Already weighed, counted in the requirement's packaged_volume
+    assert client.post("/prebatch-recs/", json={
+        "req_id": req.id, "batch_record_id": "FEFO-PLAN-001-RE-FEFO-1", "plan_id": "FEFO-PLAN",
+        "re_code": "RE-FEFO", "net_volume": 2.0,
+    }).status_code == 200
+
+    result = client.post("/allocations/fefo", json={"plan_id": "FEFO-PLAN"}).json()
+    [allocation] = result["allocations"]
+    assert (allocation["ref"], allocation["volume"]) == ("FEFO-PLAN-001", 10.0)
+    assert _split(allocation) == [("FEFO-SPP", 10.0)]
+    assert result["complete"] is True
+
+
+def test_lot_reservations_hold_volume_until_commit_or_ttl(client, db):
+    import lot_reservations
+    db.add(models.IngredientIntakeList(intake_lot_id="RSV-LOT", lot_id="RSV-LOT", mat_sap_code="MAT-RSV",
+                                       re_code="RE-RSV", intake_vol=10.0, remain_vol=10.0,
+                                       intake_by="tester", status="Active"))
+    db.commit()
+    line = {"lines": [{"re_code": "RE-RSV", "volume": 10.0}]}
+
+    held = client.post("/allocations/reservations", json={
+        "intake_lot_id": "RSV-LOT", "volume": 6.0, "station": "FH-1", "ref": "RSV-BATCH-RE-RSV-1",
+    })
+    assert held.status_code == 201
+    assert client.post("/allocations/reservations", json={
+        "intake_lot_id": "RSV-LOT", "volume": 5.0, "station": "FH-2",
+    }).status_code == 409
+
+    lookup = client.get("/stock-adjustments/lot-lookup/RSV-LOT").json()
+    assert (lookup["reserved_vol"], lookup["available_vol"]) == (6.0, 4.0)
+    assert client.get("/stock-adjustments/lot-lookup/RSV-LOT?station=FH-1").json()["available_vol"] == 10.0
+    other = client.post("/allocations/fefo", json={**line, "station": "FH-2"}).json()["allocations"][0]
+    assert (other["allocated"], other["shortfall"]) == (4.0, 6.0)
+    own = client.post("/allocations/fefo", json={**line, "station": "FH-1"}).json()["allocations"][0]
+    assert own["allocated"] == 10.0
+
+    # Committing the bag the hold was for draws it down by the volume taken
+    client.post("/prebatch-recs/", json={"batch_record_id": "RSV-BATCH-RE-RSV-1", "re_code": "RE-RSV",
+                                         "net_volume": 4.0, "intake_lot_id": "RSV-LOT"})
+    [left] = client.get("/allocations/reservations?intake_lot_id=RSV-LOT").json()
+    assert left["volume"] == 2.0
+    assert client.delete(f"/allocations/reservations/{left['id']}").status_code == 200
+    assert client.get("/allocations/reservations?intake_lot_id=RSV-LOT").json() == []
+
+    # Allocate-and-reserve, then let the holds expire
+    reserved = client.post("/allocations/fefo", json={"lines": [{"re_code": "RE-RSV", "volume": 3.0}],
+                                                      "station": "FH-2", "reserve": True}).json()
+    assert reserved["allocations"][0]["lots"][0]["reservation_id"]
+    assert client.get("/stock-adjustments/lot-lookup/RSV-LOT").json()["reserved_vol"] == 3.0
+
+    # The same station reserving again: its holds for that ref are replaced, its other holds count
+    def reserve_again(volume, ref=None):
+        response = client.post("/allocations/fefo", json={"lines": [{"re_code": "RE-RSV", "volume": volume, "ref": ref}],
+                                                          "station": "FH-2", "reserve": True})
+        assert response.status_code == 200
+        [allocation] = response.json()["allocations"]
+        return allocation["allocated"], allocation["shortfall"]
+
+    assert reserve_again(2.0, ref="RSV-B") == (2.0, 0.0)
+    assert reserve_again(2.0, ref="RSV-B") == (2.0, 0.0)
+    assert [r["volume"] for r in lot_reservations.list_reservations(station="FH-2") if r["ref"] == "RSV-B"] == [2.0]
+    assert reserve_again(5.0) == (1.0, 4.0)  # 6 left on the lot, 5 already held by FH-2
+    assert client.get("/stock-adjustments/lot-lookup/RSV-LOT").json()["reserved_vol"] == 6.0
+    for r in lot_reservations._reservations.values():
+        r["expires_at"] = r["created_at"]
+    assert client.get("/stock-adjustments/lot-lookup/RSV-LOT").json()["reserved_vol"] == 0.0
@@ -30,6 +30,199 @@ def test_get_production_batches(client):
     # Batches should have been auto-created
     assert len(data) >= 2
 
+def test_plan_creation_inserts_batches_and_requirements(client, db):
+    import models
+    db.add(models.Sku(sku_id="SKU-BULKPLAN", sku_name="Bulk plan", std_batch_size=100.0, creat_by="tester"))
+    db.add(models.Ingredient(blind_code="BLIND-BP1", mat_sap_code="MAT-BP1", re_code="RE-BP1", name="Sugar",
+                             warehouse="FH", creat_by="tester"))
+    db.add_all([
+        models.SkuStep(sku_id="SKU-BULKPLAN", phase_number="P1", sub_step=1, re_code="RE-BP1", require=10.0),
+        models.SkuStep(sku_id="SKU-BULKPLAN", phase_number="P1", sub_step=2, re_code="RE-BP2", require=4.0),
+        models.SkuStep(sku_id="SKU-BULKPLAN", phase_number="P1", sub_step=3, re_code="RE-BP1", require=5.0),
+    ])
+    db.commit()
+
+    plan = client.post("/production-plans/", json={
+        "sku_id": "SKU-BULKPLAN", "plant": "Line-7", "batch_size": 200.0, "num_batches": 3, "created_by": "tester",
+    }).json()
+    assert [b["batch_id"] for b in plan["batches"]] == [f"{plan['plan_id']}-{n:03d}" for n in (1, 2, 3)]
+    assert all(b["reqs_total"] == 2 and b["status"] == "Created" for b in plan["batches"])
+
+    reqs = db.query(models.PreBatchReq).filter(models.PreBatchReq.plan_id == plan["plan_id"]).order_by(
+        models.PreBatchReq.batch_id, models.PreBatchReq.re_code).all()
+    assert [(r.batch_id[-3:], r.re_code, r.ingredient_name, r.required_volume, r.wh) for r in reqs] == [
+        (n, re_code, name, vol, wh)
+        for n in ("001", "002", "003")
+        for re_code, name, vol, wh in (("RE-BP1", "Sugar", 30.0, "FH"), ("RE-BP2", "RE-BP2", 8.0, "-"))
+    ]
+    batch_ids = {b["batch_id"]: b["id"] for b in plan["batches"]}
+    assert all(r.batch_db_id == batch_ids[r.batch_id] for r in reqs)
+
+
+def test_id_sequences_allocate_blocks(client, db):
+    from datetime import date
+    import crud
+    import models
+    seeded = []
+
+    def seed():
+        seeded.append(1)
+        return 7
+
+    assert list(crud.allocate_ids(db, "test", 3, scope="S1", seed=seed)) == [8, 9, 10]
+    assert list(crud.allocate_ids(db, "test", 2, scope="S1", seed=seed)) == [11, 12]
+    assert list(crud.allocate_ids(db, "test", scope="S2")) == [1]
+    assert len(seeded) == 1
+    db.rollback()  # an uncommitted block is handed out again
+    assert list(crud.allocate_ids(db, "test", scope="S1", seed=seed)) == [8]
+    db.commit()
+
+    # Plans made before the series existed are skipped
+    today = date.today()
+    db.add(models.ProductionPlan(plan_id=f"P008-{today:%y%m%d}-04", sku_id="SKU-SEQ"))
+    db.commit()
+    plan_ids = [client.post("/production-plans/", json={"sku_id": "SKU-SEQ", "plant": "Line-8"}).json()["plan_id"]
+                for _ in range(2)]
+    assert plan_ids == [f"P008-{today:%y%m%d}-05", f"P008-{today:%y%m%d}-06"]
+
+    # GET only previews; POST and a create without intake_lot_id reserve
+    preview = client.get("/ingredient-intake-next-id").json()["next_id"]
+    assert client.get("/ingredient-intake-next-id").json()["next_id"] == preview
+    intake_ids = [client.post("/ingredient-intake-next-id").json()["next_id"] for _ in range(2)]
+    assert intake_ids[0] == preview
+    assert intake_ids[1].endswith(f"{int(intake_ids[0][-3:]) + 1:03d}")
+    created = client.post("/ingredient-intake-lists/", json={
+        "mat_sap_code": "MAT-SEQ", "intake_vol": 5.0, "remain_vol": 5.0, "intake_by": "tester"})
+    assert created.json()["intake_lot_id"].endswith(f"{int(intake_ids[1][-3:]) + 1:03d}")
+    assert client.get("/ingredient-intake-next-id").json()["next_id"].endswith(
+        f"{int(intake_ids[1][-3:]) + 2:03d}")
+
+
+def test_production_plans_delta_sync_pages_and_etag(client, db, monkeypatch):
+    from datetime import datetime, timedelta
+    import models
+    from routers import router_production
+    monkeypatch.setattr(router_production, "SYNC_MARGIN_S", 0)
+    old = datetime(2020, 1, 1)
+    plans = [models.ProductionPlan(plan_id=f"SYNC-PLAN-{n}", sku_id="SKU-SYNC", created_at=old, updated_at=old)
+             for n in range(3)]
+    db.add_all(plans)
+    db.flush()
+    batch = models.ProductionBatch(plan_id=plans[1].id, batch_id="SYNC-PLAN-1-001", sku_id="SKU-SYNC",
+                                   created_at=old, updated_at=old)
+    db.add(batch)
+    db.flush()
+    req = models.PreBatchReq(batch_db_id=batch.id, plan_id="SYNC-PLAN-1", batch_id=batch.batch_id,
+                             re_code="RE-SYNC", created_at=old, updated_at=old)
+    db.add(req)
+    db.commit()
+
+    # Keyset pages cover every plan once, newest first
+    seen, cursor = [], None
+    for _ in range(100):
+        r = client.get("/production-plans/", params={"limit": 2, **({"cursor": cursor} if cursor else {})})
+        seen += [(p["created_at"], p["id"]) for p in r.json()]
+        cursor = r.headers.get("X-Next-Cursor")
+        if not cursor:
+            break
+    assert len(seen) == len(set(seen)) == db.query(models.ProductionPlan).count()
+    assert seen == sorted(seen, reverse=True)
+
+    # Unchanged: 304 with an empty body
+    r = client.get("/production-plans/")
+    etag, token = r.headers["ETag"], r.headers["X-Sync-Token"]
+    r = client.get("/production-plans/", headers={"If-None-Match": etag})
+    assert r.status_code == 304 and r.content == b""
+
+    # A requirement change brings its plan into the delta
+    req.status = 1
+    req.updated_at = datetime.now() + timedelta(days=1)
+    db.commit()
+    assert client.get("/production-plans/", headers={"If-None-Match": etag}).status_code == 200
+    delta = [p["plan_id"] for p in client.get("/production-plans/", params={"updated_since": token}).json()]
+    assert "SYNC-PLAN-1" in delta and "SYNC-PLAN-0" not in delta
+
+    req.updated_at = old
+    db.commit()
+
+    # Deletes: the plan that lost a batch is re-sent, a deleted plan is listed by id
+    import plan_sync
+    r = client.get("/production-plans/")
+    etag, token = r.headers["ETag"], r.headers["X-Sync-Token"]
+    extra = models.ProductionBatch(plan_id=plans[0].id, batch_id="SYNC-PLAN-0-001", sku_id="SKU-SYNC",
+                                   created_at=old, updated_at=old)
+    db.add(extra)
+    db.commit()
+    db.delete(extra)
+    gone_id = plans[2].id
+    db.delete(plans[2])
+    db.commit()
+    assert client.get("/production-plans/", headers={"If-None-Match": etag}).status_code == 200
+    r = client.get("/production-plans/", params={"updated_since": token})
+    delta = [p["plan_id"] for p in r.json()]
+    assert "SYNC-PLAN-0" in delta and "SYNC-PLAN-1" not in delta
+    assert r.headers["X-Deleted-Plans"] == str(gone_id) and "X-Sync-Reset" not in r.headers
+
+    # Rows wiped outside the ORM: the delta is the full list
+    with db.get_bind().begin() as conn:
+        plan_sync.record_reset(conn)
+    r = client.get("/production-plans/", params={"updated_since": token})
+    assert r.headers["X-Sync-Reset"] == "1"
+    assert len(r.json()) == db.query(models.ProductionPlan).count()
+
+
+def test_production_stats_single_pass_and_cached(client, db):
+    import threading
+    import time
+    import models
+    import report_cache
+    report_cache.clear()
+
+    stats = client.get("/production-stats/summary").json()
+    assert stats["plans"]["total"] == db.query(models.ProductionPlan).count()
+    assert stats["batches"]["total"] == db.query(models.ProductionBatch).count()
+    assert sum(p["plans"]["total"] for p in stats["by_plant"].values()) == stats["plans"]["total"]
+    assert sum(stats["records_today_by_warehouse"].values()) == stats["records_today"]
+
+    # Served from the cache until the TTL runs out
+    db.add(models.ProductionPlan(plan_id="STATS-PLAN", sku_id="SKU-STATS", plant="Line-5", status="In-Progress"))
+    db.commit()
+    assert client.get("/production-stats/summary").json()["plans"] == stats["plans"]
+    report_cache.clear()
+    fresh = client.get("/production-stats/summary").json()
+    assert fresh["plans"]["total"] == stats["plans"]["total"] + 1
+    assert fresh["by_plant"]["Line-5"]["plans"]["active"] >= 1
+
+    # Concurrent misses share one computation
+    calls = []
+
+    def slow():
+        calls.append(1)
+        time.sleep(0.1)
+        return len(calls)
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(report_cache.get_or_compute_ttl("stampede", 5, slow)))
+               for _ in range(10)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(calls) == 1 and results == [1] * 10
+
+    # A waiter stops waiting for a stuck computation and computes on its own
+    release = threading.Event()
+    stuck = threading.Thread(target=lambda: report_cache.get_or_compute_ttl("stuck", 5, release.wait))
+    stuck.start()
+    time.sleep(0.05)
+    assert report_cache.get_or_compute_ttl("stuck", 5, lambda: "direct", wait_s=0.1) == "direct"
+    release.set()
+    stuck.join()
+    stats = report_cache.stats()
+    assert stats["ttl"]["wait_timeouts"] == 1 and stats["ttl"]["misses"] >= 2
+    assert (stats["hits"], stats["misses"]) == (0, 0)  # the report cache's own counters are untouched
+
+
 def test_create_prebatch_record(client):
     # Get a plan_id first
     plans = client.get("/production-plans/").json()
@@ -51,3 +244,347 @@ def test_create_prebatch_record(client):
     assert response.status_code == 200
     data = response.json()
     assert data["batch_record_id"] == f"{plan_id}-B1-RE-TEST-001-1"
+
+def test_batch_counters_and_auto_prepare(client, db):
+    import crud
+    import models
+    plan = models.ProductionPlan(plan_id="CNT-PLAN", sku_id="SKU-CNT", num_batches=1, batch_size=10.0)
+    db.add(plan)
+    db.flush()
+    batch = models.ProductionBatch(plan_id=plan.id, batch_id="CNT-PLAN-001", sku_id="SKU-CNT",
+                                   batch_size=10.0, reqs_total=2)
+    db.add(batch)
+    db.flush()
+    reqs = [models.PreBatchReq(batch_db_id=batch.id, plan_id="CNT-PLAN", batch_id="CNT-PLAN-001",
+                               re_code=re_code, required_volume=2.0, status=0) for re_code in ("RE-C1", "RE-C2")]
+    db.add_all(reqs)
+    db.commit()
+
+    def bag(req, pkg):
+        return client.post("/prebatch-recs/", json={
+            "req_id": req.id, "batch_record_id": f"CNT-PLAN-001-{req.re_code}-{pkg}", "plan_id": "CNT-PLAN",
+            "re_code": req.re_code, "package_no": pkg, "total_packages": 2, "net_volume": 1.0,
+        }).json()
+
+    def counters():
+        db.expire_all()
+        b = db.get(models.ProductionBatch, batch.id)
+        return b.reqs_completed, b.bags_weighed, b.status
+
+    bag(reqs[0], 1)
+    bag(reqs[0], 2)
+    assert counters() == (1, 2, "Created")
+    last = bag(reqs[1], 1)
+    bag(reqs[1], 2)
+    assert counters() == (2, 4, "Prepared")
+
+    client.delete(f"/prebatch-recs/{last['id']}")
+    assert counters()[:2] == (1, 3)
+    client.put(f"/prebatch-reqs/{reqs[1].id}/status?status=2")
+    assert counters()[:2] == (2, 3)
+
+    db.query(models.ProductionBatch).filter(models.ProductionBatch.id == batch.id).update(
+        {"reqs_total": 0, "reqs_completed": 0, "bags_weighed": 0})
+    db.commit()
+    crud.rebuild_batch_counters(db)
+    db.expire_all()
+    b = db.get(models.ProductionBatch, batch.id)
+    assert (b.reqs_total, b.reqs_completed, b.bags_weighed) == (2, 2, 3)
+
+
+def test_req_packaged_volume_and_progress_endpoints(client, db):
+    import crud
+    import models
+    plan = models.ProductionPlan(plan_id="PKV-PLAN", sku_id="SKU-PKV", num_batches=2, batch_size=10.0)
+    db.add(plan)
+    db.flush()
+    reqs = []
+    for n in (1, 2):
+        batch = models.ProductionBatch(plan_id=plan.id, batch_id=f"PKV-PLAN-00{n}", sku_id="SKU-PKV",
+                                       batch_size=10.0, reqs_total=1)
+        db.add(batch)
+        db.flush()
+        reqs.append(models.PreBatchReq(batch_db_id=batch.id, plan_id="PKV-PLAN", batch_id=batch.batch_id,
+                                       re_code="RE-PKV", ingredient_name="Salt", required_volume=3.0, status=0))
+    db.add_all(reqs)
+    db.commit()
+
+    def bag(req, pkg, vol):
+        return client.post("/prebatch-recs/", json={
+            "req_id": req.id, "batch_record_id": f"{req.batch_id}-RE-PKV-{pkg}", "plan_id": "PKV-PLAN",
+            "re_code": "RE-PKV", "package_no": pkg, "total_packages": 2, "net_volume": vol,
+        }).json()
+
+    bag(reqs[0], 1, 1.5)
+    bag(reqs[0], 2, 1.5)
+    last = bag(reqs[1], 1, 1.25)
+    bag(reqs[1], 2, 0.5)
+    client.delete(f"/prebatch-recs/{last['id']}")
+
+    by_batch = client.get("/prebatch-reqs/by-batch/PKV-PLAN-001").json()
+    assert (by_batch[0]["total_packaged"], by_batch[0]["bag_count"]) == (3.0, 2)
+    assert [(b["batch_id"], b["actual_volume"]) for b in
+            client.get("/prebatch-reqs/batches-by-ingredient/PKV-PLAN/RE-PKV").json()] == \
+        [("PKV-PLAN-001", 3.0), ("PKV-PLAN-002", 0.5)]
+    summary = client.get("/prebatch-reqs/summary-by-plan/PKV-PLAN").json()
+    assert len(summary) == 1
+    assert {k: summary[0][k] for k in ("total_required", "total_packaged", "batch_count", "completed_batches", "status")} \
+        == {"total_required": 6.0, "total_packaged": 3.5, "batch_count": 2, "completed_batches": 1, "status": 1}
+
+    db.query(models.PreBatchReq).filter(models.PreBatchReq.plan_id == "PKV-PLAN").update(
+        {"packaged_volume": 0, "bag_count": 0})
+    db.commit()
+    crud.rebuild_req_progress(db)
+    db.expire_all()
+    assert [(r.packaged_volume, r.bag_count) for r in (db.get(models.PreBatchReq, r.id) for r in reqs)] == \
+        [(3.0, 2), (0.5, 1)]
+
+
+def test_recheck_uses_cached_sku_tolerances(client, db):
+    import models
+    db.add(models.Sku(sku_id="SKU-RCK", sku_name="Recheck SKU", std_batch_size=10.0, creat_by="tester"))
+    step = models.SkuStep(sku_id="SKU-RCK", phase_number="P1", sub_step=1, re_code="RE-RCK-A", high_tol=0.2)
+    db.add_all([step, models.SkuStep(sku_id="SKU-RCK", phase_number="P1", sub_step=2, re_code="RE-RCK-B", high_tol=0)])
+    plan = models.ProductionPlan(plan_id="RCK-PLAN", sku_id="SKU-RCK", sku_name="Recheck SKU", num_batches=1,
+                                 batch_size=10.0)
+    db.add(plan)
+    db.flush()
+    batch = models.ProductionBatch(plan_id=plan.id, batch_id="RCK-PLAN-001", sku_id="SKU-RCK", batch_size=10.0)
+    db.add(batch)
+    db.flush()
+    bags = []
+    for re_code, required, net in (("RE-RCK-A", 5.0, 5.1), ("RE-RCK-B", 4.0, 4.1), ("RE-RCK-C", 1.0, 1.02)):
+        req = models.PreBatchReq(batch_db_id=batch.id, plan_id="RCK-PLAN", batch_id="RCK-PLAN-001",
+                                 re_code=re_code, required_volume=required, status=0)
+        db.add(req)
+        db.flush()
+        bags.append(models.PreBatchRec(req_id=req.id, batch_record_id=f"RCK-PLAN-001-{re_code}-1", plan_id="RCK-PLAN",
+                                       batch_id="RCK-PLAN-001", re_code=re_code, package_no=1, total_packages=1, net_volume=net))
+    db.add_all(bags)
+    db.commit()
+
+    # Cold tolerance cache: bags, plan and the SKU's steps, one query each; the bags are not reloaded
+    import report_cache
+    from sqlalchemy import event
+    report_cache.clear()
+    statements = []
+
+    def count(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(db.get_bind(), "before_cursor_execute", count)
+    try:
+        box = client.get("/prebatch-recs/recheck-box/RCK-PLAN-001").json()
+    finally:
+        event.remove(db.get_bind(), "before_cursor_execute", count)
+    assert len(statements) == 3, statements
+    assert (box["sku_id"], box["total_bags"]) == ("SKU-RCK", 3)
+    # high_tol, 1% of target when high_tol is 0, 50 g default when the SKU has no step
+    assert sorted((b["re_code"], b["target_volume"], round(b["tolerance"], 6), b["is_valid"]) for b in box["bags"]) == [
+        ("RE-RCK-A", 5.0, 0.2, True), ("RE-RCK-B", 4.0, 0.04, False), ("RE-RCK-C", 1.0, 0.05, True),
+    ]
+
+    def scan(re_code):
+        return client.post("/prebatch-recs/recheck-bag", json={
+            "box_id": "RCK-PLAN-001", "bag_barcode": f"RCK-PLAN-001-{re_code}-1", "operator": "qc"}).json()
+
+    assert scan("RE-RCK-A")["status"] == "OK"
+    assert scan("RE-RCK-B")["status"] == "ERROR"
+
+    # Editing a step invalidates the SKU's compiled tolerances
+    step.high_tol = 0.05
+    db.commit()
+    result = scan("RE-RCK-A")
+    assert (result["status"], result["bag"]["tolerance"]) == ("ERROR", 0.05)
+    db.expire_all()
+    assert (bags[0].recheck_status, bags[0].recheck_by) == (2, "qc")
+
+
+def test_box_counters_follow_bags(client, db):
+    import crud
+    import models
+    plan = models.ProductionPlan(plan_id="BOX-PLAN", sku_id="SKU-BOX", num_batches=1, batch_size=10.0)
+    db.add(plan)
+    db.flush()
+    batch = models.ProductionBatch(plan_id=plan.id, batch_id="BOX-PLAN-001", sku_id="SKU-BOX", batch_size=10.0,
+                                   reqs_total=2)
+    db.add(batch)
+    db.flush()
+    reqs = [models.PreBatchReq(batch_db_id=batch.id, plan_id="BOX-PLAN", batch_id="BOX-PLAN-001", re_code=re_code,
+                               required_volume=1.0, wh=wh, status=0)
+            for re_code, wh in (("RE-BOX-A", "FH"), ("RE-BOX-B", "SPP"))]
+    db.add_all(reqs)
+    db.commit()
+
+    ids = {}
+    for req, pkgs in ((reqs[0], (1, 2)), (reqs[1], (1,))):
+        for pkg in pkgs:
+            barcode = f"BOX-PLAN-001-{req.re_code}-{pkg}"
+            ids[barcode] = client.post("/prebatch-recs/", json={
+                "req_id": req.id, "batch_record_id": barcode, "plan_id": "BOX-PLAN", "re_code": req.re_code,
+                "package_no": pkg, "total_packages": len(pkgs), "net_volume": 1.0,
+            }).json()["id"]
+
+    def boxes():
+        return {b["wh"]: (b["expected_bags"], b["bag_count"], b["packed_count"], b["recheck_ok"], b["recheck_error"])
+                for b in client.get("/prebatch-boxes/?batch_id=BOX-PLAN-001").json()}
+
+    def scan(barcode):
+        return client.post("/prebatch-recs/recheck-bag", json={
+            "box_id": "BOX-PLAN-001", "bag_barcode": barcode, "operator": "qc"}).json()["status"]
+
+    assert boxes() == {"FH": (2, 2, 0, 0, 0), "SPP": (1, 1, 0, 0, 0)}
+    client.patch(f"/prebatch-recs/{ids['BOX-PLAN-001-RE-BOX-A-1']}/packing-status", json={"packing_status": 1})
+    assert scan("BOX-PLAN-001-RE-BOX-A-1") == "OK"
+    assert scan("BOX-PLAN-001-RE-BOX-A-2") == "OK"
+    assert boxes() == {"FH": (2, 2, 1, 2, 0), "SPP": (1, 1, 0, 0, 0)}
+    release = client.patch("/production-batches/BOX-PLAN-001/release")
+    assert (release.status_code, release.json()["detail"]) == \
+        (400, "Re-check incomplete. 1 bag(s) still pending or have errors.")
+
+    assert scan("BOX-PLAN-001-RE-BOX-A-1") == "OK"  # a repeated scan counts the bag once
+    assert boxes() == {"FH": (2, 2, 1, 2, 0), "SPP": (1, 1, 0, 0, 0)}
+
+    assert scan("BOX-PLAN-001-RE-BOX-B-1") == "OK"
+    # A bag saved without a requirement is in no box but still has to pass re-check
+    db.add(models.PreBatchRec(batch_record_id="BOX-PLAN-001-RE-BOX-C-1", plan_id="BOX-PLAN", batch_id="BOX-PLAN-001",
+                              re_code="RE-BOX-C", package_no=1, total_packages=1, net_volume=1.0, total_volume=1.0))
+    db.commit()
+    release = client.patch("/production-batches/BOX-PLAN-001/release")
+    assert (release.status_code, release.json()["detail"]) == \
+        (400, "Re-check incomplete. 1 bag(s) still pending or have errors.")
+    assert scan("BOX-PLAN-001-RE-BOX-C-1") == "OK"
+    assert client.patch("/production-batches/BOX-PLAN-001/release").status_code == 200
+
+    # Deleting a requirement's last bag takes its expected bags out too
+    client.delete(f"/prebatch-recs/{ids['BOX-PLAN-001-RE-BOX-B-1']}")
+    client.patch("/production-batches/by-batch-id/BOX-PLAN-001/box-close", json={"wh": "FH", "operator": "packer"})
+    assert boxes() == {"FH": (2, 2, 1, 2, 0), "SPP": (0, 0, 0, 0, 0)}
+    ready = [b for b in client.get("/production-batches/ready-to-deliver").json() if b["batch_id"] == "BOX-PLAN-001"]
+    assert [(x["wh"], x["closed_by"]) for x in ready[0]["boxes"] if x["closed_at"]] == [("FH", "packer")]
+    packing = client.get("/reports/packing-list/BOX-PLAN").json()
+    assert [(b["wh"], b["packed_count"]) for b in packing["boxes"]] == [("FH", 1), ("SPP", 0)]
+
+    incremental = boxes()
+    db.query(models.PreBatchBox).filter(models.PreBatchBox.batch_id == "BOX-PLAN-001").update(
+        {"bag_count": 0, "packed_count": 0, "recheck_ok": 0, "expected_bags": 0})
+    db.commit()
+    crud.rebuild_boxes(db)
+    assert boxes() == incremental
+
+
+def test_bulk_prebatch_recs(client, db):
+    import models
+    plan = models.ProductionPlan(plan_id="BLK-PLAN", sku_id="SKU-BLK", num_batches=1, batch_size=10.0)
+    db.add(plan)
+    db.flush()
+    batch = models.ProductionBatch(plan_id=plan.id, batch_id="BLK-PLAN-001", sku_id="SKU-BLK",
+                                   batch_size=10.0, reqs_total=1)
+    db.add(batch)
+    db.flush()
+    req = models.PreBatchReq(batch_db_id=batch.id, plan_id="BLK-PLAN", batch_id="BLK-PLAN-001",
+                             re_code="RE-BLK", required_volume=3.0, status=0)
+    db.add(req)
+    for lot in ("BLK-LOT-A", "BLK-LOT-B"):
+        db.add(models.IngredientIntakeList(intake_lot_id=lot, lot_id=lot, mat_sap_code="MAT-BLK", re_code="RE-BLK",
+                                           intake_vol=10.0, remain_vol=10.0, intake_by="tester"))
+    db.commit()
+
+    def bag(pkg, **kw):
+        return {"req_id": req.id, "batch_record_id": f"BLK-PLAN-001-RE-BLK-{pkg}", "plan_id": "BLK-PLAN",
+                "re_code": "RE-BLK", "package_no": pkg, "total_packages": 3, "net_volume": 1.0, **kw}
+
+    results = client.post("/prebatch-recs/bulk", json=[
+        bag(1, intake_lot_id="BLK-LOT-A"),
+        bag(2, origins=[{"intake_lot_id": "BLK-LOT-A", "take_volume": 0.4},
+                        {"intake_lot_id": "BLK-LOT-B", "take_volume": 0.6}]),
+        bag(2, intake_lot_id="BLK-LOT-A"),
+        bag(3, intake_lot_id="NO-SUCH-LOT"),
+        bag(3, intake_lot_id="BLK-LOT-B"),
+    ]).json()
+    assert [(r["ok"], r["error"]) for r in results] == [
+        (True, None), (True, None),
+        (False, "Duplicate batch_record_id 'BLK-PLAN-001-RE-BLK-2'"),
+        (False, "Lot 'NO-SUCH-LOT' not found"),
+        (True, None),
+    ]
+
+    db.expire_all()
+    remain = {l.intake_lot_id: l.remain_vol for l in db.query(models.IngredientIntakeList).filter(
+        models.IngredientIntakeList.intake_lot_id.in_(["BLK-LOT-A", "BLK-LOT-B"]))}
+    assert remain == {"BLK-LOT-A": 8.6, "BLK-LOT-B": 8.4}
+    assert db.query(models.StockLedger).filter(models.StockLedger.reference.like("BLK-PLAN-001-%")).count() == 4
+    b = db.get(models.ProductionBatch, batch.id)
+    assert (b.bags_weighed, b.reqs_completed, b.status) == (3, 1, "Prepared")
+
+
+def test_prebatch_rec_retries_are_idempotent(client, db):
+    import models
+    db.add(models.IngredientIntakeList(intake_lot_id="IDEM-LOT", lot_id="IDEM-LOT", mat_sap_code="MAT-IDEM",
+                                       re_code="RE-IDEM", intake_vol=10.0, remain_vol=10.0, intake_by="tester"))
+    db.commit()
+    bag = {"batch_record_id": "IDEM-BATCH-RE-IDEM-1", "re_code": "RE-IDEM", "net_volume": 2.0,
+           "intake_lot_id": "IDEM-LOT"}
+
+    first = client.post("/prebatch-recs/", json=bag, headers={"Idempotency-Key": "idem-1"})
+    again = client.post("/prebatch-recs/", json=bag, headers={"Idempotency-Key": "idem-1"})
+    no_key = client.post("/prebatch-recs/", json=bag)
+    assert first.status_code == again.status_code == no_key.status_code == 200
+    assert first.json()["id"] == again.json()["id"] == no_key.json()["id"]
+    assert "idempotent-replay" not in first.headers
+    assert again.headers["idempotent-replay"] == "true"
+
+    db.expire_all()
+    assert db.get(models.IngredientIntakeList, "IDEM-LOT").remain_vol == 8.0
+    assert client.post("/prebatch-recs/", json={**bag, "net_volume": 3.0},
+                       headers={"Idempotency-Key": "idem-1"}).status_code == 409
+    assert client.post("/prebatch-recs/", json={**bag, "net_volume": 3.0}).status_code == 409
+
+
+def test_bag_barcode_parts_stored_and_backfilled(client, db):
+    import barcodes
+    import crud
+    import models
+    assert barcodes.parse_bag_barcode("P-1-003-RE-1-A-12", "RE-1-A") == ("P-1-003", "RE-1-A", 12)
+    assert barcodes.parse_bag_barcode("P-1-003-RE-1-A-12", plan_id="P-1") == ("P-1-003", "RE-1-A", 12)
+    assert barcodes.parse_bag_barcode("P-1-003-RE-1-A-12", "RE-9") is None
+
+    plan = models.ProductionPlan(plan_id="BC-PLAN", sku_id="SKU-BC", num_batches=1, batch_size=10.0)
+    db.add(plan)
+    db.flush()
+    batch = models.ProductionBatch(plan_id=plan.id, batch_id="BC-PLAN-001", sku_id="SKU-BC", batch_size=10.0)
+    db.add(batch)
+    db.flush()
+    req = models.PreBatchReq(batch_db_id=batch.id, plan_id="BC-PLAN", batch_id="BC-PLAN-001", re_code="RE-BC",
+                             required_volume=2.0, status=0)
+    db.add(req)
+    db.commit()
+
+    # Written through the API: batch from the requirement, package_no parsed when not sent
+    created = client.post("/prebatch-recs/", json={
+        "req_id": req.id, "batch_record_id": "BC-PLAN-001-RE-BC-1", "plan_id": "BC-PLAN", "re_code": "RE-BC",
+        "total_packages": 2, "net_volume": 1.0, "recode_batch_id": "R1",
+    }).json()
+    assert (created["batch_id"], created["package_no"], created["prebatch_id"]) == \
+        ("BC-PLAN-001", 1, "BC-PLAN-001RE-BCR1")
+    # Without a requirement: batch and package_no parsed from the barcode
+    legacy = client.post("/prebatch-recs/", json={
+        "batch_record_id": "BC-PLAN-001-RE-BC-2", "plan_id": "BC-PLAN", "re_code": "RE-BC",
+        "total_packages": 2, "net_volume": 1.0,
+    }).json()
+    assert (legacy["batch_id"], legacy["package_no"]) == ("BC-PLAN-001", 2)
+
+    box = client.get("/prebatch-recs/recheck-box/BC-PLAN-001").json()
+    assert box["total_bags"] == 2
+    assert client.post("/prebatch-recs/recheck-bag", json={
+        "box_id": "BC-PLAN-002", "bag_barcode": "BC-PLAN-001-RE-BC-2", "operator": "qc"}).status_code == 400
+
+    # Rows from before the column existed are filled by the backfill
+    db.query(models.PreBatchRec).filter(models.PreBatchRec.plan_id == "BC-PLAN").update(
+        {"batch_id": None, "package_no": None})
+    db.commit()
+    assert crud.backfill_rec_barcodes(db) >= 2
+    db.expire_all()
+    assert sorted((r.batch_id, r.package_no) for r in
+                  db.query(models.PreBatchRec).filter(models.PreBatchRec.plan_id == "BC-PLAN")) == \
+        [("BC-PLAN-001", 1), ("BC-PLAN-001", 2)]
@@ -0,0 +1,243 @@
+import json
+
+import pytest
+import models
+
+
+@pytest.fixture(scope="module")
+def trace_plan(db):
+    """Plan with two batches and two lots of the same ingredient."""
+    plan = models.ProductionPlan(plan_id="TRC-PLAN-01", sku_id="SKU-TRC", sku_name="Trace SKU",
+                                 plant="Line-1", num_batches=2, batch_size=100.0)
+    db.add(plan)
+    db.flush()
+    for n in (1, 2):
+        batch = models.ProductionBatch(plan_id=plan.id, batch_id=f"TRC-PLAN-01-00{n}",
+                                       sku_id="SKU-TRC", plant="Line-1", batch_size=100.0)
+        db.add(batch)
+        db.flush()
+        db.add(models.PreBatchReq(batch_db_id=batch.id, plan_id="TRC-PLAN-01", batch_id=batch.batch_id,
+                                  re_code="RE-TRC", ingredient_name="Trace Sugar",
+                                  required_volume=10.0, wh="FH", status=0))
+    for lot in ("TRC-LOT-A", "TRC-LOT-B"):
+        db.add(models.IngredientIntakeList(intake_lot_id=lot, lot_id=f"{lot}-SUP", mat_sap_code="MAT-TRC",
+                                           re_code="RE-TRC", intake_vol=100.0, remain_vol=100.0,
+                                           intake_by="tester", status="Active"))
+    db.commit()
+    return plan
+
+
+def _post_bag(client, db, batch_id, pkg, origins):
+    req = db.query(models.PreBatchReq).filter(models.PreBatchReq.batch_id == batch_id).first()
+    response = client.post("/prebatch-recs/", json={
+        "req_id": req.id,
+        "batch_record_id": f"{batch_id}-RE-TRC-{pkg}",
+        "plan_id": "TRC-PLAN-01",
+        "re_code": "RE-TRC",
+        "package_no": pkg,
+        "total_packages": 2,
+        "net_volume": sum(o["take_volume"] for o in origins),
+        "origins": origins,
+    })
+    assert response.status_code == 200
+    return response.json()
+
+
+def test_traceability_forward_backward_recall(client, db, trace_plan):
+    _post_bag(client, db, "TRC-PLAN-01-001", 1, [
+        {"intake_lot_id": "TRC-LOT-A", "mat_sap_code": "MAT-TRC", "take_volume": 4.0},
+        {"intake_lot_id": "TRC-LOT-B", "mat_sap_code": "MAT-TRC", "take_volume": 1.0},
+    ])
+    _post_bag(client, db, "TRC-PLAN-01-002", 1, [
+        {"intake_lot_id": "TRC-LOT-B", "mat_sap_code": "MAT-TRC", "take_volume": 5.0},
+    ])
+
+    forward = client.get("/reports/traceability/TRC-LOT-B").json()
+    assert forward["type"] == "forward"
+    assert sorted(u["batch_id"] for u in forward["forward"]["used_in"]) == ["TRC-PLAN-01-001", "TRC-PLAN-01-002"]
+
+    backward = client.get("/reports/traceability/TRC-PLAN-01-002").json()
+    lots = backward["backward"]["ingredients"][0]["lots_used"]
+    # Only bags of this batch, not every bag of the plan
+    assert [l["intake_lot_id"] for l in lots] == ["TRC-LOT-B"]
+    assert lots[0]["lot_id"] == "TRC-LOT-B-SUP"
+
+    recall = client.get("/reports/traceability/TRC-LOT-B/recall").json()
+    assert recall["summary"]["batch_count"] == 2
+    assert [l["intake_lot_id"] for l in recall["co_lots"]] == ["TRC-LOT-A"]
+
+
+def test_genealogy_follows_rec_delete(client, db, trace_plan):
+    rec = db.query(models.PreBatchRec).filter(
+        models.PreBatchRec.batch_record_id == "TRC-PLAN-01-002-RE-TRC-1"
+    ).first()
+    assert client.delete(f"/prebatch-recs/{rec.id}").status_code == 200
+
+    forward = client.get("/reports/traceability/TRC-LOT-B").json()
+    assert [u["batch_id"] for u in forward["forward"]["used_in"]] == ["TRC-PLAN-01-001"]
+
+
+def test_rebuild_genealogy_matches_incremental(client, db, trace_plan):
+    import crud
+    before = client.get("/reports/traceability/TRC-LOT-A").json()["forward"]["used_in"]
+    assert crud.rebuild_genealogy(db) >= 2
+    after = client.get("/reports/traceability/TRC-LOT-A").json()["forward"]["used_in"]
+    assert [(u["batch_record_id"], u["take_volume"]) for u in after] == \
+        [(u["batch_record_id"], u["take_volume"]) for u in before]
+
+
+def test_daily_consumption_rollup(client, db, trace_plan):
+    import crud
+    # Bag 1 of batch 001 (two origins) remains; bag of batch 002 was deleted above
+    daily = client.get("/reports/production-daily").json()
+    trc = [c for c in daily["ingredient_consumption"] if c["mat_sap_code"] == "MAT-TRC"]
+    assert trc == [{"mat_sap_code": "MAT-TRC", "re_code": "RE-TRC",
+                    "total_volume": 5.0, "transaction_count": 2}]
+
+    crud.rebuild_daily_consumption(db)
+    ranged = client.get("/reports/consumption?plant=Line-1").json()
+    assert [(i["re_code"], i["total_volume"], i["transaction_count"]) for i in ranged["items"]] == \
+        [("RE-TRC", 5.0, 2)]
+
+    # Deleting a bag reverses the day of its created_at; a day never rolled up is left alone
+    from datetime import date, datetime
+    old = _post_bag(client, db, "TRC-PLAN-01-002", 2, [
+        {"intake_lot_id": "TRC-LOT-A", "mat_sap_code": "MAT-TRC", "take_volume": 1.0},
+    ])
+    db.query(models.PreBatchRec).filter(models.PreBatchRec.id == old["id"]).update(
+        {"created_at": datetime(2001, 1, 1, 12)})
+    db.commit()
+    assert client.delete(f"/prebatch-recs/{old['id']}").status_code == 200
+    D = models.DailyIngredientConsumption
+    assert db.query(D).filter(D.consumption_date == date(2001, 1, 1)).count() == 0
+    rows = db.query(D.total_volume, D.txn_count).filter(D.mat_sap_code == "MAT-TRC").all()
+    assert [(v, n) for v, n in rows] == [(6.0, 3)]  # today still counts the bag it was added to
+
+
+def test_report_exports(client, db, trace_plan):
+    csv_resp = client.get("/reports/prebatch-summary?format=csv")
+    assert csv_resp.status_code == 200
+    assert csv_resp.headers["content-type"].startswith("text/csv")
+    assert "attachment" in csv_resp.headers["content-disposition"]
+    lines = csv_resp.text.splitlines()
+    assert lines[0].startswith("batch_record_id,")
+    assert any("TRC-PLAN-01-001-RE-TRC-1" in line for line in lines[1:])
+
+    nd = client.get("/reports/traceability/TRC-LOT-A?format=ndjson")
+    assert nd.status_code == 200
+    rows = [json.loads(line) for line in nd.text.splitlines()]
+    assert [r["batch_id"] for r in rows] == ["TRC-PLAN-01-001"]
+
+    xlsx = client.get("/reports/expiry-alert?format=xlsx")
+    assert xlsx.status_code == 200
+    assert xlsx.content[:2] == b"PK"
+
+    assert client.get("/reports/expiry-alert?format=pdf").status_code == 400
+
+
+def test_report_cache_invalidated_by_writes(client, db, trace_plan):
+    import report_cache
+    report_cache.clear()
+
+    first = client.get("/reports/packing-list/TRC-PLAN-01").json()
+    assert client.get("/reports/packing-list/TRC-PLAN-01").json() == first
+    stats = client.get("/reports/cache-stats").json()
+    assert (stats["hits"], stats["misses"]) == (1, 1)
+
+    # Packing a bag bumps the plan watermark
+    rec_id = db.query(models.PreBatchRec.id).filter(models.PreBatchRec.plan_id == "TRC-PLAN-01").scalar()
+    client.patch(f"/prebatch-recs/{rec_id}/packing-status", json={"packing_status": 1, "packed_by": "tester"})
+    packed = client.get("/reports/packing-list/TRC-PLAN-01").json()
+    assert packed["summary"]["packed"] == first["summary"]["packed"] + 1
+    assert client.get("/reports/cache-stats").json()["misses"] == 2
+
+    # Stock adjustments bump the intake watermark
+    def lot_a_volume():
+        items = [i for b in ("expired", "warning", "ok", "no_expiry")
+                 for i in client.get("/reports/expiry-alert").json()[b]]
+        return next(i["remain_vol"] for i in items if i["intake_lot_id"] == "TRC-LOT-A")
+
+    before = lot_a_volume()
+    assert lot_a_volume() == before
+    client.post("/stock-adjustments/", json={"intake_lot_id": "TRC-LOT-A", "adjust_type": "decrease",
+                                             "adjust_qty": 2.0, "adjust_reason": "count", "adjusted_by": "tester"})
+    assert lot_a_volume() == before - 2.0
+
+    # Batch record follows new bags of its plan
+    batch = client.get("/reports/batch-record/TRC-PLAN-01-002").json()
+    _post_bag(client, db, "TRC-PLAN-01-002", 2, [
+        {"intake_lot_id": "TRC-LOT-A", "mat_sap_code": "MAT-TRC", "take_volume": 3.0},
+    ])
+    assert len(client.get("/reports/batch-record/TRC-PLAN-01-002").json()["ingredients"]) == \
+        len(batch["ingredients"]) + 1
+
+
+def test_report_cache_miss_leaves_caller_session_alone(db, trace_plan):
+    import report_cache
+    from sqlalchemy import inspect
+    report_cache.clear()
+
+    plan = db.query(models.ProductionPlan).filter(models.ProductionPlan.plan_id == "TRC-PLAN-01").one()
+    plan.status = "Cache-Test"
+    db.flush()
+    assert report_cache.get_or_compute(db, "test", "k", [report_cache.plan_scope("TRC-PLAN-01")],
+                                       lambda s: s.query(models.ProductionPlan).count()) >= 1
+    # Still the same transaction: flushed work kept, loaded objects not expired
+    assert db.in_transaction() and not inspect(plan).expired
+    db.rollback()
+    assert db.get(models.ProductionPlan, plan.id).status != "Cache-Test"
+
+
+def test_batch_record_only_includes_own_bags(client, db, trace_plan):
+    # Legacy bag without req_id, attributed through its barcode prefix
+    db.add(models.PreBatchRec(batch_record_id="TRC-PLAN-01-001-RE-TRC-9", plan_id="TRC-PLAN-01",
+                              batch_id="TRC-PLAN-01-001", re_code="RE-TRC", package_no=9, net_volume=0.5,
+                              intake_lot_id="TRC-LOT-B", mat_sap_code="MAT-TRC"))
+    db.commit()
+
+    report = client.get("/reports/batch-record/TRC-PLAN-01-001").json()
+    bags = {i["batch_record_id"] for i in report["ingredients"]}
+    assert bags == {"TRC-PLAN-01-001-RE-TRC-1", "TRC-PLAN-01-001-RE-TRC-9"}
+    legacy = next(i for i in report["ingredients"] if i["batch_record_id"].endswith("-9"))
+    assert (legacy["intake_lot_id"], legacy["lot_id"], legacy["actual_volume"]) == \
+        ("TRC-LOT-B", "TRC-LOT-B-SUP", 0.5)
+    assert [r["re_code"] for r in report["reqs"]] == ["RE-TRC"]
+
+    # Lot details come from the intake list: editing a lot refreshes the cached report
+    from datetime import datetime
+    db.get(models.IngredientIntakeList, "TRC-LOT-B").expire_date = datetime(2031, 1, 31)
+    db.commit()
+    report = client.get("/reports/batch-record/TRC-PLAN-01-001").json()
+    legacy = next(i for i in report["ingredients"] if i["batch_record_id"].endswith("-9"))
+    assert legacy["expire_date"].startswith("2031-01-31")
+
+
+def test_expiry_alert_buckets_in_sql(client, db):
+    from datetime import datetime, timedelta
+    now = datetime.now()
+    for lot, days in (("EXP-OLD-1", -3), ("EXP-OLD-2", -1), ("EXP-SOON", 5), ("EXP-LATER", 90)):
+        db.add(models.IngredientIntakeList(intake_lot_id=lot, lot_id=lot, mat_sap_code="MAT-EXP", re_code="RE-EXP",
+                                           intake_vol=10.0, remain_vol=10.0, intake_by="tester", status="Active",
+                                           expire_date=now + timedelta(days=days)))
+    db.add(models.IngredientIntakeList(intake_lot_id="EXP-EMPTY", lot_id="EXP-EMPTY", mat_sap_code="MAT-EXP",
+                                       intake_vol=10.0, remain_vol=0.0, intake_by="tester", status="Active",
+                                       expire_date=now - timedelta(days=1)))
+    db.commit()
+
+    full = client.get("/reports/expiry-alert").json()
+    summary = client.get("/reports/expiry-alert?summary_only=true").json()["summary"]
+    assert summary == full["summary"]
+    assert summary["expired_count"] == len(full["expired"])
+    assert "EXP-EMPTY" not in {i["intake_lot_id"] for i in full["expired"]}
+    assert "EXP-SOON" in {i["intake_lot_id"] for i in full["warning"]}
+
+    page = client.get("/reports/expiry-alert?bucket=expired&limit=1").json()
+    assert page["total"] == summary["expired_count"]
+    assert [i["intake_lot_id"] for i in page["items"]] == [full["expired"][0]["intake_lot_id"]]
+    page2 = client.get("/reports/expiry-alert?bucket=expired&skip=1&limit=1").json()
+    assert [i["intake_lot_id"] for i in page2["items"]] == [full["expired"][1]["intake_lot_id"]]
+
+    # A shorter horizon moves EXP-SOON out of 'warning'
+    short = client.get("/reports/expiry-alert?warning_days=3&bucket=ok").json()
+    assert "EXP-SOON" in {i["intake_lot_id"] for i in short["items"]}
+    assert client.get("/reports/expiry-alert?bucket=stale").status_code == 400
@@ -0,0 +1,121 @@
+"""
+Tests for the offline station journal (station_journal.py).
+Replay goes through the real app via the TestClient.
+"""
+import pytest
+
+from station_journal import CentralApi, StationJournal
+
+
+class ClientApi(CentralApi):
+    """CentralApi over the TestClient; `online = False` simulates a WAN outage."""
+
+    def __init__(self, client):
+        super().__init__("")
+        self.client = client
+        self.online = True
+        self.broken = set()  # batch_record_ids the server always answers with a 500
+
+    def _request(self, method, path, body=None, headers=None):
+        if not self.online:
+            raise ConnectionError("Network is unreachable")
+        if body and body.get("batch_record_id") in self.broken:
+            return 500, {"detail": "Database error"}
+        resp = self.client.request(method, path, json=body, headers=headers)
+        return resp.status_code, resp.json()
+
+
+@pytest.fixture
+def journal(tmp_path):
+    j = StationJournal(str(tmp_path / "station.db"))
+    yield j
+    j.close()
+
+
+def test_journal_replays_in_order_and_reports_depleted_lots(client, db, journal):
+    import models
+    plan = models.ProductionPlan(plan_id="JRN-PLAN", sku_id="SKU-JRN", num_batches=1, batch_size=10.0)
+    db.add(plan)
+    db.flush()
+    batch = models.ProductionBatch(plan_id=plan.id, batch_id="JRN-PLAN-001", sku_id="SKU-JRN",
+                                   batch_size=10.0, reqs_total=1)
+    db.add(batch)
+    db.flush()
+    req = models.PreBatchReq(batch_db_id=batch.id, plan_id="JRN-PLAN", batch_id="JRN-PLAN-001",
+                             re_code="RE-JRN", required_volume=3.0, status=0)
+    db.add(req)
+    db.add(models.IngredientIntakeList(intake_lot_id="JRN-LOT", lot_id="JRN-LOT", mat_sap_code="MAT-JRN",
+                                       re_code="RE-JRN", intake_vol=2.0, remain_vol=2.0, intake_by="tester"))
+    db.commit()
+
+    def bag(pkg, **kw):
+        return {"req_id": req.id, "batch_record_id": f"JRN-PLAN-001-RE-JRN-{pkg}", "plan_id": "JRN-PLAN",
+                "re_code": "RE-JRN", "package_no": pkg, "total_packages": 3, "net_volume": 1.0,
+                "intake_lot_id": "JRN-LOT", **kw}
+
+    api = ClientApi(client)
+    api.online = False
+    for pkg in (1, 2, 3):
+        journal.append(bag(pkg))
+    assert journal.append(bag(1))["seq"] == 1  # same bag saved twice
+    with pytest.raises(ValueError):
+        journal.append(bag(1, net_volume=1.5))
+    assert journal.replay(api) == {}
+    assert journal.counts() == {"pending": 3}
+
+    # The first bag reached the server but its response was lost
+    first = journal.entries("pending")[0]
+    client.post("/prebatch-recs/", json=first["payload"], headers={"Idempotency-Key": first["idempotency_key"]})
+    # Another station used bag 3's id for a different bag meanwhile
+    client.post("/prebatch-recs/", json=bag(3, net_volume=0.5, intake_lot_id=None))
+
+    api.online = True
+    assert journal.replay(api) == {"synced": 2, "conflict": 1}
+    db.expire_all()
+    assert db.get(models.IngredientIntakeList, "JRN-LOT").remain_vol == pytest.approx(0.0)
+    assert db.query(models.PreBatchRec).filter(models.PreBatchRec.plan_id == "JRN-PLAN").count() == 3
+
+    # Another station empties the lot before this station's next bag replays
+    client.post("/prebatch-recs/", json=bag(4, batch_record_id="JRN-OTHER-1", net_volume=0.25, req_id=None))
+    journal.append(bag(5, net_volume=0.5))
+    assert journal.replay(api) == {"overdrawn": 1}
+
+    report = journal.conflicts()
+    assert [(c["batch_record_id"], c["status"]) for c in report] == [
+        ("JRN-PLAN-001-RE-JRN-3", "conflict"), ("JRN-PLAN-001-RE-JRN-5", "overdrawn"),
+    ]
+    assert report[1]["lot_balances"] == {"JRN-LOT": pytest.approx(-0.75)}
+
+
+def test_bag_failing_with_5xx_stops_blocking_the_queue(client, journal):
+    import station_journal
+
+    def bag(n):
+        return {"batch_record_id": f"JRN5-BAG-{n}", "re_code": "RE-JRN5", "net_volume": 1.0}
+
+    api = ClientApi(client)
+    api.broken.add("JRN5-BAG-2")
+    for n in (1, 2, 3):
+        journal.append(bag(n))
+
+    # Outages do not count towards the cap
+    api.online = False
+    for _ in range(station_journal.MAX_SERVER_ERRORS):
+        assert journal.replay(api) == {}
+    api.online = True
+
+    assert journal.replay(api) == {"synced": 1}
+    for _ in range(station_journal.MAX_SERVER_ERRORS - 2):
+        assert journal.replay(api) == {}
+    assert journal.counts() == {"synced": 1, "pending": 2}
+    assert journal.replay(api) == {"failed": 1, "synced": 1}
+
+    [failed] = journal.conflicts()
+    assert (failed["batch_record_id"], failed["status"], failed["error"]) == \
+        ("JRN5-BAG-2", "failed", "HTTP 500: Database error")
+
+    # Fixed on the server: requeued, it replays
+    api.broken.clear()
+    assert journal.requeue_failed() == 1
+    assert journal.replay(api) == {"synced": 1}
+    assert journal.conflicts() == []
@@ -0,0 +1,233 @@
+import pytest
+import crud
+import models
+import schemas
+
+
+@pytest.fixture(scope="module")
+def stock_lot(db):
+    return crud.create_ingredient_intake_list(db, schemas.IngredientIntakeListCreate(
+        intake_lot_id="STK-LOT-1", mat_sap_code="MAT-STK", re_code="RE-STK",
+        material_description="Stock Salt", intake_vol=50.0, remain_vol=50.0, intake_by="tester",
+    ))
+
+
+def test_stock_ledger_records_every_mutation(client, db, stock_lot):
+    client.post("/stock-adjustments/", json={"intake_lot_id": "STK-LOT-1", "adjust_type": "increase",
+                                             "adjust_qty": 5.0, "adjust_reason": "recount", "adjusted_by": "tester"})
+    rec = client.post("/prebatch-recs/", json={"batch_record_id": "STK-BATCH-RE-STK-1", "re_code": "RE-STK",
+                                               "net_volume": 8.0, "intake_lot_id": "STK-LOT-1"}).json()
+    client.delete(f"/prebatch-recs/{rec['id']}")
+
+    moves = client.get("/stock-adjustments/movements/?intake_lot_id=STK-LOT-1").json()
+    assert [(m["movement_type"], m["direction"], m["qty"], m["new_vol"]) for m in moves] == [
+        ("prebatch_restore", "increase", 8.0, 55.0),
+        ("prebatch", "decrease", 8.0, 47.0),
+        ("adjustment", "increase", 5.0, 55.0),
+        ("intake", "increase", 50.0, 50.0),
+    ]
+    assert moves[1]["reference"] == "STK-BATCH-RE-STK-1"
+    assert moves[2]["user"] == "tester"
+
+
+def test_stock_movements_keyset_pagination(client, db, stock_lot):
+    full = client.get("/stock-adjustments/movements/?re_code=RE-STK").json()
+    seen, cursor = [], None
+    while True:
+        url = "/stock-adjustments/movements/?re_code=RE-STK&limit=3" + (f"&cursor={cursor}" if cursor else "")
+        response = client.get(url)
+        seen += [m["id"] for m in response.json()]
+        cursor = response.headers.get("x-next-cursor")
+        if not cursor:
+            break
+    assert seen == [m["id"] for m in full]
+    assert client.get("/stock-adjustments/movements/?cursor=garbage").status_code == 400
+
+
+@pytest.fixture
+def ten_k_lots(db):
+    """10k active lots intaken on one day, with adjustments and pre-batch usage on a share of them."""
+    from datetime import datetime
+    day = datetime(2001, 1, 1, 8, 0)
+    lots = [f"PERF-{n:05d}" for n in range(10_000)]
+    db.bulk_insert_mappings(models.IngredientIntakeList, [{
+        "intake_lot_id": lot, "lot_id": lot, "mat_sap_code": f"MAT-P{n % 50}", "re_code": f"RE-P{n % 50}",
+        "intake_to": "FH" if n % 2 else "SPP", "intake_vol": 25.0, "remain_vol": 20.0,
+        "intake_by": "perf", "status": "Active", "intake_at": day,
+    } for n, lot in enumerate(lots)])
+    db.bulk_insert_mappings(models.StockAdjustment, [{
+        "intake_lot_id": lot, "adjust_type": "decrease", "adjust_reason": "count", "adjust_qty": 1.0,
+        "prev_remain_vol": 21.0, "new_remain_vol": 20.0, "adjusted_by": "perf", "adjusted_at": day,
+    } for lot in lots[::3]])
+    db.bulk_insert_mappings(models.PreBatchRec, [{
+        "id": 900_000 + n, "batch_record_id": f"PERF-BAG-{n}", "re_code": "RE-P0",
+    } for n in range(2_000)])
+    db.bulk_insert_mappings(models.PreBatchRecFrom, [{
+        "prebatch_rec_id": 900_000 + n, "intake_lot_id": lots[n * 5], "take_volume": 4.0, "created_at": day,
+    } for n in range(2_000)])
+    db.commit()
+    yield lots
+    for model, col in ((models.PreBatchRecFrom, models.PreBatchRecFrom.prebatch_rec_id),
+                       (models.PreBatchRec, models.PreBatchRec.id)):
+        db.query(model).filter(col >= 900_000).delete(synchronize_session=False)
+    db.query(models.StockAdjustment).filter(models.StockAdjustment.adjusted_by == "perf").delete(synchronize_session=False)
+    db.query(models.IngredientIntakeList).filter(models.IngredientIntakeList.intake_by == "perf").delete(synchronize_session=False)
+    db.commit()
+
+
+def test_summary_report_10k_lots_bounded_statements(client, db, ten_k_lots):
+    import time
+    from sqlalchemy import event
+    statements = []
+
+    def count(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    url = "/stock-adjustments/summary-report?from_date=2001-01-01&to_date=2001-01-01"
+    for params in ("", "&detail=false"):
+        statements.clear()
+        event.listen(db.get_bind(), "before_cursor_execute", count)
+        started = time.perf_counter()
+        try:
+            response = client.get(url + params)
+        finally:
+            event.remove(db.get_bind(), "before_cursor_execute", count)
+        elapsed = time.perf_counter() - started
+        assert response.status_code == 200
+        # Target is under a second; the bound leaves room for slow CI machines
+        assert elapsed < 2.0, f"summary-report{params} took {elapsed:.2f}s"
+        data = response.json()
+        assert sum(len(v) for v in data.values()) == 10_000
+        # Lots, adjustments and pre-batch usage in one bulk query each, however many lots there are
+        assert len(statements) <= 3, f"summary-report{params} ran {len(statements)} statements"
+
+        lot = next(l for l in data["SPP"] if l["intake_lot_id"] == "PERF-00000")
+        assert (lot["adj_total"], lot["used_vol"]) == (-1.0, 4.0)
+        if params:
+            assert "adjustments" not in lot
+        else:
+            assert len(lot["adjustments"]) == len(lot["prebatch_usage"]) == 1
+
+
+def test_stock_as_of_snapshots_and_replay(client, db):
+    from datetime import datetime, timedelta
+    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    d1, d2, d3 = (today - timedelta(days=n) for n in (5, 4, 3))
+    db.add(models.IngredientIntakeList(intake_lot_id="STK-ASOF", lot_id="STK-ASOF", mat_sap_code="MAT-ASOF",
+                                       re_code="RE-ASOF", intake_vol=100.0, remain_vol=65.0, intake_by="tester",
+                                       status="Active", intake_at=d1 + timedelta(hours=8), intake_to="ASOF"))
+    for ts, direction, qty in ((d1 + timedelta(hours=8), "increase", 100.0), (d2 + timedelta(hours=9), "decrease", 30.0),
+                               (d3 + timedelta(hours=10), "increase", 5.0), (today + timedelta(minutes=1), "decrease", 10.0)):
+        db.add(models.StockLedger(ts=ts, intake_lot_id="STK-ASOF", re_code="RE-ASOF", movement_type="adjustment",
+                                  direction=direction, qty=qty))
+    db.commit()
+    crud.take_stock_snapshots(db, up_to=d2.date())
+    assert db.query(models.StockSnapshot).filter(models.StockSnapshot.intake_lot_id == "STK-ASOF").count() == 2
+
+    def lookup(as_of):
+        return client.get(f"/stock-adjustments/lot-lookup/STK-ASOF?as_of={as_of}").json()["remain_vol"]
+
+    assert lookup(d1.date().isoformat()) == 100.0                          # from snapshot
+    assert lookup(d2.date().isoformat()) == 70.0                           # from snapshot
+    assert lookup((d3 + timedelta(hours=12)).isoformat()) == 75.0          # snapshot + replay
+    assert lookup((d1 - timedelta(days=1)).date().isoformat()) == 0.0
+    assert client.get("/stock-adjustments/lot-lookup/STK-ASOF").json()["remain_vol"] == 65.0
+
+    summary = client.get(f"/stock-adjustments/summary-report?as_of={d3.date().isoformat()}&detail=false").json()
+    assert [l["remain_vol"] for l in summary["ASOF"]] == [75.0]
+    assert "ASOF" not in client.get(f"/stock-adjustments/summary-report?as_of={(d1 - timedelta(days=1)).date().isoformat()}").json()
+    assert client.get("/stock-adjustments/lot-lookup/STK-ASOF?as_of=yesterday").status_code == 400
+
+
+def test_reconcile_reports_and_repairs_drift(client, db, monkeypatch):
+    crud.create_ingredient_intake_list(db, schemas.IngredientIntakeListCreate(
+        intake_lot_id="REC-LOT", mat_sap_code="MAT-REC", re_code="RE-REC",
+        intake_vol=10.0, remain_vol=10.0, intake_by="tester",
+    ))
+    client.post("/stock-adjustments/", json={"intake_lot_id": "REC-LOT", "adjust_type": "decrease",
+                                             "adjust_qty": 2.0, "adjust_reason": "count", "adjusted_by": "tester"})
+    client.post("/prebatch-recs/", json={"batch_record_id": "REC-BATCH-RE-REC-1", "re_code": "RE-REC",
+                                         "net_volume": 3.0, "intake_lot_id": "REC-LOT"})
+
+    def rec_lot(result):
+        return [d for d in result["discrepancies"] if d["intake_lot_id"] == "REC-LOT"]
+
+    assert rec_lot(client.get("/stock-adjustments/reconcile").json()) == []
+
+    db.query(models.IngredientIntakeList).filter(
+        models.IngredientIntakeList.intake_lot_id == "REC-LOT"
+    ).update({"remain_vol": 4.5})
+    db.commit()
+    [drift] = rec_lot(client.get("/stock-adjustments/reconcile").json())
+    assert (drift["expected_vol"], drift["remain_vol"], drift["diff"]) == (5.0, 4.5, -0.5)
+
+    # A bag drawn after the report's unlocked read survives the repair
+    from crud import crud_reconcile
+    report = crud_reconcile._expected_balances
+
+    def report_then_draw(db, lot_ids=None):
+        df = report(db, lot_ids)
+        if lot_ids is None:
+            client.post("/prebatch-recs/", json={"batch_record_id": "REC-BATCH-RE-REC-2", "re_code": "RE-REC",
+                                                 "net_volume": 1.0, "intake_lot_id": "REC-LOT"})
+        return df
+
+    monkeypatch.setattr(crud_reconcile, "_expected_balances", report_then_draw)
+    repaired = client.post("/stock-adjustments/reconcile/repair").json()
+    monkeypatch.undo()
+    assert repaired["repaired"] >= 1
+    assert client.get("/stock-adjustments/lot-lookup/REC-LOT").json()["remain_vol"] == 4.0
+    last = client.get("/stock-adjustments/movements/?intake_lot_id=REC-LOT&limit=1").json()[0]
+    assert (last["movement_type"], last["direction"], last["qty"]) == ("reconcile", "increase", 0.5)
+    assert rec_lot(client.get("/stock-adjustments/reconcile").json()) == []
+
+
+def test_reconcile_10k_lots_in_one_pass(client, ten_k_lots):
+    import time
+    started = time.perf_counter()
+    result = client.get("/stock-adjustments/reconcile").json()
+    assert time.perf_counter() - started < 3.0
+    assert result["lots_checked"] >= 10_000
+    # Seeded remain 20 vs intake 25: only lots with both the −1 adjustment and the 4.0 take balance
+    drifting = {d["intake_lot_id"] for d in result["discrepancies"] if d["intake_lot_id"].startswith("PERF-")}
+    assert drifting == {lot for n, lot in enumerate(ten_k_lots) if n % 15}
+
+
+def test_concurrent_stations_lose_no_updates(db):
+    """20 stations drawing from one lot at once: every draw lands and is logged once."""
+    import threading
+    from sqlalchemy.orm import sessionmaker
+    Station = sessionmaker(autocommit=False, autoflush=False, bind=db.get_bind())
+
+    crud.create_ingredient_intake_list(db, schemas.IngredientIntakeListCreate(
+        intake_lot_id="CONC-LOT", mat_sap_code="MAT-CONC", re_code="RE-CONC",
+        intake_vol=1000.0, remain_vol=1000.0, intake_by="tester",
+    ))
+    errors = []
+
+    def station(n):
+        session = Station()
+        try:
+            for i in range(5):
+                crud.create_prebatch_rec(session, schemas.PreBatchRecCreate(
+                    batch_record_id=f"CONC-BATCH-RE-CONC-{n}-{i}", re_code="RE-CONC",
+                    net_volume=1.5, intake_lot_id="CONC-LOT",
+                ))
+        except Exception as e:
+            errors.append(e)
+        finally:
+            session.close()
+
+    threads = [threading.Thread(target=station, args=(n,)) for n in range(20)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert errors == []
+    db.expire_all()
+    assert crud.lock_lot(db, "CONC-LOT").remain_vol == 1000.0 - 20 * 5 * 1.5
+    db.rollback()
+    assert db.query(models.StockLedger).filter(
+        models.StockLedger.intake_lot_id == "CONC-LOT", models.StockLedger.movement_type == "prebatch",
+    ).count() == 100
@@ -37,6 +37,39 @@ def update_schema():
                 conn.execute(text("CREATE INDEX ix_prebatch_recs_mat_sap_code ON prebatch_recs (mat_sap_code)"))
                 conn.commit()
                 print("Successfully added column mat_sap_code.")
+
+            # Pre-batch progress counters on production_batches
+            for column in ("reqs_total", "reqs_completed", "bags_weighed"):
+                result = conn.execute(text(f"SHOW COLUMNS FROM production_batches LIKE '{column}'"))
+                if result.fetchone():
+                    print(f"Column '{column}' already exists.")
+                else:
+                    print(f"Adding column '{column}' to production_batches...")
+                    conn.execute(text(f"ALTER TABLE production_batches ADD COLUMN {column} INT NOT NULL DEFAULT 0"))
+                    conn.commit()
+                    print(f"Successfully added column {column}. Run rebuild_batch_counters.py to fill it.")
+
+            # Weighed-so-far progress on prebatch_reqs
+            for column, ddl in (("packaged_volume", "DOUBLE NOT NULL DEFAULT 0"), ("bag_count", "INT NOT NULL DEFAULT 0")):
+                result = conn.execute(text(f"SHOW COLUMNS FROM prebatch_reqs LIKE '{column}'"))
+                if result.fetchone():
+                    print(f"Column '{column}' already exists.")
+                else:
+                    print(f"Adding column '{column}' to prebatch_reqs...")
+                    conn.execute(text(f"ALTER TABLE prebatch_reqs ADD COLUMN {column} {ddl}"))
+                    conn.commit()
+                    print(f"Successfully added column {column}. Run rebuild_batch_counters.py to fill it.")
+
+            # Batch part of batch_record_id on prebatch_recs
+            result = conn.execute(text("SHOW COLUMNS FROM prebatch_recs LIKE 'batch_id'"))
+            if result.fetchone():
+                print("Column 'batch_id' already exists.")
+            else:
+                print("Adding column 'batch_id' to prebatch_recs...")
+                conn.execute(text("ALTER TABLE prebatch_recs ADD COLUMN batch_id VARCHAR(100) NULL AFTER plan_id"))
+                conn.execute(text("CREATE INDEX ix_prebatch_recs_batch_re_pkg ON prebatch_recs (batch_id, re_code, package_no)"))
+                conn.commit()
+                print("Successfully added column batch_id. Run backfill_bag_barcodes.py to fill it.")
         except Exception as e:
             print(f"Error updating schema: {e}")
 